@@ -0,0 +1,74 @@
+from typing import List, Tuple, Any
+import numpy as np
+
+from GBP import VariableNode, FactorNode, FactorGraph
+from ContourFitting import smoothing, smoothing_jac
+from Accelerators import OverRelaxation, AndersonAcceleration
+import ContourTracking as contour_fitting
+
+# name, damping, adaptive damping, accelerator factory
+OPTIONS: List[Tuple[str, float, bool, Any]] = [
+    ("plain", 0., False, None),
+    ("damping 0.3", 0.3, False, None),
+    ("damping 0.5", 0.5, False, None),
+    ("adaptive damping", 0., True, None),
+    ("over relaxation 1.3", 0., False, lambda: OverRelaxation(1.3)),
+    ("anderson 5", 0., False, lambda: AndersonAcceleration(5)),
+]
+
+
+def generate_grid(size: int, damping: float, adaptive_damping: bool, accelerator, seed: int = 0) -> FactorGraph:
+    """
+    Loopy linear graph: size x size heights with noisy priors, smoothed towards their 4 neighbours
+    """
+    rng = np.random.RandomState(seed)
+    variable_nodes = []
+    for i in range(size * size):
+        node = VariableNode(1)
+        node.prior.set_values(np.array([rng.randn()]), np.array([[1.]]))
+        node.belief = node.prior.copy()
+        variable_nodes.append(node)
+
+    factor_nodes = []
+    for row in range(size):
+        for col in range(size):
+            i = row * size + col
+            neighbours = ([i + 1] if col + 1 < size else []) + ([i + size] if row + 1 < size else [])
+            for j in neighbours:
+                factor_nodes.append(
+                    FactorNode([variable_nodes[i], variable_nodes[j]], smoothing, np.array([[0.01]]), np.zeros(1),
+                               smoothing_jac, False, [], linear=True, damping=damping,
+                               adaptive_damping=adaptive_damping))
+    return FactorGraph(variable_nodes, factor_nodes, accelerator=accelerator)
+
+
+def run_grid(size: int = 10, max_iterations: int = 1000, tolerance: float = 1e-4):
+    print("Grid " + str(size) + "x" + str(size) + " (tolerance " + str(tolerance) + ")")
+    for name, damping, adaptive_damping, accelerator in OPTIONS:
+        factor_graph = generate_grid(size, damping, adaptive_damping, accelerator() if accelerator else None)
+        report = factor_graph.fit(max_iterations, tolerance)
+        print("  " + name + ": " + str(report.iterations) + " iterations, converged: " + str(report.converged))
+
+
+def run_contour(seeds: List[int] = (42, 1, 7)):
+    print("2d contour fitting with huber line factors (first fit)")
+    config = contour_fitting.GlobalConfig
+    for name, damping, adaptive_damping, accelerator in OPTIONS:
+        config.damping, config.adaptive_damping = damping, adaptive_damping
+        config.accelerator = accelerator() if accelerator else None
+        iterations = []
+        for seed in seeds:
+            np.random.seed(seed)
+            contour_fitting.sample_from_rect.time = 0.
+            measurements = contour_fitting.generate_measurements([20, 25])
+            iterations.append(contour_fitting.generate_prior(measurements).fit().iterations)
+        print("  " + name + ": " + str(iterations) + " iterations")
+
+
+def main():
+    run_grid()
+    run_contour()
+
+
+if __name__ == "__main__":
+    main()
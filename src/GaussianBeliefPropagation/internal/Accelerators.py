@@ -0,0 +1,100 @@
+import numpy as np
+
+from GBP import EdgeTable
+
+
+# The accelerators treat one synchronous iteration as a fixed point map of the stacked factor to variable messages,
+# which is the flat buffer edges.to_variable_eta of the edge table.
+# Only the information vectors (eta) are extrapolated, the precisions are taken from the plain iteration.
+# The precisions of gaussian BP converge independently of the means and this way they always stay positive definite.
+
+
+class OverRelaxation:
+    __doc__ = "Extrapolates the messages of every iteration: x + omega * (G(x) - x). omega < 1 is a global damping."
+
+    def __init__(self, omega: float = 1.5):
+        """
+        :param omega: relaxation factor, values in (1, 2) over relax
+        """
+        self.omega = omega
+        self.previous = None
+
+    def reset(self):
+        """
+        Forgets the previous messages, e.g. if the graph changed
+        """
+        self.previous = None
+
+    def accelerate(self, edges: EdgeTable):
+        """
+        Called after the factors computed their messages, replaces them with the extrapolated messages
+        :param edges: edge table of the graph holding the messages
+        """
+        current = edges.to_variable_eta.copy()
+        if self.previous is not None and self.previous.shape == current.shape:
+            current = self.previous + self.omega * (current - self.previous)
+            edges.to_variable_eta[:] = current
+        self.previous = current
+
+
+class AndersonAcceleration:
+    __doc__ = "Anderson mixing (type II) of the last iterations of the stacked messages."
+
+    def __init__(self, memory: int = 5, regularization: float = 1e-10, safeguard: float = 10.):
+        """
+        :param memory: number of previous iterations used for the extrapolation
+        :param regularization: tikhonov regularization of the least squares problem (relative to its scale)
+        :param safeguard: restart, if the residual grows by this factor compared to the smallest residual since the
+                          last restart
+        """
+        self.memory = memory
+        self.regularization = regularization
+        self.safeguard = safeguard
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets the history, e.g. if the graph changed
+        """
+        self.previous_x = None  # input of the last iteration
+        self.previous_g = None  # output of the last iteration
+        self.previous_f = None  # residual of the last iteration
+        self.delta_g = []
+        self.delta_f = []
+        self.best_residual = np.inf
+
+    def accelerate(self, edges: EdgeTable):
+        """
+        Called after the factors computed their messages, replaces them with the mixed messages
+        :param edges: edge table of the graph holding the messages
+        """
+        g = edges.to_variable_eta.copy()
+        if self.previous_x is None or self.previous_x.shape != g.shape:
+            self.reset()
+            self.previous_x = g
+            return
+        f = g - self.previous_x
+        residual = np.linalg.norm(f)
+        if residual > self.safeguard * self.best_residual:
+            self.reset()
+            self.previous_x = g
+            return
+        self.best_residual = min(self.best_residual, residual)
+
+        if self.previous_f is not None:
+            self.delta_g.append(g - self.previous_g)
+            self.delta_f.append(f - self.previous_f)
+            if len(self.delta_f) > self.memory:
+                self.delta_g.pop(0)
+                self.delta_f.pop(0)
+        self.previous_g, self.previous_f = g, f
+
+        x = g
+        if self.delta_f:
+            delta_f = np.stack(self.delta_f, axis=1)
+            normal = delta_f.T @ delta_f
+            normal += np.identity(len(self.delta_f)) * self.regularization * max(np.trace(normal), 1e-300)
+            gamma = np.linalg.solve(normal, delta_f.T @ f)
+            x = g - np.stack(self.delta_g, axis=1) @ gamma
+            edges.to_variable_eta[:] = x
+        self.previous_x = x
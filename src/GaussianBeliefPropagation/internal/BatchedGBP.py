@@ -0,0 +1,424 @@
+from typing import List, Dict, Tuple, Callable
+import numpy as np
+
+from GBP import VariableNode, FactorNode, FactorGraph, ConvergenceReport, BeliefSnapshot, MAX_DAMPING, DAMPING_STEP
+from LinAlgKernels import positive_definite, inv_spd, solve_spd, marginalize
+from RobustKernels import mahalanobis, precision_scales
+from ContourFactors import line_measurement_factor, line_measurement_factors
+
+# Batched versions of measurement functions: measurement_fn -> fn(means (N, arity, d), factor_nodes) -> (N, M)
+BATCHED_MEASUREMENT_FNS: Dict[Callable, Callable[[np.ndarray, List[FactorNode]], np.ndarray]] = {}
+
+
+def register_batched_measurement_fn(measurement_fn: Callable, batched_fn: Callable):
+    """
+    Registers a batched version of a measurement function, which evaluates all factors of a group at once
+    :param measurement_fn: measurement function of the factor nodes
+    :param batched_fn: takes the stacked means of the adjacent variables (N, arity, d) and the N factor nodes
+                       (for their args) and returns the stacked measurements (N, M)
+    """
+    BATCHED_MEASUREMENT_FNS[measurement_fn] = batched_fn
+
+
+def _line_measurements(means: np.ndarray, factor_nodes: List[FactorNode]) -> np.ndarray:
+    return line_measurement_factors(means, np.array([f.args[0] for f in factor_nodes]),
+                                    np.array([f.args[1] for f in factor_nodes], dtype=bool))
+
+
+register_batched_measurement_fn(line_measurement_factor, _line_measurements)
+
+
+def _read_only(array: np.ndarray) -> np.ndarray:
+    view = array.view()
+    view.flags.writeable = False
+    return view
+
+
+class VariableGroup:
+    __doc__ = "All variable nodes of the same dimensionality, stored as stacked arrays."
+
+    def __init__(self, variable_nodes: List[VariableNode]):
+        """
+        Copies the state of the given variable nodes into stacked arrays
+        :param variable_nodes: variable nodes which all have the same dimensions
+        """
+        self.variable_nodes = variable_nodes
+        self.dim = variable_nodes[0].dimensions
+        n, d = len(variable_nodes), self.dim
+        self.prior_eta = np.zeros([n, d])
+        self.prior_lam = np.zeros([n, d, d])
+        self.belief_eta = np.zeros([n, d])
+        self.belief_lam = np.zeros([n, d, d])
+        self.mu = np.zeros([n, d])
+        self.sigma = np.zeros([n, d, d])
+        for row, v in enumerate(variable_nodes):
+            self.prior_eta[row] = v.prior.eta
+            self.prior_lam[row] = v.prior.lam
+            self.belief_eta[row] = v.belief.eta
+            self.belief_lam[row] = v.belief.lam
+            self.mu[row] = v.mu
+            self.sigma[row] = v.sigma
+
+
+class FactorGroup:
+    __doc__ = "All factor nodes with the same arity and the same dimensions of adjacent variables."
+
+    def __init__(self, factor_nodes: List[FactorNode], variable_dims: Tuple[int, ...],
+                 variable_rows: np.ndarray):
+        """
+        Copies the state of the given factor nodes into stacked arrays
+        :param factor_nodes: factor nodes sharing the same layout
+        :param variable_dims: dimension of the variable in each slot of the factors
+        :param variable_rows: (N, arity) rows of the adjacent variables within their variable group
+        """
+        self.factor_nodes = factor_nodes
+        self.variable_dims = variable_dims
+        self.variable_rows = variable_rows
+        self.arity = len(variable_dims)
+        self.dim = sum(variable_dims)
+        n = len(factor_nodes)
+
+        # Slices of each slot within the stacked factor dimensions
+        offsets = np.cumsum((0,) + variable_dims)
+        self.slot_indices = [np.arange(offsets[s], offsets[s + 1]) for s in range(self.arity)]
+        self.rest_indices = [np.concatenate([self.slot_indices[o] for o in range(self.arity) if o != s] +
+                                            [np.zeros(0, dtype=int)]) for s in range(self.arity)]
+
+        self.factor_eta = np.zeros([n, self.dim])
+        self.factor_lam = np.zeros([n, self.dim, self.dim])
+        self.msg_in_eta = [np.zeros([n, d]) for d in variable_dims]
+        self.msg_in_lam = [np.zeros([n, d, d]) for d in variable_dims]
+        self.msg_out_eta = [np.zeros([n, d]) for d in variable_dims]
+        self.msg_out_lam = [np.zeros([n, d, d]) for d in variable_dims]
+        self.linearization_point = [np.zeros([n, d]) for d in variable_dims]
+
+        # Static part of the noise model, the adaptive part is recomputed on relinearization
+        self.robust_kernels = [f.robust_kernel for f in factor_nodes]
+        self.robust = np.array([kernel is not None for kernel in self.robust_kernels], dtype=bool)
+        self.linear = np.array([f.linear for f in factor_nodes], dtype=bool)
+        self.relinearization_threshold = np.array([f.relinearization_threshold for f in factor_nodes], dtype=float)
+        self.base_damping = np.array([f.base_damping for f in factor_nodes], dtype=float)
+        self.damping = np.array([f.damping for f in factor_nodes], dtype=float)
+        self.adaptive_damping = np.array([f.adaptive_damping for f in factor_nodes], dtype=bool)
+        self.message_change = np.array([f.message_change for f in factor_nodes], dtype=float)
+        self.num_sent_messages = np.array([f.num_sent_messages for f in factor_nodes], dtype=int)
+
+        for row, f in enumerate(factor_nodes):
+            self.factor_eta[row] = f.factor_eta
+            self.factor_lam[row] = f.factor_lam
+            for s, (to_factor, to_variable) in enumerate(zip(f.adj_variable_messages, f.messages_to_adj_variables)):
+                self.linearization_point[s][row] = f.linearization_point[s]
+                self.msg_in_eta[s][row] = to_factor.eta
+                self.msg_in_lam[s][row] = to_factor.lam
+                self.msg_out_eta[s][row] = to_variable.eta
+                self.msg_out_lam[s][row] = to_variable.lam
+        # The noise is factorized by the factor nodes already
+        if len({f.measurement_noise_lam.shape for f in factor_nodes}) == 1:
+            self.noise_lam = np.array([f.measurement_noise_lam for f in factor_nodes])
+            self.noise_whitening = np.array([f.noise_whitening for f in factor_nodes])
+        else:
+            self.noise_lam = None  # mixed measurement dimensions, handled factor by factor
+            self.noise_whitening = None
+
+
+class BatchedFactorGraph:
+    __doc__ = "Alternate engine for a FactorGraph, running the synchronous iteration on stacked arrays."
+
+    def __init__(self, factor_graph: FactorGraph):
+        """
+        Groups all nodes of the factor graph by their layout and copies their current state
+        :param factor_graph: the factor graph to run. Its nodes are updated by write_back.
+        """
+        self.factor_graph = factor_graph
+
+        variables_by_dim: Dict[int, List[VariableNode]] = {}
+        for v in factor_graph.variable_nodes:
+            variables_by_dim.setdefault(v.dimensions, []).append(v)
+        self.variable_groups = {d: VariableGroup(nodes) for d, nodes in variables_by_dim.items()}
+        self.variable_row = {}
+        for group in self.variable_groups.values():
+            for row, v in enumerate(group.variable_nodes):
+                self.variable_row[v.idx] = row
+
+        factors_by_layout: Dict[Tuple[int, ...], List[FactorNode]] = {}
+        for f in factor_graph.factor_nodes:
+            layout = tuple(v.dimensions for v in f.adj_variable_nodes)
+            factors_by_layout.setdefault(layout, []).append(f)
+        self.factor_groups = []
+        for layout, factors in factors_by_layout.items():
+            rows = np.array([[self.variable_row[v_idx] for v_idx in f.adj_variable_node_idxs] for f in factors],
+                            dtype=int).reshape(len(factors), len(layout))
+            self.factor_groups.append(FactorGroup(factors, layout, rows))
+
+    def relinearize_factors(self):
+        """
+        Computes the linearization points of all factors as the means of their incoming messages
+        and recomputes the factors, which moved further than their relinearization threshold (see FactorNode).
+        The jacobian functions and measurement functions without a batched version (see
+        register_batched_measurement_fn) are evaluated per factor, everything else is batched.
+        """
+        for group in self.factor_groups:
+            points = []
+            for s in range(group.arity):
+                lam = group.msg_in_lam[s]
+                invertible = positive_definite(lam)
+                point = np.zeros_like(group.msg_in_eta[s])
+                if np.any(invertible):
+                    point[invertible] = solve_spd(lam[invertible], group.msg_in_eta[s][invertible][..., None])[..., 0]
+                points.append(point)
+
+            moved = np.max([np.linalg.norm(point - old, axis=1) for point, old in
+                            zip(points, group.linearization_point)], axis=0)
+            constant = group.linear & ~group.robust
+            rows = np.nonzero((moved > group.relinearization_threshold) & ~constant)[0]
+            if rows.size == 0:
+                continue
+            for s in range(group.arity):
+                group.linearization_point[s][rows] = points[s][rows]
+            self._compute_factors(group, rows)
+
+    @staticmethod
+    def _evaluate(group: FactorGroup, rows: np.ndarray):
+        """
+        Evaluates jacobian and measurement function of the given factors of the group at their linearization points
+        :return: jacobians (N,M,D), residuals measurement - prediction (N,M) and stacked linearization points (N,D)
+        """
+        factor_nodes = [group.factor_nodes[row] for row in rows]
+        for row, f in zip(rows, factor_nodes):
+            f.linearization_point = [group.linearization_point[s][row] for s in range(group.arity)]
+        batched_fn = BATCHED_MEASUREMENT_FNS.get(factor_nodes[0].measurement_fn)
+        if batched_fn is not None and len(set(group.variable_dims)) == 1 and all(
+                f.measurement_fn is factor_nodes[0].measurement_fn for f in factor_nodes):
+            means = np.stack([point[rows] for point in group.linearization_point], axis=1)
+            for f, predicted in zip(factor_nodes, batched_fn(means, factor_nodes)):
+                f.predicted_measurement = predicted  # memoized, so predict_measurement returns it
+                f.prediction_point = f.linearization_point
+
+        jacobians, residuals = [], []
+        for f in factor_nodes:
+            predicted = f.predict_measurement()
+            jacobians.append(f.compute_jacobian())
+            residuals.append(np.broadcast_to(f.measurement, predicted.shape) - predicted)
+        stacked_point = np.concatenate([point[rows] for point in group.linearization_point], axis=1)
+        return np.array(jacobians), np.array(residuals), stacked_point
+
+    def _compute_factors(self, group: FactorGroup, rows: np.ndarray):
+        """
+        Computes the (adaptive) noise and the factors of the given rows of a group, see FactorNode.compute_factor
+        """
+        if group.noise_lam is None:
+            # The measurement dimensions differ between factors, fallback to the node implementation
+            for row in rows:
+                f = group.factor_nodes[row]
+                f.linearization_point = [group.linearization_point[s][row] for s in range(group.arity)]
+                f.compute_adaptive_noise()
+                f.compute_factor()
+                group.factor_eta[row] = f.factor_eta
+                group.factor_lam[row] = f.factor_lam
+            return
+
+        jacobians, residuals, point = self._evaluate(group, rows)
+
+        noise_lam = group.noise_lam[rows]
+        if np.any(group.robust[rows]):
+            distances = mahalanobis(residuals, group.noise_whitening[rows])
+            scale = precision_scales([group.robust_kernels[row] for row in rows], distances)
+            noise_lam = noise_lam * scale[:, None, None]
+
+        jacobians_t_lam = np.transpose(jacobians, (0, 2, 1)) @ noise_lam
+        linearized_measurement = residuals + np.einsum("nmd,nd->nm", jacobians, point)
+        group.factor_eta[rows] = np.einsum("ndm,nm->nd", jacobians_t_lam, linearized_measurement)
+        factor_lam = jacobians_t_lam @ jacobians
+
+        # Ensure that matrix is positive-semi-definite
+        factor_lam = (factor_lam + np.transpose(factor_lam, (0, 2, 1))) / 2.
+        factor_lam += np.identity(group.dim) * 1e-6
+        group.factor_lam[rows] = factor_lam
+
+    def compute_all_messages(self):
+        """
+        Computes all factor to variable messages, one batched marginalization per group and slot
+        """
+        for group in self.factor_groups:
+            new_messages = []
+            for s in range(group.arity):
+                eta = group.factor_eta.copy()
+                lam = group.factor_lam.copy()
+                for o in range(group.arity):
+                    if o != s:
+                        idx = group.slot_indices[o]
+                        eta[:, idx] += group.msg_in_eta[o]
+                        lam[:, idx[:, None], idx[None, :]] += group.msg_in_lam[o]
+
+                # Marginalize the other variables of the whole group at once
+                new_message_eta, new_message_lam = marginalize(eta, lam, group.slot_indices[s],
+                                                               group.rest_indices[s])
+
+                # Ensure that matrix is positive-semi-definite
+                new_message_lam = (new_message_lam + np.transpose(new_message_lam, (0, 2, 1))) / 2.
+                new_message_lam += np.identity(group.variable_dims[s]) * 1e-6
+                new_messages.append((new_message_eta, new_message_lam))
+
+            if np.any(group.adaptive_damping):
+                self._update_damping(group, new_messages)
+            damping = np.where(group.num_sent_messages > 0, group.damping, 0.)
+            damped = damping > 0
+            for s, (new_message_eta, new_message_lam) in enumerate(new_messages):
+                if np.any(damped):
+                    new_message_eta[damped] = (1. - damping[damped, None]) * new_message_eta[damped] + \
+                                              damping[damped, None] * group.msg_out_eta[s][damped]
+                    new_message_lam[damped] = (1. - damping[damped, None, None]) * new_message_lam[damped] + \
+                                              damping[damped, None, None] * group.msg_out_lam[s][damped]
+                group.msg_out_eta[s] = new_message_eta
+                group.msg_out_lam[s] = new_message_lam
+            group.num_sent_messages += 1
+
+    @staticmethod
+    def _update_damping(group: FactorGroup, new_messages: List[Tuple[np.ndarray, np.ndarray]]):
+        """
+        Adapts the damping of all factors of the group with adaptive damping, see FactorNode.update_damping
+        """
+        change = np.sqrt(sum(np.sum(np.square(eta - old_eta), axis=1)
+                             for (eta, _), old_eta in zip(new_messages, group.msg_out_eta)))
+        increase = (group.num_sent_messages > 1) & (change > group.message_change)
+        adapted = np.where(increase, np.minimum(MAX_DAMPING, group.damping + DAMPING_STEP),
+                           group.base_damping + (group.damping - group.base_damping) / 2.)
+        group.damping = np.where(group.adaptive_damping, adapted, group.damping)
+        group.message_change = np.where(group.adaptive_damping, change, group.message_change)
+
+    def update_all_beliefs(self):
+        """
+        Sums up prior and factor messages to the new beliefs and sends them back to the factors
+        """
+        for var_group in self.variable_groups.values():
+            var_group.belief_eta = var_group.prior_eta.copy()
+            var_group.belief_lam = var_group.prior_lam.copy()
+        for group in self.factor_groups:
+            for s, d in enumerate(group.variable_dims):
+                var_group = self.variable_groups[d]
+                rows = group.variable_rows[:, s]
+                np.add.at(var_group.belief_eta, rows, group.msg_out_eta[s])
+                np.add.at(var_group.belief_lam, rows, group.msg_out_lam[s])
+
+        for var_group in self.variable_groups.values():
+            lam = var_group.belief_lam
+            # Ensure that matrix is positive-semi-definite
+            lam = (lam + np.transpose(lam, (0, 2, 1))) / 2.
+            lam += np.identity(var_group.dim) * 1e-6
+            var_group.belief_lam = lam
+
+            invertible = positive_definite(lam)
+            if np.any(invertible):
+                var_group.sigma[invertible] = inv_spd(lam[invertible])
+                var_group.mu[invertible] = (var_group.sigma[invertible] @ var_group.belief_eta[invertible][..., None])[
+                    ..., 0]
+
+        # Send message with updated belief to adjacent factors
+        for group in self.factor_groups:
+            for s, d in enumerate(group.variable_dims):
+                var_group = self.variable_groups[d]
+                rows = group.variable_rows[:, s]
+                group.msg_in_eta[s] = var_group.belief_eta[rows] - group.msg_out_eta[s]
+                group.msg_in_lam[s] = var_group.belief_lam[rows] - group.msg_out_lam[s]
+
+    def synchronous_iteration(self):
+        """
+        Triggers a single synchronous iteration over all nodes (factor and variable nodes).
+        The nodes of the factor graph are not updated, call write_back for this.
+        """
+        self.relinearize_factors()
+        self.compute_all_messages()
+        self.update_all_beliefs()
+
+    def belief_means(self) -> np.ndarray:
+        """
+        Computes the means of all beliefs in the order of the variable nodes of the factor graph. Like in
+        FactorGraph.fit, the mean of a belief, which is not positive definite (e.g. a variable without prior before
+        the first iteration), is zero.
+        :return: flat array of all means
+        """
+        means = {}
+        for var_group in self.variable_groups.values():
+            group_means = np.zeros([len(var_group.variable_nodes), var_group.dim])
+            invertible = positive_definite(var_group.belief_lam)
+            if np.any(invertible):
+                group_means[invertible] = solve_spd(var_group.belief_lam[invertible],
+                                                    var_group.belief_eta[invertible][..., None])[..., 0]
+            for v, mean in zip(var_group.variable_nodes, group_means):
+                means[v.idx] = mean
+        return np.concatenate([means[v.idx] for v in self.factor_graph.variable_nodes])
+
+    def current_means(self) -> np.ndarray:
+        """
+        Collects the means computed by the last belief update in the order of the variable nodes of the factor graph
+        :return: flat array of all means
+        """
+        means = {}
+        for var_group in self.variable_groups.values():
+            for v, mean in zip(var_group.variable_nodes, var_group.mu):
+                means[v.idx] = mean
+        return np.concatenate([means[v.idx] for v in self.factor_graph.variable_nodes])
+
+    def snapshot(self, prior: bool = False) -> BeliefSnapshot:
+        """
+        The beliefs of all variables as read only views of the stacked arrays, see FactorGraph.snapshot. The views
+        stay valid, every iteration replaces the arrays instead of modifying them.
+        :param prior: the priors instead of the beliefs
+        :return: snapshot in the order of the variable nodes of the factor graph
+        """
+        if len(self.variable_groups) > 1:
+            raise ValueError("A snapshot needs variable nodes of the same dimensions, got " +
+                             str(sorted(self.variable_groups)))
+        if not self.variable_groups:
+            return BeliefSnapshot(np.zeros([0, 0]), np.zeros([0, 0, 0]))
+        var_group = next(iter(self.variable_groups.values()))
+        if prior:
+            return BeliefSnapshot(_read_only(var_group.prior_eta), _read_only(var_group.prior_lam))
+        return BeliefSnapshot(_read_only(var_group.belief_eta), _read_only(var_group.belief_lam))
+
+    def fit(self, max_iterations: int = 500, tolerance: float = 0.001,
+            variable_tolerance: float = None) -> ConvergenceReport:
+        """
+        Calls synchronous iteration until a convergence criteria is met, see FactorGraph.fit
+        :param max_iterations: maximal number of iterations
+        :param tolerance: converged, if the norm of the change of all means is below
+        :param variable_tolerance: additionally require that the mean of every single variable changed less
+        :return: convergence report
+        """
+        report = ConvergenceReport()
+        variable_nodes = self.factor_graph.variable_nodes
+        sizes = [v.dimensions for v in variable_nodes]
+        previous_means = self.belief_means()
+        for i in range(max_iterations):
+            self.synchronous_iteration()
+            posterior_means = self.current_means()
+            report.add_iteration(variable_nodes, sizes, posterior_means - previous_means, tolerance,
+                                 variable_tolerance)
+            previous_means = posterior_means
+            if report.converged:
+                break
+        self.write_back()
+        return report
+
+    def write_back(self):
+        """
+        Writes the current state of the stacked arrays back into the nodes of the factor graph
+        """
+        for var_group in self.variable_groups.values():
+            for row, v in enumerate(var_group.variable_nodes):
+                v.belief.eta = var_group.belief_eta[row].copy()
+                v.belief.lam = var_group.belief_lam[row].copy()
+                v.mu = var_group.mu[row].copy()
+                v.sigma = var_group.sigma[row].copy()
+
+        for group in self.factor_groups:
+            for row, f in enumerate(group.factor_nodes):
+                f.factor_eta = group.factor_eta[row].copy()
+                f.factor_lam = group.factor_lam[row].copy()
+                f.damping = group.damping[row]
+                f.message_change = group.message_change[row]
+                f.num_sent_messages = group.num_sent_messages[row]
+                f.linearization_point = [group.linearization_point[s][row].copy() for s in range(group.arity)]
+                for s, message in enumerate(f.messages_to_adj_variables):
+                    f.receive_message_from(s, group.msg_in_eta[s][row], group.msg_in_lam[s][row])
+                    message.set(group.msg_out_eta[s][row], group.msg_out_lam[s][row])
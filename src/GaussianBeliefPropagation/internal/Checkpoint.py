@@ -0,0 +1,351 @@
+import os
+from math import prod
+from typing import List, Dict, Tuple, Callable, Any
+import numpy as np
+
+from GBP import GaussianState, VariableNode, FactorNode, FactorGraph, EdgeTable, factor_layout, prior_factor, \
+    prior_factor_jac
+from RobustKernels import HuberKernel, CauchyKernel, TukeyKernel
+import ContourFactors
+
+# The checkpoint is columnar: every column is a flat array over all nodes (or edges), the state of the i-th node is
+# found with offsets computed from the stored sizes. Loading only creates the node objects, their arrays are views
+# into the columns (and the messages views into the message buffers of the edge table), so nothing is recomputed.
+
+FORMAT_VERSION = 1
+
+# name -> (measurement function, jacobian function), callables can't be saved
+FACTOR_TYPES: Dict[str, Tuple[Callable, Callable]] = {}
+VARIABLE_TYPES: Dict[str, type] = {"VariableNode": VariableNode}
+KERNEL_TYPES: Dict[str, type] = {}
+
+ARG_KINDS = (np.float64, np.int64, np.bool_)
+SCALARS = ("linear", "constant_jacobian", "huber_energy", "adaptive_damping", "num_sent_messages",
+           "relinearization_threshold", "huber_mahalanobis_threshold", "base_damping", "damping", "message_change")
+
+
+def register_factor_type(name: str, measurement_fn: Callable, jacobian_fn: Callable):
+    """
+    Registers the functions of a kind of factor, only factors of registered kinds can be saved
+    :param name: unique name of the kind, stored in the checkpoint
+    :param measurement_fn: measurement function of the factors
+    :param jacobian_fn: jacobian of the measurement function
+    """
+    FACTOR_TYPES[name] = (measurement_fn, jacobian_fn)
+
+
+def register_variable_type(variable_type: type):
+    """
+    Registers a subclass of VariableNode. Its additional slots have to hold numbers.
+    """
+    VARIABLE_TYPES[variable_type.__name__] = variable_type
+
+
+def register_kernel_type(kernel_type: type):
+    """
+    Registers a subclass of RobustKernel, which is restored from its threshold alone
+    """
+    KERNEL_TYPES[kernel_type.__name__] = kernel_type
+
+
+register_factor_type("prior", prior_factor, prior_factor_jac)
+register_factor_type("transition", ContourFactors.transition_factor, ContourFactors.transition_factor_jac)
+register_factor_type("distance", ContourFactors.distance_measurement_factor,
+                     ContourFactors.distance_measurement_factor_jac)
+register_factor_type("smoothing_2d", ContourFactors.smoothing_factor, ContourFactors.smoothing_factor_jac)
+register_factor_type("point_measurement", ContourFactors.measurement_factor, ContourFactors.measurement_factor_jac)
+register_factor_type("line_measurement", ContourFactors.line_measurement_factor,
+                     ContourFactors.line_measurement_factor_jac)
+register_factor_type("line_collapse", ContourFactors.line_collapse_factor, ContourFactors.line_collapse_factor_jac)
+for kernel_type in (HuberKernel, CauchyKernel, TukeyKernel):
+    register_kernel_type(kernel_type)
+
+
+def _extra_slots(variable_type: type) -> List[str]:
+    return [slot for cls in variable_type.__mro__[:-1] if cls is not VariableNode and issubclass(cls, VariableNode)
+            for slot in cls.__dict__.get("__slots__", ())]
+
+
+def _codes(values: List[Any]) -> Tuple[np.ndarray, List[Any]]:
+    """
+    :return: code of each value and the distinct values (in order of first occurrence)
+    """
+    distinct = list(dict.fromkeys(values))
+    code_of = {value: code for code, value in enumerate(distinct)}
+    return np.array([code_of[value] for value in values], dtype=np.int64), distinct
+
+
+def _flat(arrays: List[np.ndarray]) -> np.ndarray:
+    return np.concatenate([np.ravel(array) for array in arrays]) if arrays else np.zeros(0)
+
+
+def _offsets(sizes: np.ndarray) -> List[int]:
+    return np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64).tolist()
+
+
+# ---------------------------------- Save ------------------------------------
+def graph_columns(factor_graph: FactorGraph) -> Dict[str, np.ndarray]:
+    """
+    Converts the state of a factor graph into columns
+    :raises ValueError: for nodes, which can't be saved (unregistered types, non numeric factor args)
+    """
+    variable_nodes, factor_nodes = factor_graph.variable_nodes, factor_graph.factor_nodes
+    columns = {"format_version": np.array(FORMAT_VERSION)}
+
+    # Variables
+    for v in variable_nodes:
+        if VARIABLE_TYPES.get(type(v).__name__) is not type(v):
+            raise ValueError("Variable type " + type(v).__name__ + " is not registered, see register_variable_type")
+    columns["variable_type"], variable_types = _codes([type(v) for v in variable_nodes])
+    columns["variable_type_names"] = np.array([t.__name__ for t in variable_types], dtype=str)
+    columns["variable_dims"] = np.array([v.dimensions for v in variable_nodes], dtype=np.int64)
+    for name, arrays in (("prior_eta", [v.prior.eta for v in variable_nodes]),
+                         ("prior_lam", [v.prior.lam for v in variable_nodes]),
+                         ("belief_eta", [v.belief.eta for v in variable_nodes]),
+                         ("belief_lam", [v.belief.lam for v in variable_nodes]),
+                         ("mu", [v.mu for v in variable_nodes]),
+                         ("sigma", [v.sigma for v in variable_nodes])):
+        columns[name] = _flat(arrays)
+    for slot in {slot for t in variable_types for slot in _extra_slots(t)}:
+        columns["variable_slot_" + slot] = np.array([float(getattr(v, slot, np.nan)) for v in variable_nodes])
+
+    # Factors
+    function_names = {functions: name for name, functions in FACTOR_TYPES.items()}
+    names = []
+    for f in factor_nodes:
+        name = function_names.get((f.measurement_fn, f.jacobian_fn))
+        if name is None:
+            raise ValueError("Factor functions " + f.measurement_fn.__name__ + " are not registered, see "
+                             "register_factor_type")
+        names.append(name)
+    columns["factor_type"], factor_types = _codes(names)
+    columns["factor_type_names"] = np.array(factor_types, dtype=str)
+    columns["factor_arity"] = np.array([len(f.adj_variable_nodes) for f in factor_nodes], dtype=np.int64)
+    columns["edge_variable"] = np.array([v.idx for f in factor_nodes for v in f.adj_variable_nodes], dtype=np.int64)
+    # position of the factor within the adjacent factors of the variable, keeps the order of the belief update
+    columns["edge_position"] = np.array([next(k for k, g in enumerate(v.adj_factors) if g is f)
+                                         for f in factor_nodes for v in f.adj_variable_nodes], dtype=np.int64)
+    columns["measurement_size"] = np.array([f.measurement.size for f in factor_nodes], dtype=np.int64)
+    columns["measurement"] = _flat([f.measurement for f in factor_nodes])
+    columns["noise_dim"] = np.array([f.measurement_noise.shape[0] for f in factor_nodes], dtype=np.int64)
+    for name in ("measurement_noise", "measurement_noise_lam", "noise_whitening", "adaptive_measurement_noise_lam",
+                 "factor_eta", "factor_lam"):
+        columns[name] = _flat([getattr(f, name) for f in factor_nodes])
+    columns["linearization_point"] = _flat([_flat(f.linearization_point) for f in factor_nodes])
+    jacobians = [f.jacobian for f in factor_nodes]
+    columns["jacobian_rows"] = np.array([0 if j is None else j.shape[0] for j in jacobians], dtype=np.int64)
+    columns["jacobian"] = _flat([j for j in jacobians if j is not None])
+    for name, dtype in zip(SCALARS, (bool, bool, bool, bool, np.int64, float, float, float, float, float)):
+        columns[name] = np.array([getattr(f, name) for f in factor_nodes], dtype=dtype)
+    kernels = [f.robust_kernel for f in factor_nodes]
+    for k in kernels:
+        if k is not None and KERNEL_TYPES.get(type(k).__name__) is not type(k):
+            raise ValueError("Robust kernel " + type(k).__name__ + " is not registered, see register_kernel_type")
+    columns["robust_kernel"], kernel_types = _codes([type(k).__name__ if k is not None else "" for k in kernels])
+    columns["robust_kernel_names"] = np.array(kernel_types, dtype=str)
+    columns["robust_threshold"] = np.array([k.threshold if k is not None else np.nan for k in kernels])
+
+    # Factor args, each arg is stored as flat array with its kind and shape
+    args = [np.asarray(arg) for f in factor_nodes for arg in f.args]
+    kinds = []
+    for arg in args:
+        kind = next((k for k, t in enumerate(ARG_KINDS) if np.issubdtype(arg.dtype, t)), None)
+        if kind is None:
+            raise ValueError("Factor args have to be numeric, got " + str(arg.dtype))
+        kinds.append(kind)
+    columns["factor_num_args"] = np.array([len(f.args) for f in factor_nodes], dtype=np.int64)
+    columns["arg_kind"] = np.array(kinds, dtype=np.int64)
+    columns["arg_ndim"] = np.array([arg.ndim for arg in args], dtype=np.int64)
+    columns["arg_shape"] = np.array([n for arg in args for n in arg.shape], dtype=np.int64)
+    columns["arg_data"] = _flat([arg.astype(np.float64) for arg in args])
+
+    # Messages in the order of the edges
+    messages = [(to_factor, to_variable) for f in factor_nodes
+                for to_factor, to_variable in zip(f.adj_variable_messages, f.messages_to_adj_variables)]
+    columns["to_factor_eta"] = _flat([to_factor.eta for to_factor, _ in messages])
+    columns["to_factor_lam"] = _flat([to_factor.lam for to_factor, _ in messages])
+    columns["to_variable_eta"] = _flat([to_variable.eta for _, to_variable in messages])
+    columns["to_variable_lam"] = _flat([to_variable.lam for _, to_variable in messages])
+    return columns
+
+
+def save_checkpoint(factor_graph: FactorGraph, path: str):
+    """
+    Writes the state of a factor graph: variable beliefs and priors, factor types, args, linearization and messages.
+    Runtime objects (threads, accelerator, tracer) are not saved.
+    :param path: a .npz file or a directory, which gets one .npy file per column (can be memory-mapped on load)
+    """
+    columns = graph_columns(factor_graph)
+    if path.endswith(".npz"):
+        np.savez(path, **columns)
+        return
+    os.makedirs(path, exist_ok=True)
+    for name, column in columns.items():
+        np.save(os.path.join(path, name + ".npy"), column)
+
+
+# ---------------------------------- Load ------------------------------------
+def read_columns(path: str, mmap: bool = False) -> Dict[str, np.ndarray]:
+    """
+    :param mmap: memory-map the columns of a directory checkpoint copy on write (changes are never written back)
+    """
+    if path.endswith(".npz"):
+        with np.load(path) as data:
+            return {name: data[name] for name in data.files}
+    return {name[:-4]: np.asarray(np.load(os.path.join(path, name), mmap_mode="c" if mmap else None))
+            for name in os.listdir(path) if name.endswith(".npy")}
+
+
+def _blocks(flat: np.ndarray, shapes: List[Tuple[int, ...]]) -> List[np.ndarray]:
+    """
+    Splits a column into consecutive blocks of the given shapes, all blocks are views into the column
+    """
+    if len(set(shapes)) == 1:  # one reshape instead of a slice per block
+        size = prod(shapes[0])
+        return list(flat[:len(shapes) * size].reshape((len(shapes),) + shapes[0]))
+    offsets = _offsets([prod(shape) for shape in shapes])
+    return [flat[start:end].reshape(shape) for start, end, shape in zip(offsets[:-1], offsets[1:], shapes)]
+
+
+def _resolve(registry: Dict[str, Any], names: np.ndarray, register: str) -> List[Any]:
+    missing = [name for name in names.tolist() if name not in registry]
+    if missing:
+        raise ValueError("Types " + str(missing) + " of the checkpoint are not registered, see " + register +
+                         " (import the module defining them)")
+    return [registry[name] for name in names.tolist()]
+
+
+def _restore_variables(columns: Dict[str, np.ndarray]) -> List[VariableNode]:
+    types = _resolve(VARIABLE_TYPES, columns["variable_type_names"], "register_variable_type")
+    dims = columns["variable_dims"].tolist()
+    vectors = [(d,) for d in dims]
+    matrices = [(d, d) for d in dims]
+    prior_eta, prior_lam = _blocks(columns["prior_eta"], vectors), _blocks(columns["prior_lam"], matrices)
+    belief_eta, belief_lam = _blocks(columns["belief_eta"], vectors), _blocks(columns["belief_lam"], matrices)
+    mu, sigma = _blocks(columns["mu"], vectors), _blocks(columns["sigma"], matrices)
+    slots = {name[len("variable_slot_"):]: column.tolist() for name, column in columns.items()
+             if name.startswith("variable_slot_")}
+    extra_slots = [_extra_slots(t) for t in types]
+    variable_nodes = []
+    for i, (code, d) in enumerate(zip(columns["variable_type"].tolist(), dims)):
+        v = types[code].__new__(types[code])
+        v.idx = None
+        v.dimensions = d
+        v.prior = GaussianState.__new__(GaussianState)
+        v.prior.dim, v.prior.eta, v.prior.lam = d, prior_eta[i], prior_lam[i]
+        v.belief = GaussianState.__new__(GaussianState)
+        v.belief.dim, v.belief.eta, v.belief.lam = d, belief_eta[i], belief_lam[i]
+        v.mu, v.sigma = mu[i], sigma[i]
+        v.adj_factors, v.messages_from_factors, v.messages_to_factors = [], [], []
+        for slot in extra_slots[code]:
+            setattr(v, slot, slots[slot][i])
+        variable_nodes.append(v)
+    return variable_nodes
+
+
+def _restore_args(columns: Dict[str, np.ndarray]) -> List[list]:
+    """
+    Converts the args back, one vectorized conversion per kind and shape of arg
+    """
+    dims = columns["arg_shape"].tolist()
+    shape_offsets = _offsets(columns["arg_ndim"])
+    shapes = [tuple(dims[start:end]) for start, end in zip(shape_offsets[:-1], shape_offsets[1:])]
+    data_offsets = np.array(_offsets([prod(shape) for shape in shapes])[:-1], dtype=np.int64)
+    kinds = columns["arg_kind"].tolist()
+    groups: Dict[Tuple[int, Tuple[int, ...]], List[int]] = {}
+    for i, key in enumerate(zip(kinds, shapes)):
+        groups.setdefault(key, []).append(i)
+    args = [None] * len(shapes)
+    for (kind, shape), idxs in groups.items():
+        size = prod(shape)
+        values = columns["arg_data"][data_offsets[idxs][:, None] + np.arange(size)].astype(ARG_KINDS[kind])
+        values = values.reshape(len(idxs)).tolist() if shape == () else list(values.reshape((len(idxs),) + shape))
+        for i, value in zip(idxs, values):  # scalars are python numbers again
+            args[i] = value
+    per_factor = _offsets(columns["factor_num_args"])
+    return [args[start:end] for start, end in zip(per_factor[:-1], per_factor[1:])]
+
+
+def _restore_factors(columns: Dict[str, np.ndarray], variable_nodes: List[VariableNode]) -> List[FactorNode]:
+    functions = _resolve(FACTOR_TYPES, columns["factor_type_names"], "register_factor_type")
+    kernels = _resolve({"": None, **KERNEL_TYPES}, columns["robust_kernel_names"], "register_kernel_type")
+    edge_offsets = _offsets(columns["factor_arity"])
+    edge_variable = columns["edge_variable"].tolist()
+    adj_variables = [[variable_nodes[idx] for idx in edge_variable[start:end]]
+                     for start, end in zip(edge_offsets[:-1], edge_offsets[1:])]
+    layouts = [tuple(v.dimensions for v in adj_vars) for adj_vars in adj_variables]
+    factor_dims = [sum(layout) for layout in layouts]
+    noise_shapes = [(m, m) for m in columns["noise_dim"].tolist()]
+    blocks = {name: _blocks(columns[name], noise_shapes) for name in
+              ("measurement_noise", "measurement_noise_lam", "noise_whitening", "adaptive_measurement_noise_lam")}
+    measurements = _blocks(columns["measurement"], [(size,) for size in columns["measurement_size"].tolist()])
+    factor_eta = _blocks(columns["factor_eta"], [(D,) for D in factor_dims])
+    factor_lam = _blocks(columns["factor_lam"], [(D, D) for D in factor_dims])
+    points = _blocks(columns["linearization_point"], [(D,) for D in factor_dims])
+    jacobian_rows = columns["jacobian_rows"].tolist()
+    jacobians = _blocks(columns["jacobian"], [(rows, D) for rows, D in zip(jacobian_rows, factor_dims) if rows > 0])
+    jacobians.reverse()  # popped in the order of the factors
+    scalars = [columns[name].tolist() for name in SCALARS]
+    robust_threshold = columns["robust_threshold"].tolist()
+    args = _restore_args(columns)
+
+    factor_nodes = []
+    for i, (type_code, kernel_code) in enumerate(zip(columns["factor_type"].tolist(),
+                                                     columns["robust_kernel"].tolist())):
+        f = FactorNode.__new__(FactorNode)
+        f.idx = None
+        f.adj_variable_nodes = adj_variables[i]
+        f.measurement_fn, f.jacobian_fn = functions[type_code]
+        f.args = args[i]
+        f.measurement = measurements[i]
+        f.measurement_noise = blocks["measurement_noise"][i]
+        f.measurement_noise_lam = blocks["measurement_noise_lam"][i]
+        f.noise_whitening = blocks["noise_whitening"][i]
+        f.adaptive_measurement_noise_lam = blocks["adaptive_measurement_noise_lam"][i]
+        kernel = kernels[kernel_code]
+        f.robust_kernel = kernel(robust_threshold[i]) if kernel is not None else None
+        (f.linear, f.constant_jacobian, f.huber_energy, f.adaptive_damping, f.num_sent_messages,
+         f.relinearization_threshold, f.huber_mahalanobis_threshold, f.base_damping, f.damping,
+         f.message_change) = (column[i] for column in scalars)
+        f.variable_slices, f.marginalization_indices = factor_layout(layouts[i])
+        f.number_of_conditional_variables = factor_dims[i]
+        f.factor_eta, f.factor_lam = factor_eta[i], factor_lam[i]
+        f.linearization_point = [points[i][s] for s in f.variable_slices]
+        f.jacobian = jacobians.pop() if jacobian_rows[i] > 0 else None
+        f.predicted_measurement, f.prediction_point = None, None
+        factor_nodes.append(f)
+    return factor_nodes
+
+
+def load_checkpoint(path: str, mmap: bool = False, **kwargs) -> FactorGraph:
+    """
+    Restores a factor graph saved by save_checkpoint. The arrays of the nodes are views into the loaded columns.
+    The modules defining the factor and variable types of the graph have to be imported (registered) before.
+    :param path: a .npz file or a directory of .npy files
+    :param mmap: memory-map the columns of a directory checkpoint (copy on write) instead of reading them
+    :param kwargs: runtime arguments of the FactorGraph (num_threads, chunk_size, accelerator, tracer)
+    :return: the factor graph
+    """
+    columns = read_columns(path, mmap)
+    if int(columns["format_version"]) != FORMAT_VERSION:
+        raise ValueError("Unsupported checkpoint version " + str(int(columns["format_version"])))
+    variable_nodes = _restore_variables(columns)
+    factor_nodes = _restore_factors(columns, variable_nodes)
+    for idx, v in enumerate(variable_nodes):
+        v.idx = idx
+    for idx, f in enumerate(factor_nodes):
+        f.idx = idx
+    edges = EdgeTable.from_buffers(factor_nodes, columns["to_factor_eta"], columns["to_factor_lam"],
+                                   columns["to_variable_eta"], columns["to_variable_lam"])
+
+    # Bind the factors to their variables in the saved order of the adjacent factors
+    messages = [(f, to_factor, to_variable) for f in factor_nodes
+                for to_factor, to_variable in zip(f.adj_variable_messages, f.messages_to_adj_variables)]
+    edge_variable = columns["edge_variable"].tolist()
+    for edge in np.lexsort((columns["edge_position"], columns["edge_variable"])).tolist():
+        f, to_factor, to_variable = messages[edge]
+        v = variable_nodes[edge_variable[edge]]
+        v.adj_factors.append(f)
+        v.messages_from_factors.append(to_variable)
+        v.messages_to_factors.append(to_factor)
+    return FactorGraph(variable_nodes, factor_nodes, edges=edges, **kwargs)
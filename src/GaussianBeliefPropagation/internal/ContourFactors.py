@@ -4,33 +4,47 @@ from typing import List
 from numpy import ndarray
 
 
-def distance_measurement_factor(means: List[np.matrix], target_distance) -> np.matrix:
+def transition_factor(means: List[ndarray]) -> ndarray:
+    # the node of the next frame stays at the position of its node in the previous frame (plus transition noise)
+    previous, current = means
+    return current - previous
+
+
+def transition_factor_jac(means: List[ndarray]) -> ndarray:
+    identity = np.identity(means[0].shape[0])
+    return np.hstack([-identity, identity])
+
+
+# -------------------------------------------------------------------------------
+
+
+def distance_measurement_factor(means: List[ndarray], target_distance) -> ndarray:
     a = means[0]
     b = means[1]
-    return target_distance - np.linalg.norm(a - b)
+    return np.array([target_distance - np.linalg.norm(a - b)])
 
 
-def distance_measurement_factor_jac(means: List[np.matrix], target_distance) -> np.matrix:
+def distance_measurement_factor_jac(means: List[ndarray], target_distance) -> ndarray:
     a = means[0]
     b = means[1]
     a_to_b = b - a
     a_to_b_length = np.linalg.norm(a_to_b)
 
-    return np.matrix(np.resize(np.concatenate([-(a - b) / a_to_b_length, (a - b) / a_to_b_length]), (1, a.size * 2)))
+    return np.concatenate([-(a - b) / a_to_b_length, (a - b) / a_to_b_length]).reshape(1, a.size * 2)
 
 
 # -------------------------------------------------------------------------------
 
-def smoothing_factor(means: List[np.matrix]) -> np.matrix:
+def smoothing_factor(means: List[ndarray]) -> ndarray:
     # distance point to line
     a, b, c = means
     c_a = c - a
     center = a + c_a * 0.5
     distance = np.linalg.norm(center - b)
-    return np.matrix(distance)
+    return np.array([distance])
 
 
-def smoothing_factor_jac(means: List[np.matrix]) -> np.matrix:
+def smoothing_factor_jac(means: List[ndarray]) -> ndarray:
     # wolfram alpha : jacobian of (||a+(c-a)*0.5-b||)
     a, b, c = means
     c_a = c - a
@@ -43,19 +57,19 @@ def smoothing_factor_jac(means: List[np.matrix]) -> np.matrix:
     a_derivative = unit_direction_vector * 0.5
     b_derivative = unit_direction_vector * -1
     c_derivative = unit_direction_vector * 0.5
-    return np.matrix(
-        np.resize(np.array([np.zeros_like(a_derivative), b_derivative, np.zeros_like(c_derivative)]), (1, a.size * 3)))
+    return np.concatenate([np.zeros_like(a_derivative), b_derivative, np.zeros_like(c_derivative)]).reshape(
+        1, a.size * 3)
 
 
 # -------------------------------------------------------------------------------
 
-def measurement_factor(means: List[np.matrix], measurement_point) -> np.matrix:
+def measurement_factor(means: List[ndarray], measurement_point) -> ndarray:
     distances = []
     sum_inv_dist = 0
     for p in means:
         dist = np.linalg.norm(measurement_point - p)
         # dist = np.asscalar(np.sqrt(
-        #    (measurement_point - p) @ np.linalg.inv(np.matrix([[0.001, 0], [0, 0.001]])) @ (measurement_point - p).T))
+        #    (measurement_point - p) @ np.linalg.inv(np.array([[0.001, 0], [0, 0.001]])) @ (measurement_point - p)))
         dist = dist ** 4
         distances.append(dist)
         sum_inv_dist += 1. / dist
@@ -67,10 +81,10 @@ def measurement_factor(means: List[np.matrix], measurement_point) -> np.matrix:
         direction = measurement_point - mean
         w = (1 / (dist * sum_inv_dist))
         measurement.append(direction * w)
-    return -np.matrix(np.array(measurement)).flatten()
+    return -np.concatenate(measurement)
 
 
-def measurement_factor_jac(means: List[np.matrix], measurement_point) -> ndarray:
+def measurement_factor_jac(means: List[ndarray], measurement_point) -> ndarray:
     distances = []
     sum_dist = 0
     for p in means:
@@ -90,7 +104,7 @@ def measurement_factor_jac(means: List[np.matrix], measurement_point) -> ndarray
 # -------------------------------------------------------------------------------
 
 
-def line_measurement_factor(means: List[np.matrix], measurement_point, end_points) -> np.matrix:
+def line_measurement_factor(means: List[ndarray], measurement_point, end_points) -> ndarray:
     best_measurement = None
     diff = np.finfo(float).max
     for i in range(len(means) - 1):
@@ -98,7 +112,7 @@ def line_measurement_factor(means: List[np.matrix], measurement_point, end_point
         ab = b - a
         ab_length = np.linalg.norm(ab)
         m = measurement_point - a
-        projection_point = ((ab.T @ ab) / (ab @ ab.T) @ m.T + a.T).T
+        projection_point = np.outer(ab, ab) / (ab @ ab) @ m + a
         if np.linalg.norm(projection_point - a + ab) < ab_length:
             # projection behind a
             measurement = [(measurement_point - a), np.zeros_like(m)]
@@ -130,21 +144,60 @@ def line_measurement_factor(means: List[np.matrix], measurement_point, end_point
                 measurement.append(np.zeros_like(m))
             else:
                 measurement.insert(0, np.zeros_like(m))
-        measurement = np.matrix(np.array(measurement)).flatten()
+        measurement = np.concatenate(measurement)
         d = np.linalg.norm(reference_point - measurement_point)
         if diff > d:
             diff = d
             best_measurement = measurement
-    return -np.matrix(best_measurement).flatten()
+    return -best_measurement
 
 
-def line_measurement_factor_jac(means: List[np.matrix], measurement_point, end_points) -> np.matrix:
+def line_measurement_factor_jac(means: List[ndarray], measurement_point, end_points) -> ndarray:
     return np.identity(len(means) * 2)
 
 
+def line_measurement_factors(means: ndarray, measurement_points: ndarray, end_points: ndarray) -> ndarray:
+    """
+    Batched line_measurement_factor of M factors with K adjacent nodes each, all segments are evaluated at once
+    :param means: (M, K, 2) means of the adjacent nodes
+    :param measurement_points: (M, 2) measurements
+    :param end_points: (M, >=K) which adjacent nodes are end points of the contour
+    :return: (M, 2K) measurement of every factor, equal to line_measurement_factor
+    """
+    num_factors, num_means = means.shape[:2]
+    a, b = means[:, :-1], means[:, 1:]  # (M, S, 2) segments
+    points = measurement_points[:, None]
+    ab = b - a
+    ab_length = np.linalg.norm(ab, axis=-1)
+    projection_point = ab * (np.einsum("msd,msd->ms", ab, points - a) / np.einsum("msd,msd->ms", ab, ab))[..., None] + a
+    behind_a = np.linalg.norm(projection_point - a + ab, axis=-1) < ab_length
+    behind_b = ~behind_a & (np.linalg.norm(projection_point - b - ab, axis=-1) < ab_length)
+    on_segment = ~(behind_a | behind_b)
+
+    # projection on ab, with the shrink at the end points
+    projection_vector = points - projection_point
+    lam = (np.linalg.norm(projection_point - a, axis=-1) / ab_length)[..., None]
+    expected_points_on_line = (ab_length * 20)[..., None]  # expected point density of 20, see line_measurement_factor
+    a_vec = np.where(end_points[:, :num_means - 1, None], (projection_point - a) * (1 - lam) / expected_points_on_line,
+                     0.)
+    b_vec = np.where(end_points[:, 1:num_means, None], (projection_point - b) * lam / expected_points_on_line, 0.)
+    first = np.where(on_segment[..., None], (1 - lam) * projection_vector + a_vec, 0.)
+    second = np.where(on_segment[..., None], lam * projection_vector + b_vec, 0.)
+    first = np.where(behind_a[..., None], points - a, first)
+    second = np.where(behind_b[..., None], points - b, second)
+
+    reference_point = np.where(behind_a[..., None], a, np.where(behind_b[..., None], b, projection_point))
+    best = np.argmin(np.linalg.norm(reference_point - points, axis=-1), axis=1)
+    rows = np.arange(num_factors)
+    measurement = np.zeros_like(means)
+    measurement[rows, best] = first[rows, best]
+    measurement[rows, best + 1] = second[rows, best]
+    return -measurement.reshape(num_factors, 2 * num_means)
+
+
 # -------------------------------------------------------------------------------
 
-def line_collapse_factor(means: List[np.matrix], measurements) -> np.matrix:
+def line_collapse_factor(means: List[ndarray], measurements) -> ndarray:
     a, b = means
     dist_to_a = [np.linalg.norm(a - m) for m in measurements]
     dist_to_b = [np.linalg.norm(b - m) for m in measurements]
@@ -156,13 +209,13 @@ def line_collapse_factor(means: List[np.matrix], measurements) -> np.matrix:
 
     ab = b - a
     m = m_a - a
-    projection_point_a = ((ab.T @ ab) / (ab @ ab.T) @ m.T + a.T).T
+    projection_point_a = np.outer(ab, ab) / (ab @ ab) @ m + a
 
     m = m_b - a
-    projection_point_b = ((ab.T @ ab) / (ab @ ab.T) @ m.T + a.T).T
+    projection_point_b = np.outer(ab, ab) / (ab @ ab) @ m + a
 
-    return -np.matrix(np.array([projection_point_a - a, projection_point_b - b])).flatten()
+    return -np.concatenate([projection_point_a - a, projection_point_b - b])
 
 
-def line_collapse_factor_jac(means: List[np.matrix], collapse_force) -> np.matrix:
+def line_collapse_factor_jac(means: List[ndarray], collapse_force) -> ndarray:
     return np.identity(len(means) * 2)
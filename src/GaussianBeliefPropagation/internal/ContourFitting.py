@@ -3,6 +3,7 @@ import matplotlib.pyplot as plt
 from matplotlib.animation import FuncAnimation
 
 from GBP import *
+from Checkpoint import register_factor_type, register_variable_type
 np.random.seed(44)
 
 
@@ -65,15 +66,23 @@ class ContourFittingViz:
         iterations_cov = []
 
         for v in v_nodes:
-            y_positions.append(np.asscalar(v.mu))
-            iterations_cov.append(np.asscalar(v.sigma))
-            self.iterations_lam[v.idx].append(np.asscalar(v.belief.lam))
+            y_positions.append(v.mu[0])
+            iterations_cov.append(v.sigma[0, 0])
+            self.iterations_lam[v.idx].append(v.belief.lam[0, 0])
 
         self.iterations.append(y_positions)
         self.iterations_cov.append(iterations_cov)
 
 
 # ---------------------- FACTOR GRAPH SPECIFIC STUFF ----------------------------
+class PositionedVariableNode(VariableNode):
+    __doc__ = "Variable node holding the height of the contour at a fixed x position"
+    __slots__ = ("x_pos",)
+
+
+register_variable_type(PositionedVariableNode)
+
+
 def generate_variable_nodes(num_variable_nodes: int, dims) -> List[VariableNode]:
     """
     Generates variable nodes with an x pos uniform over the interval [0,1]
@@ -83,7 +92,7 @@ def generate_variable_nodes(num_variable_nodes: int, dims) -> List[VariableNode]
     """
     nodes = []
     for i in range(num_variable_nodes):
-        node = VariableNode(dims)
+        node = PositionedVariableNode(dims)
         node.x_pos = i / (num_variable_nodes - 1)
         nodes.append(node)
     return nodes
@@ -95,7 +104,7 @@ def smoothing(means: List[np.ndarray]) -> np.ndarray:
     Simple smoothing function, forcing the nodes to hold similar height values
     :param means: height estimates for each adjacent nodes (to the factor
     """
-    return np.matrix(means[0] - means[1])
+    return means[0] - means[1]
 
 
 def smoothing_jac(linearization_point: List[np.ndarray]) -> np.ndarray:
@@ -103,7 +112,7 @@ def smoothing_jac(linearization_point: List[np.ndarray]) -> np.ndarray:
     Jacobian of the smoothing function
     :param linearization_point: point of evaluation (not used as linear)
     """
-    return np.matrix([[1, -1]])
+    return np.array([[1, -1]])
 
 
 def generate_smoothing_factors(v_nodes: List[VariableNode], meas_noise, use_huber: bool) -> List[FactorNode]:
@@ -119,10 +128,13 @@ def generate_smoothing_factors(v_nodes: List[VariableNode], meas_noise, use_hube
         meas_fn = smoothing
         measurement = 0.
         jac_fn = smoothing_jac
-        f_nodes.append(FactorNode(adj_vars, meas_fn, meas_noise, measurement, jac_fn, use_huber, []))
+        f_nodes.append(FactorNode(adj_vars, meas_fn, meas_noise, measurement, jac_fn, use_huber, [], linear=True))
     return f_nodes
 
 
+register_factor_type("smoothing", smoothing, smoothing_jac)
+
+
 def measurement_fn(means: List[np.ndarray], x_pos_i: float, x_pos_j: float, x_pos_of_measurement: float) -> np.ndarray:
     """
     Simple measurement function which divides the measurement between two factors
@@ -138,7 +150,7 @@ def measurement_fn(means: List[np.ndarray], x_pos_i: float, x_pos_j: float, x_po
     y_i = means[0]
     y_j = means[1]
     lam = (x_m - x_i) / (x_j - x_i)
-    return np.matrix((1 - lam) * y_i + lam * y_j)
+    return (1 - lam) * y_i + lam * y_j
 
 
 def measurement_fn_jac(means: List[np.ndarray], x_pos_i: float, x_pos_j: float,
@@ -155,7 +167,10 @@ def measurement_fn_jac(means: List[np.ndarray], x_pos_i: float, x_pos_j: float,
     x_i = x_pos_i
     x_j = x_pos_j
     gamma = (x_m - x_i) / (x_j - x_i)
-    return np.matrix([[(1 - gamma), gamma]])
+    return np.array([[(1 - gamma), gamma]])
+
+
+register_factor_type("interpolated_height", measurement_fn, measurement_fn_jac)
 
 
 def generate_measurement_factors(v_nodes: List[VariableNode], measurement_generator,
@@ -179,7 +194,8 @@ def generate_measurement_factors(v_nodes: List[VariableNode], measurement_genera
         meas_fn = measurement_fn
         jac_fn = measurement_fn_jac
         f_nodes.append(FactorNode(adj_vars, meas_fn, meas_noise, height_measurement, jac_fn, use_huber,
-                                  [v_nodes[idx_var_node].x_pos, v_nodes[idx_var_node + 1].x_pos, measurement_x_pos]))
+                                  [v_nodes[idx_var_node].x_pos, v_nodes[idx_var_node + 1].x_pos, measurement_x_pos],
+                                  linear=True))
         gen_meas.append(np.array([measurement_x_pos, height_measurement]))
 
     return f_nodes, gen_meas
@@ -0,0 +1,83 @@
+from typing import List, Dict, Any
+import numpy as np
+import matplotlib.pyplot as plt
+from matplotlib.animation import FuncAnimation, FFMpegWriter
+
+from GBP import FactorGraph, BeliefSnapshot
+from Recording import ChunkedRecorder, read_recording, count_snapshots
+from ContourTracking import draw_state, shown_prior
+
+
+def contour_snapshot_moments(snapshot: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Converts a snapshot of the ContourRecorder (references to the canonical states) into the stored moment form,
+    runs on the writer thread
+    """
+    belief = BeliefSnapshot(np.array(snapshot["belief_eta"], dtype=float).reshape(-1, 2),
+                            np.array(snapshot["belief_lam"], dtype=float).reshape(-1, 2, 2))
+    prior = shown_prior(BeliefSnapshot(np.array(snapshot["prior_eta"], dtype=float).reshape(-1, 2),
+                                       np.array(snapshot["prior_lam"], dtype=float).reshape(-1, 2, 2)), belief)
+    return {"measurement_idx": snapshot["measurement_idx"], "iterations": snapshot["iterations"],
+            "measurements": np.array(snapshot["measurements"], dtype=float).reshape(-1, 2),
+            "prior_mu": prior.means, "prior_cov": prior.covariances, "posterior_mu": belief.means,
+            "posterior_cov": belief.covariances}
+
+
+class ContourRecorder:
+    __doc__ = "Replacement of ContourPlottingViz for long runs: records the states into a chunked directory (see " \
+              "Recording) instead of lists in memory, render it with render_recording. On the solver thread only " \
+              "references to the states are taken (their arrays are replaced, never modified), the inversions " \
+              "into moment form run on the writer thread."
+
+    def __init__(self, path: str, chunk_size: int = 64, sample_every: int = 1):
+        """
+        :param path: directory of the recording
+        :param chunk_size: number of states per chunk file
+        :param sample_every: only every n-th state is recorded
+        """
+        self.recorder = ChunkedRecorder(path, chunk_size, sample_every, transform=contour_snapshot_moments)
+        self.state = None
+
+    def save_state(self, factor_graph: FactorGraph, iterations):
+        nodes = factor_graph.variable_nodes
+        self.state = {"iterations": iterations,
+                      "prior_eta": [v.prior.eta for v in nodes], "prior_lam": [v.prior.lam for v in nodes],
+                      "belief_eta": [v.belief.eta for v in nodes], "belief_lam": [v.belief.lam for v in nodes]}
+
+    def save_measurements(self, measurements: List[np.ndarray], measurement_idx: int):
+        """
+        Completes the state saved before (see fit_frame) and hands it over to the writer
+        """
+        self.state.update(measurements=list(measurements), measurement_idx=measurement_idx)
+        self.recorder.record(self.state)
+        self.state = None
+
+    def close(self):
+        self.recorder.close()
+
+
+def render_recording(path: str, output: str = 'animation.mp4', writer=None):
+    """
+    Renders a recording of the ContourRecorder, streaming it chunk by chunk
+    :param writer: animation writer, FFMpeg with 10 fps by default
+    """
+    fig, ax = plt.subplots(1, 1)
+
+    def states():  # every state with the measurement idx of the following one
+        previous = None
+        for state in read_recording(path):
+            if previous is not None:
+                yield previous, state["measurement_idx"]
+            previous = state
+        if previous is not None:
+            yield previous, None
+
+    def animate(item):
+        state, next_measurement_idx = item
+        draw_state(fig, ax, state["measurements"], state["measurement_idx"], state["iterations"], state["prior_mu"],
+                   state["posterior_mu"], state["posterior_cov"], next_measurement_idx)
+
+    ani = FuncAnimation(fig, animate, frames=states, save_count=count_snapshots(path), repeat=False,
+                        cache_frame_data=False)
+    ani.save(output, writer=FFMpegWriter(fps=10) if writer is None else writer)
+    plt.close(fig)
@@ -0,0 +1,659 @@
+from typing import List, Tuple, Dict
+import numpy as np
+import matplotlib.pyplot as plt
+from matplotlib.animation import FuncAnimation, FFMpegWriter
+from matplotlib.patches import Ellipse
+import matplotlib.transforms as transforms
+
+from GBP import GaussianState, VariableNode, FactorNode, FactorGraph, BeliefSnapshot
+from ContourFactors import distance_measurement_factor, distance_measurement_factor_jac, smoothing_factor, \
+    smoothing_factor_jac, measurement_factor, measurement_factor_jac, line_measurement_factor, \
+    line_measurement_factor_jac, line_collapse_factor, line_collapse_factor_jac
+from LinAlgKernels import positive_definite
+from Tracing import span
+from SpatialIndex import NodeIndex
+
+# Fitting of a 2d contour to the measurements of a frame (see fit_frame), configured by GlobalConfig. The script
+# 2dContourFitting runs it frame by frame, MultiContourTracking fits several contours in parallel, FixedLagSmoothing
+# keeps the last frames in one graph and ContourRecording records the states of long runs.
+
+
+class GlobalConfig:
+    num_total_frames = 50
+    num_initial_nodes = 2
+    use_huber = True
+    max_iterations_per_measurement = 500
+    num_threads = 1  # threads used within one iteration of a factor graph
+    relinearization_threshold = 0.  # factors are only relinearized if an adjacent mean moved further
+    damping = 0.  # weight of the previous message in the factor to variable messages
+    adaptive_damping = False  # increase the damping of oscillating factors
+    accelerator = None  # extrapolation of the messages, e.g. Accelerators.AndersonAcceleration()
+    tracer = None  # e.g. Tracing.Tracer(), records the phases of all frames
+    trace_path = "contour_fitting_trace.json"  # chrome trace written at the end of main, if tracing
+    frame_queue_size = 2  # frames waiting for the solver in the pipeline of main
+    frame_policy = "block"  # if the solver falls behind: "block", "drop_oldest", "drop_newest" or "merge"
+    num_contours = 1  # independent contours tracked by main, more than one uses the MultiContourTracker
+    num_contour_workers = None  # worker processes of the MultiContourTracker, None for one per contour
+
+    transition_noise = 0.1
+    fixed_lag = 0  # frames kept in one graph by the FixedLagSmoother, 0 resets the nodes every frame instead
+    record_path = None  # if set, main records the states into this directory (ContourRecorder) instead of memory
+    record_every = 1  # sampling rate of the ContourRecorder
+
+    # Line configs
+    line_factor_huber_distance = 0.05
+    line_factor_robust_kernel = None  # e.g. RobustKernels.CauchyKernel(0.05), replaces the huber energy
+    birth_line_variance = 0.1
+    death_node_sigma = 0.08
+    line_measurement_noise = 0.1
+    line_merge_residual = 0.05
+
+    # Measurement factor configs
+    measurement_num_nearest = 4  # a measurement factor is connected to at most this many nearest nodes
+    measurement_gate = 0.3  # maximum distance of the connected nodes
+    measurement_gate_mahalanobis = False  # gate with the mahalanobis instead of the euclidean distance
+
+
+def confidence_ellipse(center, cov, ax, n_std=3.0, facecolor='none', **kwargs):
+    pearson = cov[0, 1] / np.sqrt(cov[0, 0] * cov[1, 1])
+    # Using a special case to obtain the eigenvalues of this
+    # two-dimensional dataset.
+    ell_radius_x = np.sqrt(1 + pearson)
+    ell_radius_y = np.sqrt(1 - pearson)
+    ellipse = Ellipse((0, 0), width=ell_radius_x * 2, height=ell_radius_y * 2,
+                      facecolor=facecolor, **kwargs)
+
+    # Calculating the standard deviation of x from
+    # the square-root of the variance and multiplying
+    # with the given number of standard deviations.
+    scale_x = np.sqrt(cov[0, 0]) * n_std
+    mean_x = center[0]
+
+    # calculating the standard deviation of y ...
+    scale_y = np.sqrt(cov[1, 1]) * n_std
+    mean_y = center[1]
+
+    transf = transforms.Affine2D() \
+        .rotate_deg(45) \
+        .scale(scale_x, scale_y) \
+        .translate(mean_x, mean_y)
+
+    ellipse.set_transform(transf + ax.transData)
+    return ax.add_patch(ellipse)
+
+
+class ContourPlottingViz:
+    def __init__(self):
+        self.measurement_list = []
+        self.measurement_idx_list = []
+        self.prior_state_mu_list = []
+        self.prior_state_cov_list = []
+        self.posterior_state_mu_list = []
+        self.posterior_state_cov_list = []
+        self.iterations_list = []
+
+    def save_measurements(self, measurements: List[np.ndarray], measurement_idx: int):
+        self.measurement_list.append(list(measurements))
+        self.measurement_idx_list.append(measurement_idx)
+
+    def save_state(self, factor_graph: FactorGraph, iterations):
+        self.iterations_list.append(iterations)
+        belief = factor_graph.snapshot()
+        prior = shown_prior(factor_graph.snapshot(prior=True), belief)
+        self.prior_state_mu_list.append(prior.means)
+        self.prior_state_cov_list.append(prior.covariances)
+        self.posterior_state_mu_list.append(belief.means)
+        self.posterior_state_cov_list.append(belief.covariances)
+
+    def extend(self, other: "ContourPlottingViz"):
+        """
+        Appends all states saved by another visualization, e.g. of a single frame
+        """
+        for name, values in vars(other).items():
+            getattr(self, name).extend(values)
+
+    def render(self):
+        fig, ax = plt.subplots(1, 1)
+
+        def animate(t):
+            next_measurement_idx = None
+            if t + 1 < len(self.measurement_idx_list):
+                next_measurement_idx = self.measurement_idx_list[t + 1]
+            draw_state(fig, ax, self.measurement_list[t], self.measurement_idx_list[t], self.iterations_list[t],
+                       self.prior_state_mu_list[t], self.posterior_state_mu_list[t], self.posterior_state_cov_list[t],
+                       next_measurement_idx)
+
+        ani = FuncAnimation(fig, animate, frames=len(self.prior_state_mu_list), repeat=False)
+        FFwriter = FFMpegWriter(fps=10)
+        ani.save('animation.mp4', writer=FFwriter)
+        plt.show()
+
+
+def draw_state(fig, ax, measurements, measurement_idx: int, iterations: int, prior_mus, posterior_mus,
+               posterior_covs, next_measurement_idx: int = None):
+    """
+    Draws one saved state, the background is white for the last state of a measurement (frame)
+    """
+    fig.patch.set_facecolor('xkcd:orange')
+    if next_measurement_idx is not None and measurement_idx < next_measurement_idx:
+        fig.patch.set_facecolor('xkcd:white')
+
+    ax.clear()
+    ax.set_title("Measurement No: " + str(measurement_idx) + " Iteration: " + str(iterations))
+    ax.set_xlim(0, 2)
+    ax.set_ylim(0, 2)
+    x, y = zip(*measurements)
+    ax.scatter(x, y, alpha=0.5)
+
+    x, y = zip(*prior_mus)
+    ax.plot(x, y, marker="x", color="red", alpha=0.7)
+
+    # for mean, cov in zip(prior_mus, prior_covs):
+    #    confidence_ellipse(mean, cov, ax, 1., edgecolor="red", linestyle=':', alpha=0.5)
+
+    x, y = zip(*posterior_mus)
+    ax.plot(x, y, marker="x", color="purple")
+
+    for mean, cov in zip(posterior_mus, posterior_covs):
+        confidence_ellipse(mean, cov, ax, 1., edgecolor="purple", linestyle=':')
+
+
+def shown_prior(prior: BeliefSnapshot, belief: BeliefSnapshot) -> BeliefSnapshot:
+    """
+    The priors to draw: nodes of the FixedLagSmoother have no prior (the transition factor predicts them), their
+    belief is drawn instead
+    """
+    has_prior = np.asarray(positive_definite(prior.lam), dtype=bool).reshape(len(prior))
+    return BeliefSnapshot(np.where(has_prior[:, None], prior.eta, belief.eta),
+                          np.where(has_prior[:, None, None], prior.lam, belief.lam))
+
+
+# ---------------------------------- Factor Graph ------------------------------------
+def generate_variable_nodes() -> List[VariableNode]:
+    variable_nodes = []
+    for i in range(GlobalConfig.num_initial_nodes):
+        cov_prior = np.array([[1000., 0.], [0., 1000.]])
+        pos_prior = np.array([(i + 1) / (GlobalConfig.num_initial_nodes + 1), 0.2])
+        prior = GaussianState(2)
+        prior.set_values(pos_prior, cov_prior)
+        variable_nodes.append(VariableNode(2, prior))
+    return variable_nodes
+
+
+def generate_distance_factor_nodes(variable_nodes: List[VariableNode], measurement_noise: np.ndarray,
+                                   target_distance: float) -> List[FactorNode]:
+    factor_nodes = []
+    for i in range(len(variable_nodes) - 1):
+        adj_vars = [variable_nodes[i], variable_nodes[i + 1]]
+        meas_fn = distance_measurement_factor
+        jac_fn = distance_measurement_factor_jac
+        measurement = 0.
+        factor_nodes.append(
+            FactorNode(adj_vars, meas_fn, measurement_noise, measurement, jac_fn, GlobalConfig.use_huber,
+                       [target_distance], relinearization_threshold=GlobalConfig.relinearization_threshold,
+                       damping=GlobalConfig.damping, adaptive_damping=GlobalConfig.adaptive_damping))
+    return factor_nodes
+
+
+def generate_smoothing_factor_nodes(variable_nodes: List[VariableNode], measurement_noise: np.ndarray) -> List[
+    FactorNode]:
+    factor_nodes = []
+    for i in range(1, len(variable_nodes) - 1):
+        adj_vars = [variable_nodes[i - 1], variable_nodes[i], variable_nodes[i + 1]]
+        meas_fn = smoothing_factor
+        jac_fn = smoothing_factor_jac
+        measurement = np.zeros(1)
+        factor_nodes.append(
+            FactorNode(adj_vars, meas_fn, measurement_noise, measurement, jac_fn, GlobalConfig.use_huber, [],
+                       relinearization_threshold=GlobalConfig.relinearization_threshold,
+                       damping=GlobalConfig.damping, adaptive_damping=GlobalConfig.adaptive_damping))
+    return factor_nodes
+
+
+def generate_measurement_factor_nodes(variable_nodes: List[VariableNode], measurement_noise: np.ndarray,
+                                      measurements: List[np.ndarray]) -> List[FactorNode]:
+    """
+    Connects every measurement to its nearest nodes within the gate (see GlobalConfig), so the dimension of the
+    factors does not grow with the contour. Measurements without a node in the gate get no factor.
+    :param measurement_noise: noise per adjacent node (2x2), the noise of a factor is block diagonal
+    """
+    index = NodeIndex(variable_nodes)
+    covariances = None
+    if GlobalConfig.measurement_gate_mahalanobis:
+        covariances = np.array([v.sigma for v in variable_nodes])
+    gated = index.gated_k_nearest(np.array(measurements), GlobalConfig.measurement_num_nearest,
+                                  GlobalConfig.measurement_gate, covariances)
+    factor_nodes = []
+    for m, idxs in zip(measurements, gated):
+        if len(idxs) == 0:
+            continue
+        adj_vars = [variable_nodes[i] for i in idxs.tolist()]
+        meas_fn = measurement_factor
+        jac_fn = measurement_factor_jac
+        measurement = np.zeros(1)
+        noise = np.kron(np.identity(len(adj_vars)), measurement_noise)
+        factor_nodes.append(
+            FactorNode(adj_vars, meas_fn, noise, measurement, jac_fn, GlobalConfig.use_huber, [m],
+                       constant_jacobian=True, relinearization_threshold=GlobalConfig.relinearization_threshold,
+                       damping=GlobalConfig.damping, adaptive_damping=GlobalConfig.adaptive_damping))
+    return factor_nodes
+
+
+def associate_line_measurements(variable_nodes: List[VariableNode], measurements: List[np.ndarray],
+                                index: NodeIndex = None) -> List[Tuple[List[VariableNode], List[bool]]]:
+    """
+    Finds the nodes of the contour for the line factors of all measurements with one batched nearest neighbour
+    query: the closest node and its neighbours
+    :param index: index over the current means of the variable nodes, built if not given
+    :return: adjacent variable nodes and which of them are end points of the contour, for every measurement
+    """
+    if len(measurements) == 0:
+        return []
+    if index is None:
+        index = NodeIndex(variable_nodes)
+    _, min_idxs = index.nearest(np.array(measurements))
+    last = len(variable_nodes) - 1
+    associations = []
+    for min_idx in np.maximum(min_idxs, 1).tolist():
+        adj_vars = [variable_nodes[min_idx - 1], variable_nodes[min_idx]]
+        if last > min_idx:
+            adj_vars.append(variable_nodes[min_idx + 1])
+        associations.append((adj_vars, [(min_idx - 1) == 0, min_idx == last, (min_idx + 1) == last]))
+    return associations
+
+
+def associate_line_measurement(variable_nodes: List[VariableNode],
+                               m: np.ndarray) -> Tuple[List[VariableNode], List[bool]]:
+    """
+    Finds the nodes of the contour for a line factor: the closest node and its neighbours
+    :return: adjacent variable nodes and which of them are end points of the contour
+    """
+    return associate_line_measurements(variable_nodes, [m])[0]
+
+
+def create_line_factor_node(adj_vars: List[VariableNode], m: np.ndarray, end_points: List[bool]) -> FactorNode:
+    meas_fn = line_measurement_factor
+    jac_fn = line_measurement_factor_jac
+    measurement = np.zeros(1)
+    return FactorNode(adj_vars, meas_fn, np.identity(len(adj_vars) * 2) * GlobalConfig.line_measurement_noise,
+                      measurement, jac_fn,
+                      GlobalConfig.use_huber, [m, end_points], constant_jacobian=True,
+                      relinearization_threshold=GlobalConfig.relinearization_threshold,
+                      damping=GlobalConfig.damping, adaptive_damping=GlobalConfig.adaptive_damping,
+                      huber_mahalanobis_threshold=GlobalConfig.line_factor_huber_distance,
+                      robust_kernel=GlobalConfig.line_factor_robust_kernel)
+
+
+def generate_line_factor_nodes(variable_nodes: List[VariableNode],
+                               measurements: List[np.ndarray]) -> List[FactorNode]:
+    factor_nodes = []
+    for m, (adj_vars, end_points) in zip(measurements, associate_line_measurements(variable_nodes, measurements)):
+        factor_nodes.append(create_line_factor_node(adj_vars, m, end_points))
+    return factor_nodes
+
+
+def measurement_key(m: np.ndarray) -> bytes:
+    """
+    Key of a measurement point, which matches the factor of the measurement by its value, unlike id() also after the
+    factor graph was copied or loaded from a checkpoint
+    """
+    return np.asarray(m, dtype=float).tobytes()
+
+
+def update_line_factor_nodes(factor_graph: FactorGraph, measurements: List[np.ndarray]) -> int:
+    """
+    Associates the measurements again after the variable nodes of the graph changed. Only the line factors, whose
+    adjacent nodes changed, are replaced, all others keep their messages.
+    :return: number of added factors
+    """
+    current: Dict[bytes, List[FactorNode]] = {}  # factors by their measurement point, equal points are interchangeable
+    for f in factor_graph.factor_nodes:
+        if f.measurement_fn is line_measurement_factor:
+            current.setdefault(measurement_key(f.args[0]), []).append(f)
+    num_added = 0
+    associations = associate_line_measurements(factor_graph.variable_nodes, measurements)
+    for m, (adj_vars, end_points) in zip(measurements, associations):
+        candidates = current.get(measurement_key(m))
+        factor_node = candidates.pop() if candidates else None
+        if factor_node is not None:
+            same_nodes = len(factor_node.adj_variable_nodes) == len(adj_vars) and all(
+                old is new for old, new in zip(factor_node.adj_variable_nodes, adj_vars))
+            if same_nodes and np.array_equal(factor_node.args[1], end_points):
+                continue
+            factor_graph.remove_factor(factor_node)
+        factor_graph.add_factor(create_line_factor_node(adj_vars, m, end_points))
+        num_added += 1
+    for factor_node in [f for factor_nodes in current.values() for f in factor_nodes]:  # measurements, which are gone
+        factor_graph.remove_factor(factor_node)
+    return num_added
+
+
+def generate_line_collapse_factor_nodes(variable_nodes: List[VariableNode], measurement_noise: np.ndarray,
+                                        measurements) -> List[FactorNode]:
+    factor_nodes = []
+    for i in range(1, len(variable_nodes)):
+        adj_vars = [variable_nodes[i - 1], variable_nodes[i]]
+        meas_fn = line_collapse_factor
+        jac_fn = line_collapse_factor_jac
+        measurement = np.zeros(1)
+        factor_nodes.append(
+            FactorNode(adj_vars, meas_fn, np.identity(len(adj_vars) * 2) * measurement_noise, measurement, jac_fn,
+                       GlobalConfig.use_huber, [measurements], constant_jacobian=True,
+                       relinearization_threshold=GlobalConfig.relinearization_threshold,
+                       damping=GlobalConfig.damping, adaptive_damping=GlobalConfig.adaptive_damping))
+    return factor_nodes
+
+
+# ------------------------------ Putting all together --------------------------------
+def generate_factors(variable_nodes, measurements):
+    factor_nodes = []
+    # factor_nodes.extend(generate_distance_factor_nodes(variable_nodes, np.array(0.0002), use_huber, target_distance))
+    # factor_nodes.extend(generate_smoothing_factor_nodes(variable_nodes, np.array(0.07), use_huber))
+    # factor_nodes.extend(
+    #    generate_measurement_factor_nodes(variable_nodes, np.identity(2) * 0.2, use_huber,
+    #                                      measurements))
+    factor_nodes.extend(
+        generate_line_factor_nodes(variable_nodes, measurements))
+    # factor_nodes.extend(generate_line_collapse_factor_nodes(variable_nodes, 0.5, use_huber, measurements))
+    return factor_nodes
+
+
+def generate_prior(measurements: List[np.ndarray]) -> FactorGraph:
+    variable_nodes = generate_variable_nodes()
+    factor_nodes = generate_factors(variable_nodes, measurements)
+    return FactorGraph(variable_nodes, factor_nodes, GlobalConfig.num_threads, accelerator=GlobalConfig.accelerator,
+                       tracer=GlobalConfig.tracer)
+
+
+def reset_variable_nodes(variable_nodes: List[VariableNode]):
+    for v in variable_nodes:
+        v.reset(np.identity(v.belief.lam.shape[0]) * GlobalConfig.transition_noise)
+
+
+def add_new_nodes(factor_graph: FactorGraph):
+    variable_nodes = factor_graph.variable_nodes
+    num_birth_components = 0
+    birth_distance = 0.15
+    if len(variable_nodes) == 1:
+        old = variable_nodes[0]
+        post_mean, post_sigma = old.belief.get_values()
+        prior_mean, _ = old.prior.get_values()
+        vec_prior_post = post_mean - prior_mean
+        vec_orto = np.array([vec_prior_post[1], -vec_prior_post[0]])
+        vec_orto = vec_orto / np.linalg.norm(vec_orto)
+        vec_orto *= post_sigma[0, 0]
+        factor_graph.remove_variable(old)
+        for i in range(2):
+            new = GaussianState(2)
+            new_mu = old.mu + vec_orto
+            new.set_values(new_mu, old.sigma)
+            vec_orto *= -1
+            new_var = VariableNode(2, new)
+            new_var.mu = new_mu
+            new_var.sigma = old.sigma
+            new_var.prior = old.prior.copy()
+            factor_graph.add_variable(new_var)
+        num_birth_components = 1
+    else:
+        i = 0
+        while i < len(variable_nodes) - 1:
+            v_i = variable_nodes[i]
+            v_j = variable_nodes[i + 1]
+            if np.linalg.norm(v_i.mu - v_j.mu) > birth_distance:
+                new_mu = (v_i.mu + 0.5 * (v_j.mu - v_i.mu))
+                new_sigma = (v_i.sigma + v_j.sigma) / 2.
+                belief = GaussianState(v_i.dimensions)
+                belief.set_values(new_mu, new_sigma)
+                new_node = VariableNode(v_j.dimensions, belief)
+                new_node.mu = new_mu
+                new_node.sigma = new_sigma
+
+                new_lam = (v_i.prior.lam + v_j.prior.lam) / 2.
+                new_eta = (v_i.prior.eta + v_j.prior.eta) * 0.5
+                prior = GaussianState(v_i.dimensions)
+                prior.lam = new_lam
+                prior.eta = new_eta
+
+                new_node.prior = prior
+                factor_graph.insert_between(v_i, v_j, new_node)
+                num_birth_components += 1
+                i += 1
+
+            i += 1
+    return num_birth_components
+
+
+def give_birth(measurements, factor_graph) -> (FactorGraph, int):
+    num_birth_components = add_new_nodes(factor_graph)
+    update_line_factor_nodes(factor_graph, measurements)
+
+    # ToDO shrink as needed
+    return factor_graph, num_birth_components
+
+
+class Line:
+    def __init__(self, support, direction):
+        self.support = support
+        self.direction = direction
+        self.fac = np.outer(self.direction, self.direction) / (self.direction @ self.direction)
+
+    def dist_2_point(self, point):
+        m = point - self.support
+        projection_point = self.fac @ m + self.support
+        return np.linalg.norm(projection_point - point)
+
+
+def give_birth_line(measurements, factor_graph: FactorGraph) -> (FactorGraph, int):
+    birth_variance = GlobalConfig.birth_line_variance
+    sigma_death = GlobalConfig.death_node_sigma
+
+    v_nodes = list(factor_graph.variable_nodes)
+    lines = []
+    for i in range(len(v_nodes) - 1):
+        a, b = v_nodes[i].mu, v_nodes[i + 1].mu
+        ab = b - a
+        lines.append(Line(a, ab))
+    sum_squared_residuals = [0 for l in lines]
+    num_measurements = [1 for l in lines]
+    for m in measurements:
+        distances = []
+        for l in lines:
+            distances.append(l.dist_2_point(m))
+        min_dist_idx = np.argmin(distances)
+        sum_squared_residuals[min_dist_idx] += distances[min_dist_idx]
+        num_measurements[min_dist_idx] += 1
+
+    variance = [ssr / num for ssr, num in zip(sum_squared_residuals, num_measurements)]
+    num_changed_components = 0
+    i = 0
+    new_nodes = []
+
+    while i < len(v_nodes) - 1:
+        var = variance[i]
+        v_i = v_nodes[i]
+        v_j = v_nodes[i + 1]
+        if len(v_nodes) > 2:
+            if i is 0 and num_measurements[i] is 1:  # kill begin/end if doing nothing
+                i += 1
+                num_changed_components += 1
+                continue
+
+            if np.linalg.norm(v_i.sigma) > sigma_death:  # Kill because of sigma
+                i += 1
+                num_changed_components += 1
+                continue
+
+            # Kill if two lines can be combined
+            if i > 0:
+                v_k = v_nodes[i - 1]
+                line = Line(v_k.mu, v_j.mu - v_k.mu)
+                is_straight_line = line.dist_2_point(v_i.mu) < GlobalConfig.line_merge_residual
+                if is_straight_line:  # Kill because of straight line
+                    i += 1  # ToDo fix me correctly: if deleted, the next one needs to be compared with the previous not this node
+                    if i < len(v_nodes):
+                        new_nodes.append(v_nodes[i])
+                        i += 1
+                    num_changed_components += 1
+                    continue
+        # ToDo add birth at the end if needed
+        new_nodes.append(v_i)
+        if var > birth_variance:
+            for j in range(2):
+                new_mu = (v_i.mu + (1 + j) / 3 * (v_j.mu - v_i.mu))
+                new_sigma = (v_i.sigma + v_j.sigma) / (1 + j) / 3
+                belief = GaussianState(v_i.dimensions)
+                belief.set_values(new_mu, new_sigma)
+                new_node = VariableNode(v_j.dimensions, belief)
+                new_node.mu = new_mu
+                new_node.sigma = new_sigma
+
+                new_lam = (v_i.prior.lam + v_j.prior.lam) * 0.5
+                new_eta = (v_i.prior.eta + v_j.prior.eta) * 0.5
+                prior = GaussianState(v_i.dimensions)
+                prior.lam = new_lam
+                prior.eta = new_eta
+
+                new_node.prior = prior
+                new_nodes.append(new_node)
+            num_changed_components += 1
+        i += 1
+    if len(new_nodes) < 2 or (np.linalg.norm(v_nodes[-1].sigma) < sigma_death and num_measurements[-1] > 1):
+        if not new_nodes or new_nodes[-1] is not v_nodes[-1]:  # may be kept already by merging the lines before
+            new_nodes.append(v_nodes[-1])
+    else:
+        num_changed_components += 1
+
+    # Apply the changes to the graph, so only the factors next to killed or new nodes are replaced
+    for v in v_nodes:
+        if not any(v is new for new in new_nodes):
+            factor_graph.remove_variable(v)
+    for k, v in enumerate(new_nodes):
+        if v.idx is not None:
+            continue
+        if k == 0 or k == len(factor_graph.variable_nodes):
+            factor_graph.add_variable(v, k)
+        else:
+            factor_graph.insert_between(new_nodes[k - 1], factor_graph.variable_nodes[k], v)
+    update_line_factor_nodes(factor_graph, measurements)
+
+    return factor_graph, num_changed_components
+
+
+def update_factor_graph(new_measurements: List[np.ndarray],
+                        factor_graph: FactorGraph) -> (FactorGraph):
+    for f in reversed(list(factor_graph.factor_nodes)):  # all measurements are new
+        factor_graph.remove_factor(f)
+    reset_variable_nodes(factor_graph.variable_nodes)
+    update_line_factor_nodes(factor_graph, new_measurements)
+    return factor_graph
+
+
+def sample_from_line(num_measurements: int) -> List[np.ndarray]:
+    measurements = []
+    for i in range(num_measurements):
+        x, y = np.random.random(2)
+        y = y * 0.05 + 0.5
+        measurements.append(np.array([x, y]))
+    return measurements
+
+
+def sample_from_step(num_measurements: int) -> List[np.ndarray]:
+    measurements = []
+    for i in range(num_measurements):
+        x, y = np.random.random(2)
+        y = y * 0.05 + 0.1
+        if x > 0.2:
+            y += 0.5
+        if x > 0.7:
+            y -= 0.5
+
+        measurements.append(np.array([x, y]))
+    return measurements
+
+
+def sample_from_circle(num_measurements: int) -> List[np.ndarray]:
+    measurements = []
+    for i in range(num_measurements):
+        a = np.random.random() * np.pi + 0.5
+        r = 0.3
+        rot_mat = np.array([[np.cos(a), -np.sin(a)], [np.sin(a), np.cos(a)]])
+        center = np.array([0.5, 0.5])
+        dir = np.array([1., 1.]) @ rot_mat * r
+        measurements.append(center + dir)
+    return measurements
+
+
+def sample_from_rect(point_density: int) -> List[np.ndarray]:
+    measurements = []
+    length = np.max([np.min([1.5, 2 * np.abs(1 - sample_from_rect.time / 20.)]), 0.5])
+    num_measurements = int(length * point_density)
+    sample_from_rect.time += 1.
+    for i in range(num_measurements):
+        front_side = np.random.random() < 0.5
+        dist = np.random.random()
+        support_vect = np.array([0.1, 0.1])
+        support_vect += support_vect * np.random.random() * 0.4
+        dir_vect = np.array([0., 1.])
+        if front_side:
+            dir_vect = np.array([1., 0.])
+
+        measurements.append(support_vect + (dir_vect * dist * length))
+    return measurements
+
+
+sample_from_rect.time = 0.
+
+
+def sample_from_gaussian(num_measurements: int) -> List[np.ndarray]:
+    mean = np.array([0.7, 0.7])
+    cov = np.array([[0.05, 0.], [0., 0.05]])
+    measurements = []
+    for _ in range(num_measurements):
+        measurements.append(np.random.multivariate_normal(mean, cov, 1)[0])
+    return measurements
+
+
+def generate_measurements(num_range: List[int]) -> List[np.ndarray]:
+    num_measurements = np.random.randint(*num_range)
+    num_outliers = int(num_measurements / 7)
+    measurements = []
+    measurements.extend(sample_from_circle(num_measurements))
+    measurements.extend(sample_from_rect(num_measurements))
+    # measurements.extend(sample_from_step(num_measurements))
+    # measurements.extend(sample_from_gaussian(num_outliers))
+    return measurements
+
+
+def fit_frame(measurements: List[np.ndarray], factor_graph: FactorGraph, frame: int,
+              viz: ContourPlottingViz = None, verbose: bool = True) -> (FactorGraph, int):
+    """
+    Fits the contour to the measurements of one frame, alternating GBP and the birth/death of nodes
+    :param measurements: measurements of the frame
+    :param factor_graph: factor graph of the frame
+    :param frame: number of the frame
+    :param viz: optional visualization, which saves all intermediate states (ContourPlottingViz or ContourRecorder)
+    :param verbose: print the progress
+    :return: the factor graph and the total number of iterations
+    """
+    total_iterations = 0
+    num_changed_components = 1
+    with span(GlobalConfig.tracer, "frame", frame=frame, measurements=len(measurements)) as frame_span:
+        while (
+                num_changed_components != 0) and total_iterations < GlobalConfig.max_iterations_per_measurement:  # ToDo repeat if means moved a lot
+            iterations = factor_graph.fit().iterations
+            total_iterations += iterations
+            if viz is not None:
+                viz.save_state(factor_graph, iterations)
+                viz.save_measurements(measurements, frame)
+            num_changed_components = 0
+            # factor_graph, num_new_components = give_birth(measurements, use_huber, target_distance,
+            #                                               factor_graph)
+            with span(GlobalConfig.tracer, "birth_death") as birth_span:
+                factor_graph, num_changed_components = give_birth_line(measurements, factor_graph)
+                birth_span.set(changed_components=num_changed_components,
+                               variables=len(factor_graph.variable_nodes))
+            if verbose:
+                print("Iterations: " + str(iterations) + " -> had to kill/birth : " + str(
+                    num_changed_components) + " nodes. Num nodes: " + str(len(factor_graph.variable_nodes)))
+        frame_span.set(iterations=total_iterations)
+    return factor_graph, total_iterations
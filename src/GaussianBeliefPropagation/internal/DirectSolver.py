@@ -0,0 +1,173 @@
+from typing import List, Tuple
+import numpy as np
+import scipy.sparse as sp
+from scipy.sparse.linalg import splu
+
+from GBP import FactorGraph
+
+
+def build_information_system(factor_graph: FactorGraph) -> Tuple[sp.csc_matrix, np.ndarray, np.ndarray]:
+    """
+    Assembles the joint gaussian of all variables in canonical form from the priors and the linearized factors.
+    The factors are used as they are, so call relinearize before, if their linearization point is outdated.
+    :param factor_graph: the factor graph
+    :return: sparse precision matrix, information vector and the offset of each variable within the joint state
+    """
+    variable_nodes = factor_graph.variable_nodes
+    offsets = np.cumsum([0] + [v.dimensions for v in variable_nodes])
+
+    eta = np.zeros(offsets[-1])
+    rows, cols, values = [], [], []
+
+    def add_block(idxs: np.ndarray, block_eta: np.ndarray, block_lam: np.ndarray):
+        eta[idxs] += block_eta
+        rows.append(np.repeat(idxs, idxs.size))
+        cols.append(np.tile(idxs, idxs.size))
+        values.append(np.ravel(block_lam))
+
+    for v in variable_nodes:
+        idxs = np.arange(offsets[v.idx], offsets[v.idx] + v.dimensions)
+        add_block(idxs, v.prior.eta, v.prior.lam)
+
+    for f in factor_graph.factor_nodes:
+        idxs = np.concatenate([np.arange(offsets[v.idx], offsets[v.idx] + v.dimensions)
+                               for v in f.adj_variable_nodes])
+        add_block(idxs, f.factor_eta, f.factor_lam)
+
+    # Explicit zeros are kept, so every variable block is part of the sparsity pattern of the factorization
+    lam = sp.csc_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))),
+                        shape=(eta.size, eta.size))
+    return lam, eta, offsets
+
+
+def symbolic_factorization(lam: sp.csc_matrix, permutation: np.ndarray) -> List[List[int]]:
+    """
+    Computes the sparsity pattern of the cholesky factor of the permuted matrix via its elimination tree.
+    In contrast to the numeric factor, entries which are zero by cancellation (e.g. uncorrelated dimensions
+    of a variable) are part of the pattern.
+    :param lam: the (not permuted) symmetric matrix, explicit zeros count as non zero entries
+    :param permutation: permutation of the factorization, column k of lam is column permutation[k] of the factor
+    :return: sorted row indices below the diagonal for every column of the factor
+    """
+    n = lam.shape[0]
+    coo = lam.tocoo()
+    rows, cols = permutation[coo.row], permutation[coo.col]
+    lower = rows > cols
+    pattern = [set() for _ in range(n)]
+    for i, j in zip(rows[lower].tolist(), cols[lower].tolist()):
+        pattern[j].add(i)
+
+    children = [[] for _ in range(n)]
+    structure = []
+    for j in range(n):
+        column = pattern[j]
+        for child in children[j]:
+            column.update(structure[child])
+        column.discard(j)
+        structure.append(sorted(column))
+        if column:
+            children[structure[j][0]].append(j)
+    return structure
+
+
+def selected_inversion(lu, structure: List[List[int]]) -> dict:
+    """
+    Computes the entries of the inverse on the sparsity pattern of the cholesky factor (Takahashi equations),
+    without computing the dense inverse.
+    The factorization has to be symmetric, i.e. P A P^T = L D L^T with unit lower triangular L.
+    :param lu: symmetric SuperLU factorization (see factorize)
+    :param structure: symbolic pattern of L (see symbolic_factorization)
+    :return: dict column -> {row: value} holding the lower triangle of the permuted inverse
+    """
+    lower = lu.L.tocsc()
+    diagonal = lu.U.diagonal()
+    n = diagonal.size
+    inverse = {}
+    for i in range(n - 1, -1, -1):
+        start, end = lower.indptr[i], lower.indptr[i + 1]
+        numeric = dict(zip(lower.indices[start:end].tolist(), lower.data[start:end].tolist()))
+        rows = structure[i]
+        values = [numeric.get(k, 0.) for k in rows]
+
+        column = {}
+        for j in rows:
+            column[j] = -sum(l_ki * (inverse[min(k, j)][max(k, j)]) for k, l_ki in zip(rows, values))
+        column[i] = 1. / diagonal[i] - sum(l_ki * column[k] for k, l_ki in zip(rows, values))
+        inverse[i] = column
+    return inverse
+
+
+def factorize(lam: sp.csc_matrix):
+    """
+    Sparse LU factorization of a symmetric positive definite matrix, which is equivalent to a LDL^T factorization.
+    Symmetric mode without pivoting keeps row and column permutation identical.
+    """
+    lu = splu(lam, permc_spec="MMD_AT_PLUS_A", diag_pivot_thresh=0., options=dict(SymmetricMode=True))
+    if not np.array_equal(lu.perm_r, lu.perm_c):
+        raise np.linalg.LinAlgError("Factorization is not symmetric, the precision matrix is not positive definite")
+    return lu
+
+
+class DirectSolver:
+    __doc__ = "Solves a linear(ized) factor graph exactly with one sparse factorization of the joint system."
+
+    def __init__(self, factor_graph: FactorGraph):
+        """
+        :param factor_graph: the factor graph to solve, its variable nodes are updated by solve
+        """
+        self.factor_graph = factor_graph
+        self.means = None  # joint mean of the last solve
+        self.marginal_covariances = None  # list of the marginal covariance of each variable of the last solve
+
+    def relinearize_at_means(self):
+        """
+        Linearizes all factors around the current means of their adjacent variables
+        """
+        for f in self.factor_graph.factor_nodes:
+            f.linearization_point = [v.mu for v in f.adj_variable_nodes]
+            f.compute_adaptive_noise()
+            f.compute_factor()
+
+    def solve(self, num_relinearizations: int = 0, compute_marginals: bool = True):
+        """
+        Solves for the joint mean and (optionally) the marginal covariances of all variables.
+        Afterwards the beliefs of the variable nodes are set to their marginals.
+        :param num_relinearizations: number of additional gauss-newton steps, which relinearize all factors
+                                     around the last solution. Not needed for linear factors.
+        :param compute_marginals: compute marginal covariances via selected inversion. If false only the
+                                  means of the variable nodes are updated.
+        :return: joint mean
+        """
+        lam, lu, offsets = None, None, None
+        for i in range(num_relinearizations + 1):
+            if i > 0:
+                self.relinearize_at_means()
+            lam, eta, offsets = build_information_system(self.factor_graph)
+            lu = factorize(lam)
+            self.means = lu.solve(eta)
+            for v, offset in zip(self.factor_graph.variable_nodes, offsets):
+                v.mu = self.means[offset:offset + v.dimensions]
+
+        if compute_marginals:
+            self.marginal_covariances = self._marginal_covariances(lam, lu, offsets)
+            for v, sigma in zip(self.factor_graph.variable_nodes, self.marginal_covariances):
+                v.sigma = sigma
+                v.belief.set_values(v.mu, sigma)
+        return self.means
+
+    def _marginal_covariances(self, lam: sp.csc_matrix, lu, offsets: np.ndarray) -> List[np.ndarray]:
+        """
+        Extracts the marginal covariance of every variable from the selected inverse
+        """
+        permutation = lu.perm_c
+        inverse = selected_inversion(lu, symbolic_factorization(lam, permutation))
+        covariances = []
+        for v, offset in zip(self.factor_graph.variable_nodes, offsets):
+            idxs = permutation[offset:offset + v.dimensions]
+            sigma = np.zeros([v.dimensions, v.dimensions])
+            for a in range(v.dimensions):
+                for b in range(a + 1):
+                    i, j = max(idxs[a], idxs[b]), min(idxs[a], idxs[b])
+                    sigma[a, b] = sigma[b, a] = inverse[j][i]
+            covariances.append(sigma)
+        return covariances
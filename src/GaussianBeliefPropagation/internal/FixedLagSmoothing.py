@@ -0,0 +1,115 @@
+from collections import deque
+from typing import List
+import numpy as np
+
+from GBP import VariableNode, FactorNode, FactorGraph, ConvergenceReport, BeliefSnapshot
+from ContourFactors import transition_factor, transition_factor_jac
+from LinAlgKernels import add_noise
+from ContourTracking import GlobalConfig, generate_variable_nodes, update_line_factor_nodes
+
+
+class CurrentContour:
+    __doc__ = "Contour of the current frame within the graph of a FixedLagSmoother. Offers the part of the " \
+              "FactorGraph interface used by the contour fitting (fit_frame, give_birth_line, " \
+              "update_line_factor_nodes, the visualization), so these only see the nodes and line factors of this frame. " \
+              "The nodes of the current frame are contiguous at the end of the variable nodes of the graph."
+
+    def __init__(self, factor_graph: FactorGraph, variable_nodes: List[VariableNode]):
+        self.factor_graph = factor_graph
+        self.variable_nodes = variable_nodes
+        self.factor_nodes: List[FactorNode] = []
+
+    def fit(self, *args, **kwargs) -> ConvergenceReport:
+        """
+        Fits the whole window, which smooths the contours of the previous frames as well
+        """
+        return self.factor_graph.fit(*args, **kwargs)
+
+    def snapshot(self, variable_nodes: List[VariableNode] = None, prior: bool = False) -> BeliefSnapshot:
+        """
+        Snapshot of the nodes of this frame by default, see FactorGraph.snapshot
+        """
+        return self.factor_graph.snapshot(self.variable_nodes if variable_nodes is None else variable_nodes, prior)
+
+    def add_variable(self, variable_node: VariableNode, position: int = None) -> VariableNode:
+        position = len(self.variable_nodes) if position is None else position
+        first = self.variable_nodes[0].idx if self.variable_nodes else len(self.factor_graph.variable_nodes)
+        self.factor_graph.add_variable(variable_node, first + position)
+        self.variable_nodes.insert(position, variable_node)
+        return variable_node
+
+    def remove_variable(self, variable_node: VariableNode) -> List[FactorNode]:
+        removed_factors = self.factor_graph.remove_variable(variable_node)
+        self.variable_nodes.remove(variable_node)
+        self._forget(removed_factors)
+        return removed_factors
+
+    def insert_between(self, left: VariableNode, right: VariableNode, variable_node: VariableNode) -> List[FactorNode]:
+        removed_factors = self.factor_graph.insert_between(left, right, variable_node)
+        self.variable_nodes.insert(self.variable_nodes.index(right), variable_node)
+        self._forget(removed_factors)
+        return removed_factors
+
+    def add_factor(self, factor_node: FactorNode) -> FactorNode:
+        self.factor_nodes.append(self.factor_graph.add_factor(factor_node))
+        return factor_node
+
+    def remove_factor(self, factor_node: FactorNode):
+        self.factor_graph.remove_factor(factor_node)
+        self._forget([factor_node])
+
+    def _forget(self, factor_nodes: List[FactorNode]):
+        removed = {id(f) for f in factor_nodes}
+        self.factor_nodes = [f for f in self.factor_nodes if id(f) not in removed]
+
+
+class FixedLagSmoother:
+    __doc__ = "Keeps the nodes and factors of the last frames in one factor graph instead of resetting the nodes " \
+              "every frame. Each node is linked to its successor in the next frame by a transition factor. The " \
+              "frame, which leaves the window, is marginalized into a prior factor on the following frame " \
+              "(see FactorGraph.marginalize_variables), so memory and compute per frame stay bounded."
+
+    def __init__(self, lag: int):
+        """
+        :param lag: number of frames in the window including the current one, at least 1
+        """
+        if lag < 1:
+            raise ValueError("The window has to contain at least the current frame")
+        self.lag = lag
+        self.factor_graph: FactorGraph = None
+        self.frames: deque = deque()  # CurrentContour of every frame in the window, the oldest first
+
+    def new_frame(self, measurements: List[np.ndarray]) -> CurrentContour:
+        """
+        Adds the contour of a new frame (predicted from the previous one) with the line factors of its measurements
+        and marginalizes the oldest frame, if the window is full
+        :return: the contour of the new frame, use it like the factor graph of a frame (e.g. for fit_frame)
+        """
+        if self.factor_graph is None:
+            variable_nodes = generate_variable_nodes()
+            self.factor_graph = FactorGraph(variable_nodes, [], GlobalConfig.num_threads,
+                                            accelerator=GlobalConfig.accelerator, tracer=GlobalConfig.tracer)
+            contour = CurrentContour(self.factor_graph, list(variable_nodes))
+        else:
+            transition_noise = np.identity(2) * GlobalConfig.transition_noise
+            contour = CurrentContour(self.factor_graph, [])
+            for previous in self.frames[-1].variable_nodes:
+                # without prior, the prediction is only the initial belief for the first messages
+                node = contour.add_variable(VariableNode(previous.dimensions))
+                node.belief.eta, node.belief.lam = add_noise(previous.belief.eta, previous.belief.lam,
+                                                             transition_noise)
+                node.mu, node.sigma = previous.mu, previous.sigma + transition_noise
+                self.factor_graph.add_factor(
+                    FactorNode([previous, node], transition_factor, transition_noise, np.zeros(previous.dimensions),
+                               transition_factor_jac, False, [], linear=True))
+            while len(self.frames) >= self.lag:
+                self.factor_graph.marginalize_variables(self.frames.popleft().variable_nodes)
+        self.frames.append(contour)
+        update_line_factor_nodes(contour, measurements)
+        return contour
+
+    def smoothed_means(self) -> List[np.ndarray]:
+        """
+        :return: (n, 2) means of the contour of every frame in the window, the oldest first
+        """
+        return [np.array([v.mu for v in contour.variable_nodes]).reshape(-1, 2) for contour in self.frames]
@@ -0,0 +1,251 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from typing import List, Callable, Any, Sequence, Optional
+import numpy as np
+
+from Tracing import Tracer
+
+
+class Frame:
+    __doc__ = "Measurements of one time step, which enter the pipeline."
+    __slots__ = ("index", "measurements", "created", "num_merged")
+
+    def __init__(self, index: int, measurements, created: float = None, num_merged: int = 0):
+        """
+        :param index: number of the frame in the source
+        :param measurements: measurements of the frame, e.g. a list of arrays or an array with one row per measurement
+        :param created: perf_counter at the ingestion of the frame
+        :param num_merged: number of older frames, which were merged into this one
+        """
+        self.index = index
+        self.measurements = measurements
+        self.created = time.perf_counter() if created is None else created
+        self.num_merged = num_merged
+
+
+class FrameResult:
+    __doc__ = "Output of the solver for one frame, which is passed to the consumers."
+    __slots__ = ("frame", "value", "solve_seconds", "latency_seconds")
+
+    def __init__(self, frame: Frame, value: Any, solve_seconds: float):
+        self.frame = frame
+        self.value = value
+        self.solve_seconds = solve_seconds
+        self.latency_seconds = time.perf_counter() - frame.created  # from the ingestion to the end of the solver
+
+
+def merge_frames(older: Frame, newer: Frame) -> Frame:
+    """
+    Merges two pending frames into one with the measurements of both, used by the policy "merge"
+    """
+    if isinstance(older.measurements, np.ndarray) and isinstance(newer.measurements, np.ndarray):
+        measurements = np.concatenate([older.measurements, newer.measurements])
+    else:
+        measurements = list(older.measurements) + list(newer.measurements)
+    return Frame(newer.index, measurements, older.created, older.num_merged + newer.num_merged + 1)
+
+
+class FrameQueue:
+    __doc__ = "Bounded queue between two stages of the pipeline. If it is full, the policy decides: " \
+              "block the producer (backpressure), drop the oldest or the newest frame or merge the new frame into " \
+              "the newest pending one."
+    POLICIES = ("block", "drop_oldest", "drop_newest", "merge")
+
+    def __init__(self, max_size: int, policy: str = "block", merge: Callable[[Any, Any], Any] = merge_frames):
+        if policy not in self.POLICIES:
+            raise ValueError("Unknown policy " + str(policy) + ", expected one of " + str(self.POLICIES))
+        if max_size < 1:
+            raise ValueError("max_size has to be at least 1")
+        self.max_size = max_size
+        self.policy = policy
+        self.merge = merge
+        self.items = deque()
+        self.closed = False
+        self.num_dropped = 0
+        self.num_merged = 0
+        self.condition = threading.Condition()
+
+    def put(self, item) -> Optional[str]:
+        """
+        Adds an item, blocks with the policy "block" while the queue is full
+        :return: None if the item was added unchanged, otherwise what happened: "dropped", "merged" or "closed"
+        """
+        with self.condition:
+            while self.policy == "block" and len(self.items) >= self.max_size and not self.closed:
+                self.condition.wait()
+            if self.closed:
+                return "closed"
+            outcome = None
+            if len(self.items) >= self.max_size:
+                if self.policy == "drop_newest":
+                    self.num_dropped += 1
+                    return "dropped"
+                if self.policy == "drop_oldest":
+                    self.items.popleft()
+                    self.num_dropped += 1
+                    outcome = "dropped"
+                else:
+                    item = self.merge(self.items.pop(), item)
+                    self.num_merged += 1
+                    outcome = "merged"
+            self.items.append(item)
+            self.condition.notify_all()
+            return outcome
+
+    def get(self):
+        """
+        Removes the oldest item, blocks while the queue is empty
+        :return: the item or None, if the queue is closed and empty
+        """
+        with self.condition:
+            while not self.items and not self.closed:
+                self.condition.wait()
+            if not self.items:
+                return None
+            item = self.items.popleft()
+            self.condition.notify_all()
+            return item
+
+    def close(self, discard: bool = False):
+        """
+        No more items are added, get returns the remaining items (unless discarded) and None afterwards
+        """
+        with self.condition:
+            self.closed = True
+            if discard:
+                self.items.clear()
+            self.condition.notify_all()
+
+
+class PipelineStats:
+    __doc__ = "Summary of a run of the pipeline."
+
+    def __init__(self):
+        self.num_ingested = 0
+        self.num_solved = 0
+        self.num_dropped = 0
+        self.num_merged = 0
+        self.seconds = 0.
+        self.latencies: List[float] = []
+        self.solve_seconds: List[float] = []
+
+    def __repr__(self):
+        mean_latency = 1e3 * np.mean(self.latencies) if self.latencies else 0.
+        return "PipelineStats(ingested=" + str(self.num_ingested) + ", solved=" + str(self.num_solved) + \
+               ", dropped=" + str(self.num_dropped) + ", merged=" + str(self.num_merged) + \
+               ", seconds={:.3f}, mean latency={:.1f} ms)".format(self.seconds, mean_latency)
+
+
+class FramePipeline:
+    __doc__ = "Streaming pipeline of three overlapping stages: ingestion of the frames of a source (thread), " \
+              "solving (the calling thread, so the solver state stays in it) and emission of the results to the " \
+              "consumers (thread). The stages are connected by bounded queues, the policy of the frame queue " \
+              "decides what happens, if the solver falls behind, the result queue always blocks the solver."
+
+    def __init__(self, solve: Callable[[Frame], Any], consumers: Sequence[Callable[[FrameResult], None]] = (),
+                 queue_size: int = 2, policy: str = "block", result_queue_size: int = 2,
+                 merge: Callable[[Frame, Frame], Frame] = merge_frames, tracer: Tracer = None):
+        """
+        :param solve: solver of one frame, called in order of the frames
+        :param consumers: called with the result of every solved frame in order, e.g. recording or visualization
+        :param queue_size: maximum number of frames waiting for the solver
+        :param policy: what to do with new frames, if the frame queue is full, see FrameQueue.POLICIES
+        :param result_queue_size: maximum number of results waiting for the consumers
+        :param merge: combines two pending frames with the policy "merge"
+        :param tracer: optional tracer, dropped and merged frames are recorded as instant events
+        """
+        self.solve = solve
+        self.consumers = list(consumers)
+        self.queue_size = queue_size
+        self.policy = policy
+        self.result_queue_size = result_queue_size
+        self.merge = merge
+        self.tracer = tracer
+
+    def run(self, source) -> PipelineStats:
+        """
+        Runs the pipeline until the source is exhausted and all frames are solved and emitted.
+        An exception of any stage stops all stages and is raised again.
+        :param source: iterable or async iterable of the measurements of the frames
+        """
+        frames = FrameQueue(self.queue_size, self.policy, self.merge)
+        results = FrameQueue(self.result_queue_size)
+        stats = PipelineStats()
+        errors = []
+
+        def stop(error: BaseException):
+            errors.append(error)
+            frames.close(discard=True)
+            results.close(discard=True)
+
+        def ingest():
+            try:
+                if hasattr(source, "__aiter__"):
+                    asyncio.run(self._ingest_async(source, frames, stats))
+                else:
+                    for measurements in source:
+                        if not self._ingest(measurements, frames, stats):
+                            break
+            except BaseException as error:
+                stop(error)
+            frames.close()
+
+        def emit():
+            try:
+                while True:
+                    result = results.get()
+                    if result is None:
+                        break
+                    for consumer in self.consumers:
+                        consumer(result)
+                    stats.latencies.append(time.perf_counter() - result.frame.created)  # until emitted
+            except BaseException as error:
+                stop(error)
+
+        start = time.perf_counter()
+        threads = [threading.Thread(target=ingest, name="pipeline-ingest", daemon=True),
+                   threading.Thread(target=emit, name="pipeline-emit", daemon=True)]
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                frame = frames.get()
+                if frame is None:
+                    break
+                solve_start = time.perf_counter()
+                value = self.solve(frame)
+                result = FrameResult(frame, value, time.perf_counter() - solve_start)
+                stats.num_solved += 1
+                stats.solve_seconds.append(result.solve_seconds)
+                if results.put(result) == "closed":  # a consumer failed
+                    break
+        except BaseException as error:
+            stop(error)
+        results.close()
+        for thread in threads:
+            thread.join()
+        stats.num_dropped = frames.num_dropped
+        stats.num_merged = frames.num_merged
+        stats.seconds = time.perf_counter() - start
+        if errors:
+            raise errors[0]
+        return stats
+
+    def _ingest(self, measurements, frames: FrameQueue, stats: PipelineStats) -> bool:
+        """
+        :return: False if the pipeline was stopped
+        """
+        frame = Frame(stats.num_ingested, measurements)
+        stats.num_ingested += 1
+        outcome = frames.put(frame)
+        if outcome in ("dropped", "merged") and self.tracer is not None:
+            self.tracer.instant("frame_" + outcome, frame=frame.index)
+        return outcome != "closed"
+
+    async def _ingest_async(self, source, frames: FrameQueue, stats: PipelineStats):
+        async for measurements in source:
+            # blocking put on purpose: the source runs in the event loop of the ingestion thread and is paused
+            if not self._ingest(measurements, frames, stats):
+                break
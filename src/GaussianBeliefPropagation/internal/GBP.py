@@ -1,11 +1,18 @@
-import sys
-from typing import List, Callable, Tuple, Union, Any
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import List, Callable, Tuple, Union, Any, Dict
 import numpy as np
-from copy import deepcopy
+
+from LinAlgKernels import NotPositiveDefiniteError, inv_spd, solve_spd, marginalize, add_noise
+from RobustKernels import RobustKernel, HuberKernel, whiten_noise, whiten_precision, mahalanobis
+from Tracing import Tracer, counters, span
 
 
 class GaussianState:
-    __doc__ = "This class holds a possibly multi dimensional state in canonical form"
+    __doc__ = "This class holds a possibly multi dimensional state in canonical form. " \
+              "The arrays are replaced on update, never modified in place, so states can share them without copies."
+    __slots__ = ("dim", "eta", "lam")
 
     def __init__(self, dimensionality: int):
         """
@@ -15,29 +22,39 @@ class GaussianState:
         :param lam: canonical form of the covariance matrix
         """
         self.dim = dimensionality
-        self.eta = np.matrix(np.zeros(self.dim))
+        self.eta = np.zeros(self.dim)
         self.lam = np.zeros([self.dim, self.dim])
 
-    def set_values(self, mu: np.matrix, sigma: np.matrix):
+    def set_values(self, mu: np.ndarray, sigma: np.ndarray):
         """
         Sets and converts values from moment form to canonical form
         :param mu: mean
         :param sigma: covariance
         """
-        self.lam = np.linalg.inv(sigma)
-        self.eta = mu @ self.lam
+        self.lam = inv_spd(sigma)
+        self.eta = self.lam @ np.asarray(mu).ravel()
 
     def get_values(self):
         """
         Return values in moment form
         :return: mean, cov
         """
-        return np.linalg.inv(self.lam) @ self.eta.T, np.linalg.inv(self.lam)
+        sigma = inv_spd(self.lam)
+        return sigma @ self.eta, sigma
+
+    def copy(self) -> "GaussianState":
+        """
+        Creates a new state sharing the (never modified) arrays of this one
+        """
+        state = GaussianState.__new__(GaussianState)
+        state.dim, state.eta, state.lam = self.dim, self.eta, self.lam
+        return state
 
 
 class VariableNode:
     __doc__ = "Represents a gaussian distributed multi dimensional random variable in a factor graph."
-    idx_counter = 0
+    __slots__ = ("idx", "belief", "prior", "dimensions", "adj_factors", "messages_from_factors", "messages_to_factors",
+                 "mu", "sigma")
 
     def __init__(self, dimensions: int, prior: GaussianState = None):
         """
@@ -45,32 +62,40 @@ class VariableNode:
         :param dimensions: the dimensions of the gaussian state
         :param prior: a prior of the variable
         """
-        self.idx = VariableNode.idx_counter
-        VariableNode.idx_counter += 1
+        self.idx = None  # position within the factor graph, assigned by the FactorGraph
         if prior is None:
             self.belief = GaussianState(dimensions)
             self.prior = GaussianState(dimensions)
         else:
-            self.belief = deepcopy(prior)
-            self.prior = deepcopy(prior)
+            self.belief = prior.copy()
+            self.prior = prior.copy()
         self.dimensions = dimensions
-        self.adj_factors_idx = []  # will be filled by Factors on creation
-        self.factor_nodes = []  # will be filled at the end by the FactorGraph
+        # will be filled by Factors on creation, the messages are shared with the factors
+        self.adj_factors = []
+        self.messages_from_factors = []
+        self.messages_to_factors = []
 
         self.mu = np.zeros(dimensions)  # for debug/output purpose
         self.sigma = np.zeros([dimensions, dimensions])  # for debug/output purpose
 
-    def reset(self, transition_noise):
+    def clear_factors(self):
+        """
+        Disconnects the variable from all its factors, e.g. before generating new factors for it
+        """
+        self.adj_factors = []
+        self.messages_from_factors = []
+        self.messages_to_factors = []
+
+    def reset(self, transition_noise: np.ndarray):
         """
-        Sets current belief as prior and resets everything else
+        Sets current belief with the added transition noise as prior and resets everything else
+        :param transition_noise: covariance of the transition noise
         """
-        self.sigma += transition_noise
+        self.sigma = self.sigma + transition_noise
 
-        self.belief.lam = np.linalg.inv(self.sigma)
-        self.belief.eta = (self.belief.lam @ self.mu).T
-        self.prior = deepcopy(self.belief)
-        self.adj_factors_idx = []
-        self.factor_nodes = []
+        self.belief.eta, self.belief.lam = add_noise(self.belief.eta, self.belief.lam, transition_noise)
+        self.prior = self.belief.copy()
+        self.clear_factors()
 
     def update_belief(self):
         """
@@ -78,11 +103,9 @@ class VariableNode:
         """
         eta = self.prior.eta.copy()
         lam = self.prior.lam.copy()
-        for factor_idx in self.adj_factors_idx:
-            factor = self.factor_nodes[factor_idx]
-            eta_message, lam_message = factor.get_message_for(self.idx)
-            eta += eta_message
-            lam += lam_message
+        for message in self.messages_from_factors:
+            eta += message.eta
+            lam += message.lam
 
         # Ensure that matrix is positive-semi-definite
         lam = (lam + lam.T) / 2.
@@ -90,131 +113,251 @@ class VariableNode:
 
         self.belief.eta = eta
         self.belief.lam = lam
-        if np.linalg.det(self.belief.lam) != 0:
-            self.sigma = np.linalg.inv(self.belief.lam)  # Just for debugging/output
-            self.mu = self.sigma @ self.belief.eta.T  # Just for debugging/output
+        try:
+            self.sigma = inv_spd(self.belief.lam)  # Just for debugging/output
+            self.mu = self.sigma @ self.belief.eta  # Just for debugging/output
+        except NotPositiveDefiniteError:
+            warnings.warn("Belief of variable node " + str(self.idx) + " is not positive definite", RuntimeWarning)
 
         # Send message with updated belief to adjacent factors
-        for factor_idx in self.adj_factors_idx:
-            factor = self.factor_nodes[factor_idx]
-            eta_message, lam_message = factor.get_message_for(self.idx)
-            factor.receive_message_from(self.idx, eta - eta_message, lam - lam_message)
+        for to_factor, from_factor in zip(self.messages_to_factors, self.messages_from_factors):
+            np.subtract(eta, from_factor.eta, out=to_factor.eta)
+            np.subtract(lam, from_factor.lam, out=to_factor.lam)
+
+
+class Message:
+    __doc__ = "Gaussian message along an edge in canonical form. Once its factor is part of a FactorGraph, the arrays " \
+              "are views into the message buffers of the graph (see EdgeTable), so they are written in place."
+    __slots__ = ("eta", "lam")
+
+    def __init__(self, eta: np.ndarray, lam: np.ndarray):
+        """
+        :param eta: the eta part of the message, owned by the message
+        :param lam: the lambda part of the message, owned by the message
+        """
+        self.eta = eta
+        self.lam = lam
+
+    def set(self, eta: np.ndarray, lam: np.ndarray):
+        """
+        Overwrites the message in place
+        """
+        self.eta[...] = eta
+        self.lam[...] = lam
+
+
+MAX_DAMPING = 0.9  # upper bound for adaptive damping
+DAMPING_STEP = 0.1  # increase of the adaptive damping per oscillating iteration
+
+
+@lru_cache(maxsize=None)
+def factor_layout(variable_dims: Tuple[int, ...]) -> Tuple[List[slice], List[Tuple[np.ndarray, np.ndarray]]]:
+    """
+    Index structures of a factor, which only depend on the dimensions of its variables.
+    They are shared between all factors with the same layout.
+    :param variable_dims: dimensions of the adjacent variables
+    :return: slice of each variable within the factor and the (kept, marginalized out) dimensions for its message
+    """
+    offsets = np.cumsum((0,) + variable_dims)
+    dims = np.arange(offsets[-1])
+    slices = [slice(start, end) for start, end in zip(offsets[:-1], offsets[1:])]
+    marginalization_indices = [(dims[s], np.concatenate([dims[:s.start], dims[s.stop:]])) for s in slices]
+    return slices, marginalization_indices
 
 
 class FactorNode:
     __doc__ = "Factor node modelling the dependencies between variable nodes as a gaussian distribution."
-    idx_counter = 0
+    __slots__ = ("idx", "adj_variable_nodes", "measurement_fn", "measurement_noise", "measurement_noise_lam",
+                 "noise_whitening", "robust_kernel", "adaptive_measurement_noise_lam", "measurement", "jacobian_fn",
+                 "args", "adj_variable_messages", "messages_to_adj_variables", "linearization_point", "huber_energy",
+                 "huber_mahalanobis_threshold", "linear", "constant_jacobian", "relinearization_threshold",
+                 "jacobian", "predicted_measurement", "prediction_point", "base_damping", "damping",
+                 "adaptive_damping", "message_change", "num_sent_messages", "number_of_conditional_variables",
+                 "variable_slices", "marginalization_indices", "factor_eta", "factor_lam")
 
     def __init__(self, adj_variable_nodes: List[VariableNode],
-                 measurement_fn: Callable[[List[np.matrix], Any], np.matrix],
-                 measurement_noise: np.matrix,
-                 measurement: Union[np.matrix, float],
-                 jacobian_fn: Callable[[List[np.matrix], Any], np.matrix],
+                 measurement_fn: Callable[[List[np.ndarray], Any], np.ndarray],
+                 measurement_noise: np.ndarray,
+                 measurement: Union[np.ndarray, float],
+                 jacobian_fn: Callable[[List[np.ndarray], Any], np.ndarray],
                  huber_energy: bool,
-                 args: Any):
+                 args: Any,
+                 linear: bool = False,
+                 constant_jacobian: bool = False,
+                 relinearization_threshold: float = 0.,
+                 huber_mahalanobis_threshold: float = 0.1,
+                 damping: float = 0.,
+                 adaptive_damping: bool = False,
+                 robust_kernel: RobustKernel = None,
+                 measurement_precision: np.ndarray = None):
         """
         Initialize internal variables & adds itself to all adjacent variable nodes
         :param adj_variable_nodes: all variable nodes, which are adjacent to this factor node
-        :param measurement_fn: the measurement function
+        :param measurement_fn: the measurement function, gets the means of the adjacent variables as flat arrays
         :param measurement_noise: gaussian covariance matrix representing measurement noise
         :param measurement: the actual measurement
         :param jacobian_fn: the jacobian of the measurement function
         :param args: any additional args for the measurement/jacobian function
-        """
-        self.idx = FactorNode.idx_counter
-        FactorNode.idx_counter += 1
-        self.adj_variable_node_idxs = [v.idx for v in adj_variable_nodes]
+        :param linear: the measurement function is linear, so the factor does not depend on the linearization point
+                       (only the adaptive noise does)
+        :param constant_jacobian: the jacobian does not depend on the linearization point (implied by linear)
+        :param relinearization_threshold: relinearize only if the mean of an adjacent variable moved further
+        :param huber_energy: use a HuberKernel, if no robust kernel is given
+        :param huber_mahalanobis_threshold: mahalanobis distance, where the huber energy becomes linear
+        :param damping: weight of the previous message in the outgoing messages, 0 disables damping
+        :param adaptive_damping: increase the damping while the outgoing messages change more from iteration to
+                                 iteration (oscillation) and decrease it towards damping otherwise
+        :param robust_kernel: robust energy of the residual (see RobustKernels), replaces huber_energy
+        :param measurement_precision: the inverse of measurement_noise, if it is known already (e.g. a marginal), so
+                                      it is used as it is
+        """
+        self.idx = None  # position within the factor graph, assigned by the FactorGraph
+        self.adj_variable_nodes = adj_variable_nodes
         self.measurement_fn = measurement_fn
-        self.measurement_noise = measurement_noise
-        self.adaptive_measurement_noise_lam = np.linalg.inv(self.measurement_noise)
-        self.measurement = measurement
+        self.measurement_noise = np.atleast_2d(np.asarray(measurement_noise))
+        # factorized once, the adaptive noise only rescales the precision
+        if measurement_precision is None:
+            self.measurement_noise_lam, self.noise_whitening = whiten_noise(self.measurement_noise)
+        else:
+            self.measurement_noise_lam, self.noise_whitening = whiten_precision(measurement_precision)
+        self.adaptive_measurement_noise_lam = self.measurement_noise_lam
+        self.measurement = np.asarray(measurement, dtype=float).ravel()
         self.jacobian_fn = jacobian_fn
         self.args = args
-        self.adj_variable_messages = {}
-        self.messages_to_adj_variables = {}
+        self.adj_variable_messages = []  # variable to factor message of each adjacent variable
+        self.messages_to_adj_variables = []  # factor to variable message of each adjacent variable
         self.linearization_point = []
-        self.variable_nodes = []  # will be set by the FactorGraph at the end
         self.huber_energy = huber_energy
-        self.huber_mahalanobis_threshold = 0.1
+        self.huber_mahalanobis_threshold = huber_mahalanobis_threshold
+        if robust_kernel is None and huber_energy:
+            robust_kernel = HuberKernel(huber_mahalanobis_threshold)
+        self.robust_kernel = robust_kernel
+        self.linear = linear
+        self.constant_jacobian = constant_jacobian or linear
+        self.relinearization_threshold = relinearization_threshold
+        self.jacobian = None  # cached if constant
+        self.predicted_measurement = None  # memoized for the linearization point below
+        self.prediction_point = None
+        self.base_damping = damping
+        self.damping = damping
+        self.adaptive_damping = adaptive_damping
+        self.message_change = np.inf  # change of the undamped outgoing messages in the last iteration
+        self.num_sent_messages = 0  # the first messages are not damped, as there is no previous message
 
-        self.number_of_conditional_variables = 0
         for variable_node in adj_variable_nodes:
-            variable_node.adj_factors_idx.append(self.idx)  # bind factor to variable
-            self.number_of_conditional_variables += variable_node.dimensions
-            self.adj_variable_messages[variable_node.idx] = deepcopy(variable_node.belief)
-            self.messages_to_adj_variables[variable_node.idx] = GaussianState(variable_node.dimensions)
-            self.linearization_point.append(np.zeros_like(variable_node.belief.eta))
+            d = variable_node.dimensions
+            to_factor = Message(variable_node.belief.eta.copy(), variable_node.belief.lam.copy())
+            to_variable = Message(np.zeros(d), np.zeros([d, d]))
+            self.adj_variable_messages.append(to_factor)
+            self.messages_to_adj_variables.append(to_variable)
+            # bind factor to variable
+            variable_node.adj_factors.append(self)
+            variable_node.messages_from_factors.append(to_variable)
+            variable_node.messages_to_factors.append(to_factor)
+            self.linearization_point.append(np.zeros(d))
+        self.variable_slices, self.marginalization_indices = factor_layout(
+            tuple(v.dimensions for v in adj_variable_nodes))
+        self.number_of_conditional_variables = self.variable_slices[-1].stop if self.variable_slices else 0
 
         self.factor_eta = None
         self.factor_lam = None
         self.relinearize()
-        self.compute_factor()
 
-    def receive_message_from(self, variable_idx: int, eta_message: np.matrix, lam_message: np.matrix):
+    @property
+    def adj_variable_node_idxs(self) -> List[int]:
+        """
+        Idxs of the adjacent variable nodes within the factor graph
+        """
+        return [v.idx for v in self.adj_variable_nodes]
+
+    def receive_message_from(self, slot: int, eta_message: np.ndarray, lam_message: np.ndarray):
         """
-        Stores the new variable to factor message for the next iteration
-        :param variable_idx: the idx of the variable where the message originated from
+        Stores (copies) the new variable to factor message for the next iteration
+        :param slot: position of the variable where the message originated from within the adjacent variables
         :param eta_message: the eta part of the message
         :param lam_message: the lambda part of the message
         """
-        self.adj_variable_messages[variable_idx].lam = lam_message.copy()
-        self.adj_variable_messages[variable_idx].eta = eta_message.copy()
+        self.adj_variable_messages[slot].set(eta_message, lam_message)
 
-    def get_message_for(self, variable_node_idx: int):
+    def get_message_for(self, slot: int):
         """
-        Simple getter function to retrieve the correct message for a given variable node
-        :param variable_node_idx: idx of variable, which message should be returned
+        Simple getter function to retrieve the correct message for a given variable node (not copied, read only)
+        :param slot: position of the variable within the adjacent variables
         :return: eta_message and lam_message
         """
-        return self.messages_to_adj_variables[variable_node_idx].eta.copy(), \
-               self.messages_to_adj_variables[variable_node_idx].lam.copy()
+        message = self.messages_to_adj_variables[slot]
+        return message.eta, message.lam
 
     def relinearize(self):
         """
         Calculates a new mean of adjacent variables, if possible. This used as the new linearization point.
         """
         linearization_point = []
-        for belief in self.adj_variable_messages.values():
-            if np.linalg.det(belief.lam) != 0:  # if possible relinearize
-                mean = belief.eta @ np.linalg.inv(belief.lam)
-                linearization_point.append(mean)  # Linearize around mean of adj. vars
-            else:
-                linearization_point.append(np.array([0.]))
+        for belief in self.adj_variable_messages:
+            try:  # if possible relinearize
+                linearization_point.append(solve_spd(belief.lam, belief.eta))  # Linearize around mean of adj. vars
+            except NotPositiveDefiniteError:
+                linearization_point.append(np.zeros_like(belief.eta))
+
+        if self.factor_eta is not None:  # lazy relinearization, if the factor was computed already
+            if self.linear and self.robust_kernel is None:
+                return  # factor is the same for every linearization point
+            if self.linearization_moved_by(linearization_point) <= self.relinearization_threshold:
+                return
+        if counters.active:
+            counters.add("relinearizations")
         self.linearization_point = linearization_point
         self.compute_adaptive_noise()
         self.compute_factor()
 
-    def compute_adaptive_noise(self):
+    def linearization_moved_by(self, linearization_point: List[np.ndarray]) -> float:
         """
-        Computes the adaptive measurement noise if enabled
+        Computes how far the mean of any adjacent variable moved compared to the current linearization point
+        :param linearization_point: new linearization point
+        :return: the largest distance
         """
-        if self.huber_energy:
-            predicted_measurement = self.measurement_fn(self.linearization_point, *self.args)
-            res = self.measurement.T - predicted_measurement
+        return max(np.linalg.norm(new - old) for new, old in zip(linearization_point, self.linearization_point))
 
-            mahalanobis_dist = np.asscalar(np.sqrt(res @ np.linalg.inv(self.measurement_noise) @ res.T))
-            if mahalanobis_dist > self.huber_mahalanobis_threshold:
-                self.adaptive_measurement_noise_lam = np.linalg.inv(
-                    self.measurement_noise * np.square(mahalanobis_dist) / (2 * (
-                            self.huber_mahalanobis_threshold * mahalanobis_dist - 0.5 * np.square(
-                        self.huber_mahalanobis_threshold))))
-            else:
-                self.adaptive_measurement_noise_lam = np.linalg.inv(self.measurement_noise)
-        else:
-            self.adaptive_measurement_noise_lam = np.linalg.inv(self.measurement_noise)
+    def compute_jacobian(self):
+        """
+        Evaluates the jacobian at the linearization point, only once if it is constant
+        """
+        if self.jacobian is None or not self.constant_jacobian:
+            self.jacobian = np.atleast_2d(np.asarray(self.jacobian_fn(self.linearization_point, *self.args)))
+        return self.jacobian
+
+    def predict_measurement(self):
+        """
+        Evaluates the measurement function at the linearization point.
+        The result is memoized until a new linearization point (list) is assigned.
+        """
+        if self.prediction_point is not self.linearization_point:
+            self.predicted_measurement = np.asarray(self.measurement_fn(self.linearization_point, *self.args)).ravel()
+            self.prediction_point = self.linearization_point
+        return self.predicted_measurement
+
+    def compute_adaptive_noise(self):
+        """
+        Computes the adaptive measurement noise if a robust kernel is used: the precision of the measurement noise
+        is scaled, so the quadratic energy matches the robust energy of the current residual
+        """
+        if self.robust_kernel is None:
+            self.adaptive_measurement_noise_lam = self.measurement_noise_lam
+            return
+        res = self.measurement - self.predict_measurement()
+        scale = self.robust_kernel.precision_scale(mahalanobis(res, self.noise_whitening))
+        self.adaptive_measurement_noise_lam = self.measurement_noise_lam * scale
 
     def compute_factor(self):
         """
         Computes the factor of the factor node.
         Should be called, when the linearization point changes.
         """
-        jacobian = self.jacobian_fn(self.linearization_point, *self.args)
-        predicted_measurement = self.measurement_fn(self.linearization_point, *self.args)
+        jacobian = self.compute_jacobian()
+        predicted_measurement = self.predict_measurement()
 
         self.factor_eta = jacobian.T @ self.adaptive_measurement_noise_lam @ (
-                self.measurement - (
-                predicted_measurement.T - (jacobian @ np.matrix(np.array(self.linearization_point).flatten()).T)))
-        self.factor_eta = self.factor_eta.flatten()
+                self.measurement - (predicted_measurement - jacobian @ np.concatenate(self.linearization_point)))
 
         self.factor_lam = jacobian.T @ self.adaptive_measurement_noise_lam @ jacobian
 
@@ -229,100 +372,635 @@ class FactorNode:
 
         See this blog post Appendix B for the equations: https://gaussianbp.github.io/
         """
-        current_variable_position = 0
-        for variable_node_idx in self.adj_variable_node_idxs:
-            variable_node = self.variable_nodes[variable_node_idx]
+        new_messages = []
+        for slot, (keep, rest) in enumerate(self.marginalization_indices):
             eta_factor, lam_factor = self.factor_eta.copy(), self.factor_lam.copy()
 
             # For every node take the product of factor and incoming messages
-            current_factor_position = 0
-            for other_variable_idx in self.adj_variable_node_idxs:
-                other_variables = self.variable_nodes[other_variable_idx]
-                if variable_node_idx != other_variable_idx:
-                    start = current_factor_position
-                    end = current_factor_position + other_variables.dimensions
-                    eta_factor[:, start:end] += self.adj_variable_messages[other_variables.idx].eta
-                    lam_factor[start:end, start:end] += self.adj_variable_messages[other_variables.idx].lam
-                current_factor_position += other_variables.dimensions
-
-            # Marginalization to variable node
-            # - First "reorder" variable_nodes's (short a) elements to the top
-            cur_dims = variable_node.dimensions
-            start = current_variable_position
-            end = current_variable_position + cur_dims
-            eta_a = eta_factor[:, start:end]  # information vector of variable_node
-            eta_b = np.block([eta_factor[:, :start], eta_factor[:, end:]])  # information vector of the rest
-
-            lam_aa = lam_factor[start:end, start:end]
-            lam_ab = np.hstack((lam_factor[start:end, :start], lam_factor[start:end, end:]))
-            lam_ba = np.vstack((lam_factor[:start, start:end], lam_factor[end:, start:end]))
-            lam_bb = np.block([[lam_factor[:start, :start], lam_factor[:start, end:]],
-                               [lam_factor[end:, :start], lam_factor[end:, end:]]])
-
-            # - Then marginalize according to https://ieeexplore.ieee.org/document/4020357
-            new_message_eta = eta_a - (lam_ab @ np.linalg.inv(lam_bb) @ eta_b.T).T
-            new_message_lam = lam_aa - lam_ab @ np.linalg.inv(lam_bb) @ lam_ba
+            for other_slot, (message, other_slice) in enumerate(zip(self.adj_variable_messages,
+                                                                    self.variable_slices)):
+                if slot != other_slot:
+                    eta_factor[other_slice] += message.eta
+                    lam_factor[other_slice, other_slice] += message.lam
+
+            # Marginalization to variable node (schur complement of all other variables)
+            new_message_eta, new_message_lam = marginalize(eta_factor, lam_factor, keep, rest)
 
             # Ensure that matrix is positive-semi-definite
             new_message_lam = (new_message_lam + new_message_lam.T) / 2.
             new_message_lam += np.identity(new_message_lam.shape[0]) * 1e-6
 
-            self.messages_to_adj_variables[variable_node_idx].eta = new_message_eta
-            self.messages_to_adj_variables[variable_node_idx].lam = new_message_lam
+            new_messages.append((new_message_eta, new_message_lam))
+
+        if self.adaptive_damping:
+            self.update_damping(new_messages)
+        damping = self.damping if self.num_sent_messages > 0 else 0.
+        for message, (new_message_eta, new_message_lam) in zip(self.messages_to_adj_variables, new_messages):
+            if damping > 0:
+                new_message_eta = (1. - damping) * new_message_eta + damping * message.eta
+                new_message_lam = (1. - damping) * new_message_lam + damping * message.lam
+            message.set(new_message_eta, new_message_lam)
+        self.num_sent_messages += 1
 
-            current_variable_position += variable_node.dimensions
+    def update_damping(self, new_messages: List[Tuple[np.ndarray, np.ndarray]]):
+        """
+        Adapts the damping to the change of the undamped messages: if the messages change more than in the last
+        iteration the damping is increased (up to MAX_DAMPING), otherwise it is halved towards the base damping.
+        :param new_messages: undamped (eta, lam) messages for all adjacent variables
+        """
+        change = np.sqrt(sum(np.sum(np.square(eta - message.eta))
+                             for message, (eta, _) in zip(self.messages_to_adj_variables, new_messages)))
+        if self.num_sent_messages > 1 and change > self.message_change:
+            self.damping = min(MAX_DAMPING, self.damping + DAMPING_STEP)
+        else:
+            self.damping = self.base_damping + (self.damping - self.base_damping) / 2.
+        self.message_change = change
+
+
+class EdgeTable:
+    __doc__ = "All (factor, variable) edges of a factor graph. The messages along the edges are stored in flat " \
+              "buffers, edge e owns the block at eta_offset[e] (lam_offset[e] for the flattened precision). " \
+              "The edges are ordered like the factors, removed factors leave unused blocks until the next compaction."
+    __slots__ = ("factor", "variable", "slot", "eta_offset", "lam_offset", "eta_size", "lam_size", "unused_eta",
+                 "to_factor_eta", "to_factor_lam", "to_variable_eta", "to_variable_lam")
+
+    def __init__(self, factor_nodes: List[FactorNode]):
+        """
+        Numbers the edges factor by factor in the order of the adjacent variables (so the edges of a factor are
+        contiguous) and moves the messages of all factors into the buffers
+        :param factor_nodes: all factor nodes of the graph, the idxs have to be assigned already
+        """
+        self.compact(factor_nodes)
+
+    def __len__(self):
+        return self.factor.shape[0]
+
+    def compact(self, factor_nodes: List[FactorNode], capacity: float = 1.):
+        """
+        Rebuilds the table with new buffers without unused blocks and moves the messages of all factors into them
+        :param factor_nodes: all factor nodes of the graph, the idxs have to be assigned already
+        :param capacity: size of the buffers relative to the used size, the rest is reserved for added factors
+        """
+        self._set_layout(factor_nodes)
+        self.to_factor_eta = np.zeros(int(capacity * self.eta_size))
+        self.to_factor_lam = np.zeros(int(capacity * self.lam_size))
+        self.to_variable_eta = np.zeros(int(capacity * self.eta_size))
+        self.to_variable_lam = np.zeros(int(capacity * self.lam_size))
+        self.bind_messages(factor_nodes)
+
+    def _set_layout(self, factor_nodes: List[FactorNode]):
+        """
+        Numbers the edges of the given factors and places their blocks one after another
+        """
+        edges = np.array([(f.idx, v.idx, slot, v.dimensions) for f in factor_nodes
+                          for slot, v in enumerate(f.adj_variable_nodes)], dtype=int).reshape(-1, 4)
+        self.factor, self.variable, self.slot, dims = (column.copy() for column in edges.T)
+        self.eta_offset = np.cumsum(dims) - dims
+        self.lam_offset = np.cumsum(np.square(dims)) - np.square(dims)
+        self.eta_size = int(np.sum(dims))
+        self.lam_size = int(np.sum(np.square(dims)))
+        self.unused_eta = 0
+
+    @classmethod
+    def from_buffers(cls, factor_nodes: List[FactorNode], to_factor_eta: np.ndarray, to_factor_lam: np.ndarray,
+                     to_variable_eta: np.ndarray, to_variable_lam: np.ndarray) -> "EdgeTable":
+        """
+        Compact table adopting the given buffers (e.g. of a checkpoint), which hold the messages in the order of the
+        edges. The messages of the factors are created as views into the buffers, nothing is copied.
+        :param factor_nodes: all factor nodes of the graph without messages, the idxs have to be assigned already
+        :return: the edge table
+        """
+        table = cls.__new__(cls)
+        table._set_layout(factor_nodes)
+        table.to_factor_eta, table.to_factor_lam = to_factor_eta, to_factor_lam
+        table.to_variable_eta, table.to_variable_lam = to_variable_eta, to_variable_lam
+        to_factor = table._views(to_factor_eta, to_factor_lam)
+        to_variable = table._views(to_variable_eta, to_variable_lam)
+        edge = 0
+        for f in factor_nodes:
+            arity = len(f.adj_variable_nodes)
+            f.adj_variable_messages = [Message(*views) for views in to_factor[edge:edge + arity]]
+            f.messages_to_adj_variables = [Message(*views) for views in to_variable[edge:edge + arity]]
+            edge += arity
+        return table
+
+    def _views(self, eta_buffer: np.ndarray, lam_buffer: np.ndarray) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Views of the blocks of all edges into the given buffers
+        """
+        dims = np.diff(np.append(self.eta_offset, self.eta_size))
+        if len(dims) > 0 and np.all(dims == dims[0]):  # one reshape instead of a slice per edge
+            d, num_edges = int(dims[0]), len(dims)
+            return list(zip(eta_buffer[:num_edges * d].reshape(num_edges, d),
+                            lam_buffer[:num_edges * d * d].reshape(num_edges, d, d)))
+        return [(eta_buffer[eta_offset:eta_offset + d], lam_buffer[lam_offset:lam_offset + d * d].reshape(d, d))
+                for eta_offset, lam_offset, d in zip(self.eta_offset.tolist(), self.lam_offset.tolist(),
+                                                     dims.tolist())]
+
+    def bind_messages(self, factor_nodes: List[FactorNode]):
+        """
+        Copies the messages of all factors into the buffers and replaces their arrays by views into the buffers
+        :param factor_nodes: the factor nodes in the order of the edges
+        """
+        for f, edge in zip(factor_nodes, np.searchsorted(self.factor, [f.idx for f in factor_nodes]).tolist()):
+            self._bind_factor(f, edge)
+
+    def _bind_factor(self, factor: FactorNode, first_edge: int):
+        """
+        Moves the messages of a single factor into the blocks of its edges
+        """
+        offsets = zip(self.eta_offset[first_edge:first_edge + len(factor.adj_variable_messages)].tolist(),
+                      self.lam_offset[first_edge:first_edge + len(factor.adj_variable_messages)].tolist())
+        for to_factor, to_variable, (eta_offset, lam_offset) in zip(factor.adj_variable_messages,
+                                                                    factor.messages_to_adj_variables, offsets):
+            d = to_factor.eta.shape[0]
+            for message, eta_buffer, lam_buffer in ((to_factor, self.to_factor_eta, self.to_factor_lam),
+                                                    (to_variable, self.to_variable_eta, self.to_variable_lam)):
+                eta = eta_buffer[eta_offset:eta_offset + d]
+                lam = lam_buffer[lam_offset:lam_offset + d * d].reshape(d, d)
+                eta[...] = message.eta
+                lam[...] = message.lam
+                message.eta, message.lam = eta, lam
+
+    def add_factor(self, factor_nodes: List[FactorNode], factor: FactorNode):
+        """
+        Appends the edges of a factor, which was appended to the factor nodes. Its messages are moved into the
+        reserved part of the buffers, only if that is too small all buffers are reallocated (with twice the size).
+        :param factor_nodes: all factor nodes of the graph including the new one
+        :param factor: the new factor node
+        """
+        dims = np.array([v.dimensions for v in factor.adj_variable_nodes], dtype=int)
+        if self.eta_size + np.sum(dims) > self.to_factor_eta.shape[0] or \
+                self.lam_size + np.sum(np.square(dims)) > self.to_factor_lam.shape[0]:
+            self.compact(factor_nodes, capacity=2.)
+            return
+        first_edge = len(self)
+        self.factor = np.append(self.factor, np.full(dims.shape[0], factor.idx))
+        self.variable = np.append(self.variable, [v.idx for v in factor.adj_variable_nodes])
+        self.slot = np.append(self.slot, np.arange(dims.shape[0]))
+        self.eta_offset = np.append(self.eta_offset, self.eta_size + np.cumsum(dims) - dims)
+        self.lam_offset = np.append(self.lam_offset, self.lam_size + np.cumsum(np.square(dims)) - np.square(dims))
+        self.eta_size += int(np.sum(dims))
+        self.lam_size += int(np.sum(np.square(dims)))
+        self._bind_factor(factor, first_edge)
+
+    def remove_factor(self, factor_nodes: List[FactorNode], factor: FactorNode, factor_idx: int):
+        """
+        Removes the edges of a factor, which was removed from the factor nodes (the following factors moved up by
+        one). The messages of the factor get their own arrays again, its blocks stay unused until the unused part
+        of the buffers is larger than the used one.
+        :param factor_nodes: all remaining factor nodes of the graph
+        :param factor: the removed factor node
+        :param factor_idx: the idx of the factor before it was removed
+        """
+        for message in factor.adj_variable_messages + factor.messages_to_adj_variables:
+            message.eta, message.lam = message.eta.copy(), message.lam.copy()
+        keep = self.factor != factor_idx
+        self.unused_eta += sum(v.dimensions for v in factor.adj_variable_nodes)
+        self.factor, self.variable, self.slot = self.factor[keep], self.variable[keep], self.slot[keep]
+        self.eta_offset, self.lam_offset = self.eta_offset[keep], self.lam_offset[keep]
+        self.factor[self.factor > factor_idx] -= 1
+        if 2 * self.unused_eta > self.eta_size:
+            self.compact(factor_nodes, capacity=2.)
+
+    def move_variables(self, first_idx: int, shift: int):
+        """
+        Updates the variable idxs of all edges after a variable was inserted (shift 1) or removed (shift -1)
+        :param first_idx: all idxs from this one on (before the change) are shifted
+        :param shift: change of the idxs
+        """
+        self.variable[self.variable >= first_idx] += shift
+
+
+_thread_pools: Dict[int, ThreadPoolExecutor] = {}  # shared between all factor graphs, as they are rebuilt often
+
+
+def get_thread_pool(num_threads: int) -> ThreadPoolExecutor:
+    """
+    Returns the shared thread pool with the given number of threads
+    """
+    if num_threads not in _thread_pools:
+        _thread_pools[num_threads] = ThreadPoolExecutor(num_threads, thread_name_prefix="gbp")
+    return _thread_pools[num_threads]
+
+
+def prior_factor(means: List[np.ndarray]) -> np.ndarray:
+    """
+    Measurement function of a linear prior on the stacked means of its variables, see marginalize_variables
+    """
+    return np.concatenate(means)
+
+
+def prior_factor_jac(means: List[np.ndarray]) -> np.ndarray:
+    return np.identity(sum(mean.shape[0] for mean in means))
+
+
+class BeliefSnapshot:
+    __doc__ = "Gaussian states of many variables of the same dimensionality in canonical form, stacked into (N, D) " \
+              "eta and (N, D, D) lam. The moment form is only computed on request, with one batched inversion."
+
+    def __init__(self, eta: np.ndarray, lam: np.ndarray):
+        """
+        :param eta: information vectors of shape (N, D)
+        :param lam: precision matrices of shape (N, D, D)
+        """
+        self.eta = eta
+        self.lam = lam
+        self._covariances = None
+        self._means = None
+
+    def __len__(self):
+        return len(self.eta)
+
+    @property
+    def covariances(self) -> np.ndarray:
+        """
+        (N, D, D) covariances, computed on the first access
+        :raises NotPositiveDefiniteError: if any precision matrix is not positive definite
+        """
+        if self._covariances is None:
+            self._covariances = inv_spd(self.lam)
+        return self._covariances
+
+    @property
+    def means(self) -> np.ndarray:
+        """
+        (N, D) means, computed with the covariances on the first access
+        :raises NotPositiveDefiniteError: if any precision matrix is not positive definite
+        """
+        if self._means is None:
+            self._means = (self.covariances @ self.eta[..., None])[..., 0]
+        return self._means
 
 
 class FactorGraph:
     __doc__ = "Orchestrate the gaussian belief propagation algorithm."
 
-    def __init__(self, variable_nodes: List[VariableNode], factor_nodes: List[FactorNode]):
+    def __init__(self, variable_nodes: List[VariableNode], factor_nodes: List[FactorNode], num_threads: int = 1,
+                 chunk_size: int = 64, accelerator: Any = None, tracer: Tracer = None, edges: EdgeTable = None):
+        """
+        Assigns the idxs of all nodes (their position in the given lists) and moves all messages into the edge table.
+        A node can only be part of one factor graph at a time.
+        :param variable_nodes: all variable nodes of the graph
+        :param factor_nodes: all factor nodes of the graph
+        :param num_threads: if larger than one, the nodes of each phase of an iteration are updated in parallel
+        :param chunk_size: number of nodes updated per task of the thread pool
+        :param accelerator: optional extrapolation of the messages of each iteration, see Accelerators
+        :param tracer: optional trace of the phases of every iteration and fit, see Tracing
+        :param edges: edge table holding the messages of the given factors already (e.g. restored from a checkpoint)
+        """
         self.variable_nodes = variable_nodes
         self.factor_nodes = factor_nodes
-        for v in self.variable_nodes:
-            v.factor_nodes = self.factor_nodes
+        for idx, v in enumerate(self.variable_nodes):
+            v.idx = idx
+        for idx, f in enumerate(self.factor_nodes):
+            f.idx = idx
         for f in self.factor_nodes:
-            f.variable_nodes = self.variable_nodes
+            self._check_variables_of(f)
+        for v in self.variable_nodes:
+            if any(not self._contains_factor(f) for f in v.adj_factors):
+                raise ValueError("Variable node " + str(v.idx) + " is adjacent to a factor node, which is not part of "
+                                 "the factor graph (see VariableNode.clear_factors)")
+        self.edges = EdgeTable(self.factor_nodes) if edges is None else edges
+        self.num_threads = num_threads
+        self.chunk_size = chunk_size
+        self.accelerator = accelerator
+        self.tracer = tracer
+        if self.accelerator is not None:
+            self.accelerator.reset()  # the history of a previous graph is meaningless for this one
+
+    def __setstate__(self, state: Dict[str, Any]):
+        self.__dict__.update(state)
+        self.edges.bind_messages(self.factor_nodes)  # pickling copies the views, reconnect them to the buffers
+
+    def _contains_variable(self, variable_node: VariableNode) -> bool:
+        idx = variable_node.idx
+        return idx is not None and idx < len(self.variable_nodes) and self.variable_nodes[idx] is variable_node
+
+    def _contains_factor(self, factor_node: FactorNode) -> bool:
+        idx = factor_node.idx
+        return idx is not None and idx < len(self.factor_nodes) and self.factor_nodes[idx] is factor_node
+
+    def _check_variables_of(self, factor_node: FactorNode):
+        if not all(self._contains_variable(v) for v in factor_node.adj_variable_nodes):
+            raise ValueError("Factor node " + str(factor_node.idx) + " is adjacent to a variable node, which is not "
+                             "part of the factor graph")
+
+    def _topology_changed(self):
+        if self.accelerator is not None:
+            self.accelerator.reset()
+
+    # The following operations change the graph in place. Only the nodes and edges next to the change are touched,
+    # all other factors keep their linearization and messages. Nodes after the change are renumbered.
+
+    def add_variable(self, variable_node: VariableNode, position: int = None) -> VariableNode:
+        """
+        Adds a variable node without factors, create and add its factors afterwards (see add_factor)
+        :param variable_node: the new variable node
+        :param position: position within the variable nodes (default: at the end)
+        :return: the added variable node
+        """
+        if variable_node.adj_factors:
+            raise ValueError("The new variable node is already adjacent to factor nodes")
+        position = len(self.variable_nodes) if position is None else position
+        self.variable_nodes.insert(position, variable_node)
+        for idx in range(position, len(self.variable_nodes)):
+            self.variable_nodes[idx].idx = idx
+        self.edges.move_variables(position, 1)
+        return variable_node
+
+    def remove_variable(self, variable_node: VariableNode) -> List[FactorNode]:
+        """
+        Removes a variable node together with all its factors
+        :param variable_node: a variable node of the graph
+        :return: the removed factors
+        """
+        if not self._contains_variable(variable_node):
+            raise ValueError("The variable node is not part of the factor graph")
+        removed_factors = list(variable_node.adj_factors)
+        for f in removed_factors:
+            self.remove_factor(f)
+        position = variable_node.idx
+        del self.variable_nodes[position]
+        for idx in range(position, len(self.variable_nodes)):
+            self.variable_nodes[idx].idx = idx
+        self.edges.move_variables(position + 1, -1)
+        variable_node.idx = None
+        return removed_factors
+
+    def insert_between(self, left: VariableNode, right: VariableNode, variable_node: VariableNode) -> List[FactorNode]:
+        """
+        Adds a variable node between two neighbouring variable nodes (e.g. of a contour) and removes all factors,
+        which connect the two, as they do not connect neighbours anymore. Add the new factors afterwards.
+        :param left: a variable node of the graph
+        :param right: the variable node following left
+        :param variable_node: the new variable node
+        :return: the removed factors
+        """
+        if not (self._contains_variable(left) and self._contains_variable(right) and right.idx == left.idx + 1):
+            raise ValueError("Can only insert between two following variable nodes of the factor graph")
+        removed_factors = [f for f in left.adj_factors if any(v is right for v in f.adj_variable_nodes)]
+        for f in removed_factors:
+            self.remove_factor(f)
+        self.add_variable(variable_node, right.idx)
+        return removed_factors
+
+    def add_factor(self, factor_node: FactorNode) -> FactorNode:
+        """
+        Adds a new factor node. Its adjacent variables have to be part of the graph already.
+        :param factor_node: the new factor node, created with variable nodes of the graph
+        :return: the added factor node
+        """
+        factor_node.idx = len(self.factor_nodes)
+        self._check_variables_of(factor_node)
+        self.factor_nodes.append(factor_node)
+        self.edges.add_factor(self.factor_nodes, factor_node)
+        self._topology_changed()
+        return factor_node
+
+    def remove_factor(self, factor_node: FactorNode):
+        """
+        Removes a factor node and its messages from the graph and its adjacent variables
+        :param factor_node: a factor node of the graph
+        """
+        if not self._contains_factor(factor_node):
+            raise ValueError("The factor node is not part of the factor graph")
+        for v in factor_node.adj_variable_nodes:
+            k = next(k for k, f in enumerate(v.adj_factors) if f is factor_node)
+            del v.adj_factors[k], v.messages_from_factors[k], v.messages_to_factors[k]
+        position = factor_node.idx
+        del self.factor_nodes[position]
+        for idx in range(position, len(self.factor_nodes)):
+            self.factor_nodes[idx].idx = idx
+        self.edges.remove_factor(self.factor_nodes, factor_node, position)
+        factor_node.idx = None
+        self._topology_changed()
+
+    def marginalize_variables(self, variable_nodes: List[VariableNode]) -> Union[FactorNode, None]:
+        """
+        Removes variable nodes and marginalizes them into one prior factor on their markov blanket (the remaining
+        variables adjacent to their factors). The joint of the priors of the removed variables and all their factors
+        (linearized at the current linearization points) is marginalized with the schur complement, all these
+        factors are removed.
+        :param variable_nodes: variable nodes of the graph
+        :return: the added prior factor, None if the variables are not connected to the rest of the graph
+        """
+        removed = {id(v) for v in variable_nodes}
+        factors = list({id(f): f for v in variable_nodes for f in v.adj_factors}.values())
+        blanket = list({id(v): v for f in factors for v in f.adj_variable_nodes if id(v) not in removed}.values())
+
+        # joint in canonical form, the blanket first
+        offsets = {}
+        size = 0
+        for v in blanket + list(variable_nodes):
+            offsets[id(v)] = size
+            size += v.dimensions
+        eta, lam = np.zeros(size), np.zeros([size, size])
+        for v in variable_nodes:
+            block = slice(offsets[id(v)], offsets[id(v)] + v.dimensions)
+            eta[block] += v.prior.eta
+            lam[block, block] += v.prior.lam
+        for f in factors:
+            idxs = np.concatenate([np.arange(offsets[id(v)], offsets[id(v)] + v.dimensions)
+                                   for v in f.adj_variable_nodes])
+            eta[idxs] += f.factor_eta
+            lam[idxs[:, None], idxs[None, :]] += f.factor_lam
+        blanket_size = sum(v.dimensions for v in blanket)
+        eta, lam = marginalize(eta, lam, np.arange(blanket_size), np.arange(blanket_size, size))
+
+        for v in variable_nodes:
+            self.remove_variable(v)
+        if not blanket:
+            return None
+        # The factors are regularized already (see FactorNode.compute_factor), so the joint and its marginal are
+        # positive definite. The prior factor is regularized once more by compute_factor, like every factor.
+        lam = (lam + lam.T) / 2.
+        covariance = inv_spd(lam)
+        return self.add_factor(FactorNode(blanket, prior_factor, covariance, covariance @ eta, prior_factor_jac,
+                                          False, [], linear=True, measurement_precision=lam))
+
+    def _for_each(self, nodes: list, update: Callable[[Any], None]):
+        """
+        Calls update for all nodes, in parallel chunks if multiple threads are configured.
+        Within one phase every node only writes its own state (and its own slot of the messages),
+        so the result does not depend on the order of execution.
+        """
+        if self.num_threads <= 1 or len(nodes) <= self.chunk_size:
+            for node in nodes:
+                update(node)
+            return
+
+        def update_chunk(start: int):
+            for node in nodes[start:start + self.chunk_size]:
+                update(node)
+
+        # Consume the results, so exceptions of the workers are raised here
+        list(get_thread_pool(self.num_threads).map(update_chunk, range(0, len(nodes), self.chunk_size)))
 
     def compute_all_messages(self):
         """
         Calls all factors to update their outgoing messages
         """
-        for factor_node in self.factor_nodes:
-            factor_node.compute_outgoing_messages()
+        self._for_each(self.factor_nodes, FactorNode.compute_outgoing_messages)
 
     def update_all_beliefs(self):
         """
         Calls all variable nodes to update their belief
         """
-        for variable_node in self.variable_nodes:
-            variable_node.update_belief()
+        self._for_each(self.variable_nodes, VariableNode.update_belief)
 
     def relinearize_factors(self):
         """
         Calculates new linearization points for all factors if possible
         """
-        for factor in self.factor_nodes:
-            factor.relinearize()
+        self._for_each(self.factor_nodes, FactorNode.relinearize)
 
     def synchronous_iteration(self):
         """
         Triggers a single synchronous iteration over all nodes (factor and variable nodes)
         """
+        if self.tracer is not None:
+            self._traced_iteration()
+            return
         self.relinearize_factors()
         self.compute_all_messages()
+        if self.accelerator is not None:
+            self.accelerator.accelerate(self.edges)
         self.update_all_beliefs()
 
-    def fit(self):
-        """
-        Calls synchronous iteration until a convergence criteria is met or
-        """
-        i = 0
-        for i in range(500):
-            prior_means = np.array([v.belief.get_values()[0] for v in self.variable_nodes]).flatten()
-            self.synchronous_iteration()
-            posterior_means = np.array([v.belief.get_values()[0] for v in self.variable_nodes]).flatten()
-            diff = np.linalg.norm(prior_means - posterior_means)
-            if diff < 0.001:
-                break
-        return i
+    def _traced_iteration(self):
+        """
+        Synchronous iteration with a span per phase, see Tracing
+        """
+        tracer = self.tracer
+        edges = self.edges
+        with tracer.span("iteration", variables=len(self.variable_nodes), factors=len(self.factor_nodes),
+                         edges=len(edges)):
+            with tracer.span("relinearize"):
+                self.relinearize_factors()
+            with tracer.span("messages") as messages:
+                if tracer.message_residuals:
+                    previous_eta, previous_lam = edges.to_variable_eta.copy(), edges.to_variable_lam.copy()
+                self.compute_all_messages()
+                if self.accelerator is not None:
+                    self.accelerator.accelerate(edges)
+                if tracer.message_residuals:
+                    messages.set(eta_residual=float(np.linalg.norm(edges.to_variable_eta - previous_eta)),
+                                 lam_residual=float(np.linalg.norm(edges.to_variable_lam - previous_lam)))
+            with tracer.span("beliefs"):
+                self.update_all_beliefs()
+
+    def solve_direct(self, num_relinearizations: int = 0, compute_marginals: bool = True):
+        """
+        Solves the linear(ized) factor graph exactly with one sparse factorization instead of message passing.
+        Needs scipy, see DirectSolver.
+        :param num_relinearizations: number of gauss-newton steps for non-linear factors
+        :param compute_marginals: also compute the marginal covariances of all variables
+        :return: joint mean of all variables
+        """
+        from DirectSolver import DirectSolver
+        return DirectSolver(self).solve(num_relinearizations, compute_marginals)
+
+    def snapshot(self, variable_nodes: List[VariableNode] = None, prior: bool = False) -> BeliefSnapshot:
+        """
+        Stacks the beliefs of variable nodes into one snapshot instead of reading them node by node. The nodes keep
+        their states separately, so the arrays are copies, means and covariances are computed on request only.
+        :param variable_nodes: nodes of the same dimensions (default: all nodes of the graph)
+        :param prior: stack the priors instead of the beliefs
+        :return: snapshot in the order of the nodes
+        """
+        variable_nodes = self.variable_nodes if variable_nodes is None else variable_nodes
+        dims = {v.dimensions for v in variable_nodes}
+        if len(dims) > 1:
+            raise ValueError("A snapshot needs variable nodes of the same dimensions, got " + str(sorted(dims)))
+        d = dims.pop() if dims else 0
+        states = [v.prior if prior else v.belief for v in variable_nodes]
+        eta = np.array([state.eta for state in states], dtype=float).reshape(len(states), d)
+        lam = np.array([state.lam for state in states], dtype=float).reshape(len(states), d, d)
+        return BeliefSnapshot(eta, lam)
+
+    def save(self, path: str):
+        """
+        Writes a checkpoint of the complete state, see Checkpoint.save_checkpoint
+        :param path: a .npz file or a directory of .npy files (can be memory-mapped on load)
+        """
+        from Checkpoint import save_checkpoint
+        save_checkpoint(self, path)
+
+    @staticmethod
+    def load(path: str, mmap: bool = False, **kwargs) -> "FactorGraph":
+        """
+        Restores a factor graph from a checkpoint, see Checkpoint.load_checkpoint
+        :param path: a .npz file or a directory of .npy files written by save
+        :param mmap: memory-map the arrays of a directory checkpoint (copy on write) instead of reading them
+        :param kwargs: runtime arguments of the graph, which are not saved (num_threads, accelerator, tracer, ...)
+        :return: the factor graph
+        """
+        from Checkpoint import load_checkpoint
+        return load_checkpoint(path, mmap, **kwargs)
+
+    def fit(self, max_iterations: int = 500, tolerance: float = 0.001,
+            variable_tolerance: float = None) -> "ConvergenceReport":
+        """
+        Calls synchronous iteration until a convergence criteria is met or the maximum number of iterations is reached.
+        The change of the means is tracked with the means computed by the belief updates.
+        :param max_iterations: maximal number of iterations
+        :param tolerance: converged, if the norm of the change of all means is below
+        :param variable_tolerance: additionally require that the mean of every single variable changed less
+        :return: convergence report
+        """
+        report = ConvergenceReport()
+        with span(self.tracer, "fit") as fit_span:
+            means = []
+            for v in self.variable_nodes:  # only needed once, afterwards the means of the belief update are used
+                try:
+                    means.append(v.belief.get_values()[0])
+                except NotPositiveDefiniteError:
+                    means.append(np.zeros(v.dimensions))
+            previous_means = np.concatenate(means) if means else np.zeros(0)
+            sizes = [v.dimensions for v in self.variable_nodes]
+
+            for i in range(max_iterations):
+                self.synchronous_iteration()
+                posterior_means = np.concatenate([v.mu for v in self.variable_nodes]) if means else np.zeros(0)
+                report.add_iteration(self.variable_nodes, sizes, posterior_means - previous_means, tolerance,
+                                     variable_tolerance)
+                previous_means = posterior_means
+                if report.converged:
+                    break
+            fit_span.set(iterations=report.iterations, converged=bool(report.converged),
+                         residual=float(report.residuals[-1]) if report.residuals else None)
+        return report
+
+
+class ConvergenceReport:
+    __doc__ = "Summary of a call of fit: residuals of every iteration and the variables, which did not converge yet."
+
+    def __init__(self):
+        self.iterations = 0  # number of synchronous iterations
+        self.converged = False
+        self.residuals = []  # norm of the change of all means per iteration
+        self.num_active_variables = []  # number of not converged variables per iteration
+        self.active_variables = []  # idxs of the variables, which still changed in the last iteration
+
+    def add_iteration(self, variable_nodes: List[VariableNode], sizes: List[int], mean_changes: np.ndarray,
+                      tolerance: float, variable_tolerance: float = None):
+        """
+        Adds the result of an iteration and checks the convergence
+        :param variable_nodes: all variable nodes
+        :param sizes: dimensions of each variable
+        :param mean_changes: stacked change of the means of all variables
+        :param tolerance: threshold for the norm of all changes
+        :param variable_tolerance: optional threshold for the change of every single variable
+        """
+        residual = np.linalg.norm(mean_changes)
+        variable_threshold = tolerance if variable_tolerance is None else variable_tolerance
+        squared_changes = np.add.reduceat(np.square(mean_changes), np.cumsum([0] + sizes[:-1])) \
+            if len(sizes) else np.zeros(0)
+        active = np.sqrt(squared_changes) >= variable_threshold
+
+        self.iterations += 1
+        self.residuals.append(residual)
+        self.num_active_variables.append(int(np.sum(active)))
+        self.active_variables = [v.idx for v, is_active in zip(variable_nodes, active) if is_active]
+        self.converged = residual < tolerance and (variable_tolerance is None or not np.any(active))
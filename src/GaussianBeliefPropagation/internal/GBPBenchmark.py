@@ -0,0 +1,257 @@
+import argparse
+import json
+import time
+import tracemalloc
+from typing import List, Dict, Callable, Any
+import numpy as np
+
+from GBP import VariableNode, FactorNode, FactorGraph, ConvergenceReport
+from BatchedGBP import BatchedFactorGraph
+from PartitionedGBP import PartitionedFactorGraph, partition_edge_cut
+from ContourFitting import generate_variable_nodes, generate_measurement_factors, generate_smoothing_factors, \
+    generate_measurement_step, smoothing, smoothing_jac
+from ContourFactors import measurement_factor, measurement_factor_jac
+from AccelerationBenchmark import generate_grid
+
+PHASES = ("relinearize_factors", "compute_all_messages", "update_all_beliefs")
+
+
+# ---------------------------------- Graph generators ------------------------------------
+def generate_chain(size: int, seed: int = 0) -> FactorGraph:
+    """
+    1-D contour like in ContourFitting: heights smoothed towards their neighbours and 0.6 * size step measurements
+    """
+    np.random.seed(seed)
+    variable_nodes = generate_variable_nodes(size, 1)
+    factor_nodes, _ = generate_measurement_factors(variable_nodes, generate_measurement_step, int(0.6 * size),
+                                                   np.array([[0.01]]), False)
+    factor_nodes.extend(generate_smoothing_factors(variable_nodes, np.array([[0.01]]), False))
+    return FactorGraph(variable_nodes, factor_nodes)
+
+
+def generate_loopy(size: int, seed: int = 0) -> FactorGraph:
+    """
+    Random loopy graph: a chain of heights with noisy priors and size / 2 smoothing factors between random pairs
+    """
+    rng = np.random.RandomState(seed)
+    variable_nodes = []
+    for _ in range(size):
+        node = VariableNode(1)
+        node.prior.set_values(np.array([rng.randn()]), np.array([[1.]]))
+        node.belief = node.prior.copy()
+        variable_nodes.append(node)
+    pairs = [(i, i + 1) for i in range(size - 1)]
+    pairs += [tuple(rng.choice(size, 2, replace=False)) for _ in range(size // 2)]
+    factor_nodes = [FactorNode([variable_nodes[i], variable_nodes[j]], smoothing, np.array([[0.1]]), np.zeros(1),
+                               smoothing_jac, False, [], linear=True) for i, j in pairs]
+    return FactorGraph(variable_nodes, factor_nodes)
+
+
+def generate_high_arity(size: int, arity: int = 6, seed: int = 0) -> FactorGraph:
+    """
+    2-D points with priors, each point measurement is connected to a window of arity points by a measurement_factor
+    (like in 2dContourFitting)
+    """
+    rng = np.random.RandomState(seed)
+    variable_nodes = []
+    for _ in range(size):
+        node = VariableNode(2)
+        node.prior.set_values(rng.rand(2), np.identity(2) * 0.1)
+        node.belief = node.prior.copy()
+        variable_nodes.append(node)
+    factor_nodes = []
+    for start in range(0, size - arity + 1, max(arity // 2, 1)):
+        adj_vars = variable_nodes[start:start + arity]
+        factor_nodes.append(FactorNode(adj_vars, measurement_factor, np.identity(2 * arity) * 0.2, np.zeros(1),
+                                       measurement_factor_jac, False, [rng.rand(2)], constant_jacobian=True))
+    return FactorGraph(variable_nodes, factor_nodes)
+
+
+GRAPHS: Dict[str, Callable[[int], FactorGraph]] = {
+    "chain": generate_chain,
+    "grid": lambda size: generate_grid(int(np.ceil(np.sqrt(size))), 0., False, None),
+    "loopy": generate_loopy,
+    "high_arity": generate_high_arity,
+}
+
+
+# ---------------------------------- Measurement ------------------------------------
+def time_phases(factor_graph: FactorGraph) -> Dict[str, float]:
+    """
+    Wraps the phases of the synchronous iteration of the given graph with timers
+    :return: accumulated seconds per phase, updated by every following iteration
+    """
+    seconds = {phase: 0. for phase in PHASES}
+
+    def timed(phase: str, run: Callable[[], None]):
+        def run_timed():
+            start = time.perf_counter()
+            run()
+            seconds[phase] += time.perf_counter() - start
+        return run_timed
+
+    for phase in PHASES:
+        setattr(factor_graph, phase, timed(phase, getattr(factor_graph, phase)))
+    return seconds
+
+
+def run_case(graph: str, size: int, max_iterations: int = 200, tolerance: float = 1e-3) -> Dict[str, Any]:
+    """
+    Builds a graph and fits it twice: once timed (phases wrapped) and once with tracemalloc for the peak memory
+    :param graph: name of the graph generator, see GRAPHS
+    :param size: number of variable nodes (rounded up to a square for grids)
+    :return: flat dict of the measurements
+    """
+    start = time.perf_counter()
+    factor_graph = GRAPHS[graph](size)
+    build_seconds = time.perf_counter() - start
+    phase_seconds = time_phases(factor_graph)
+    start = time.perf_counter()
+    report = factor_graph.fit(max_iterations, tolerance)
+    fit_seconds = time.perf_counter() - start
+
+    tracemalloc.start()
+    GRAPHS[graph](size).fit(max_iterations, tolerance)
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    iterations = max(report.iterations, 1)
+    result = {"graph": graph, "size": size, "num_variables": len(factor_graph.variable_nodes),
+              "num_factors": len(factor_graph.factor_nodes), "iterations": report.iterations,
+              "converged": bool(report.converged), "build_seconds": build_seconds, "fit_seconds": fit_seconds,
+              "iterations_per_second": iterations / fit_seconds, "peak_memory_bytes": peak_memory}
+    for phase in PHASES:
+        result[phase + "_ms"] = 1e3 * phase_seconds[phase] / iterations
+    return result
+
+
+def run_suite(graphs: List[str], sizes: List[int], repeats: int = 3) -> List[Dict[str, Any]]:
+    """
+    Runs all combinations of graphs and sizes. Timings are the best of repeats, everything else is deterministic.
+    """
+    results = []
+    for graph in graphs:
+        for size in sizes:
+            runs = [run_case(graph, size) for _ in range(repeats)]
+            best = max(runs, key=lambda run: run["iterations_per_second"])
+            results.append(best)
+            print_result(best)
+    return results
+
+
+def print_result(result: Dict[str, Any]):
+    print("{graph:>10} {size:>5}: {iterations:>4} iterations ({converged!s:>5}), {iterations_per_second:8.1f} it/s, "
+          "relinearize {relinearize_factors_ms:6.2f} ms, messages {compute_all_messages_ms:6.2f} ms, "
+          "beliefs {update_all_beliefs_ms:6.2f} ms, peak {peak_memory_bytes:>9} bytes".format(**result))
+
+
+# ---------------------------------- Engines ------------------------------------
+# Alternative engines, which have to reach the same result as FactorGraph.fit: (graph, max_iterations, tolerance)
+ENGINES: Dict[str, Callable[[FactorGraph, int, float], ConvergenceReport]] = {
+    "batched": lambda factor_graph, max_iterations, tolerance: BatchedFactorGraph(factor_graph).fit(max_iterations,
+                                                                                                    tolerance),
+    "partitioned": lambda factor_graph, max_iterations, tolerance: PartitionedFactorGraph(
+        factor_graph, partition_edge_cut(factor_graph, 2)).fit(max_iterations, tolerance),
+}
+
+
+def check_engines(graphs: List[str], sizes: List[int], max_iterations: int = 200, tolerance: float = 1e-3,
+                  mean_tolerance: float = 1e-6) -> List[str]:
+    """
+    Fits every graph with FactorGraph.fit and every engine of ENGINES. The chain has no priors, so the beliefs are
+    not positive definite before the first iteration.
+    :param mean_tolerance: allowed difference of the means of the engines
+    :return: description of every mismatch, empty if there is none
+    """
+    mismatches = []
+    for graph in graphs:
+        for size in sizes:
+            factor_graph = GRAPHS[graph](size)
+            reference = factor_graph.fit(max_iterations, tolerance)
+            reference_means = np.concatenate([v.mu for v in factor_graph.variable_nodes])
+            for engine, fit in ENGINES.items():
+                case = engine + " " + graph + " " + str(size) + ": "
+                try:
+                    factor_graph = GRAPHS[graph](size)
+                    report = fit(factor_graph, max_iterations, tolerance)
+                except Exception as error:
+                    mismatches.append(case + "raised " + repr(error))
+                    continue
+                if report.iterations != reference.iterations or report.converged != reference.converged:
+                    mismatches.append(case + str(report.iterations) + " iterations (converged: " +
+                                      str(report.converged) + ") instead of " + str(reference.iterations) + " (" +
+                                      str(reference.converged) + ")")
+                difference = np.max(np.abs(np.concatenate([v.mu for v in factor_graph.variable_nodes]) -
+                                           reference_means), initial=0.)
+                if difference > mean_tolerance:
+                    mismatches.append(case + "means differ by {:.2e}".format(difference))
+    return mismatches
+
+
+# ---------------------------------- Baseline ------------------------------------
+def save_baseline(results: List[Dict[str, Any]], path: str):
+    with open(path, "w") as file:
+        json.dump(results, file, indent=1)
+
+
+def compare_to_baseline(results: List[Dict[str, Any]], baseline: List[Dict[str, Any]],
+                        time_tolerance: float = 0.2, memory_tolerance: float = 0.1) -> List[str]:
+    """
+    Compares the results to a stored baseline of the same cases
+    :param time_tolerance: allowed relative loss of iterations per second
+    :param memory_tolerance: allowed relative increase of the peak memory
+    :return: description of every regression, empty if there is none
+    """
+    baseline = {(entry["graph"], entry["size"]): entry for entry in baseline}
+    regressions = []
+    for result in results:
+        reference = baseline.get((result["graph"], result["size"]))
+        if reference is None:
+            continue
+        case = result["graph"] + " " + str(result["size"]) + ": "
+        if result["iterations"] > reference["iterations"] or (reference["converged"] and not result["converged"]):
+            regressions.append(case + "converges in " + str(result["iterations"]) + " instead of " +
+                               str(reference["iterations"]) + " iterations")
+        if result["iterations_per_second"] < (1 - time_tolerance) * reference["iterations_per_second"]:
+            regressions.append(case + "{:.1f} instead of {:.1f} iterations per second".format(
+                result["iterations_per_second"], reference["iterations_per_second"]))
+        if result["peak_memory_bytes"] > (1 + memory_tolerance) * reference["peak_memory_bytes"]:
+            regressions.append(case + "peak memory of " + str(result["peak_memory_bytes"]) + " instead of " +
+                               str(reference["peak_memory_bytes"]) + " bytes")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the synchronous iteration of the GBP core")
+    parser.add_argument("--graphs", nargs="+", default=list(GRAPHS), choices=list(GRAPHS))
+    parser.add_argument("--sizes", nargs="+", type=int, default=[25, 100, 400])
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--save", metavar="PATH", help="store the results as new baseline")
+    parser.add_argument("--baseline", metavar="PATH", help="compare the results to this baseline")
+    parser.add_argument("--check-engines", action="store_true",
+                        help="only check that all engines (see ENGINES) reach the result of FactorGraph.fit")
+    args = parser.parse_args()
+
+    if args.check_engines:
+        mismatches = check_engines(args.graphs, args.sizes)
+        for mismatch in mismatches:
+            print("MISMATCH " + mismatch)
+        if mismatches:
+            raise SystemExit(1)
+        print("all engines agree")
+        return
+
+    results = run_suite(args.graphs, args.sizes, args.repeats)
+    if args.save:
+        save_baseline(results, args.save)
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare_to_baseline(results, json.load(file))
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        if regressions:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+from typing import Tuple
+import numpy as np
+
+from Tracing import counters
+
+try:
+    from scipy.linalg.lapack import dposv
+except ImportError:  # scipy is optional here, single matrices are factorized by numpy instead (slower)
+    dposv = None
+
+
+class NotPositiveDefiniteError(np.linalg.LinAlgError):
+    __doc__ = "Raised if a precision/covariance matrix, which has to be positive definite, is not."
+
+
+# ------------------------------- closed form kernels ------------------------------------
+# The kernels work on nested lists of elements. An element is either a python float (single matrix)
+# or an array holding the same element of a whole batch of matrices. This way the same formulas are
+# used for single matrices (without numpy overhead) and for batches (vectorized).
+# For single matrices they only pay off for 1 and 2 dimensions, larger ones are faster with one LAPACK call (dposv).
+# For batches of at least _MIN_BATCH matrices the LDL^T substitution beats numpy for any small size (500 matrices
+# 6x6: 0.26 ms instead of 1.2 ms), since numpy pays its per matrix overhead in the batched solvers as well.
+
+def _det_2(m):
+    return m[0][0] * m[1][1] - m[0][1] * m[1][0]
+
+
+def _spd_1(m):
+    return m[0][0] > 0, [[1. / m[0][0]]]
+
+
+def _spd_2(m):
+    det = _det_2(m)
+    return (m[0][0] > 0) & (det > 0), [[m[1][1] / det, -m[0][1] / det],
+                                       [-m[1][0] / det, m[0][0] / det]]
+
+
+_CLOSED_FORM = {1: _spd_1, 2: _spd_2}
+_MIN_BATCH = 64
+
+
+def _ldl_solve(m, b, n: int, k: int):
+    # LDL^T decomposition (cholesky without square roots) and forward/backward substitution of the k columns of b.
+    # The matrix is positive definite iff all pivots d are positive.
+    l = [[None] * n for _ in range(n)]
+    ld = [[None] * n for _ in range(n)]  # l[i][t] * d[t]
+    d = [None] * n
+    is_pd = True
+    for j in range(n):
+        d_j = m[j][j]
+        for t in range(j):
+            d_j = d_j - l[j][t] * ld[j][t]
+        d[j] = d_j
+        is_pd = is_pd & (d_j > 0)
+        for i in range(j + 1, n):
+            s = m[i][j]
+            for t in range(j):
+                s = s - ld[i][t] * l[j][t]
+            ld[i][j] = s
+            l[i][j] = s / d_j
+    x = [[None] * k for _ in range(n)]
+    for c in range(k):
+        y = [None] * n
+        for i in range(n):
+            y_i = b[i][c]
+            for t in range(i):
+                y_i = y_i - l[i][t] * y[t]
+            y[i] = y_i
+        for i in reversed(range(n)):
+            x_i = y[i] / d[i]
+            for t in range(i + 1, n):
+                x_i = x_i - l[t][i] * x[t][c]
+            x[i][c] = x_i
+    return is_pd, x
+
+
+def _closed_form(mat: np.ndarray):
+    """
+    Runs the closed form kernel on a (batch of) matrices
+    :return: positive definite flag(s) and the inverse(s), which are only valid where the flag is set
+    """
+    n = mat.shape[-1]
+    if mat.ndim == 2:
+        try:
+            is_pd, inv = _CLOSED_FORM[n](mat.tolist())
+        except ZeroDivisionError:
+            return False, None
+        return bool(is_pd), np.array(inv)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        is_pd, inv = _CLOSED_FORM[n]([[mat[..., i, j] for j in range(n)] for i in range(n)])
+    return np.asarray(is_pd), np.moveaxis(np.array(inv), (0, 1), (-2, -1))
+
+
+def _closed_form_solve(mat: np.ndarray, rhs: np.ndarray):
+    """
+    Runs the LDL^T kernel on a (batch of) matrices and right hand sides of the same batch shape
+    :return: positive definite flag(s) and the solution(s), which are only valid where the flag is set
+    """
+    n, k = mat.shape[-1], rhs.shape[-1]
+    if mat.ndim == 2:
+        try:
+            is_pd, x = _ldl_solve(mat.tolist(), rhs.tolist(), n, k)
+        except ZeroDivisionError:
+            return False, None
+        return bool(is_pd), np.array(x)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        is_pd, x = _ldl_solve([[mat[..., i, j] for j in range(n)] for i in range(n)],
+                              [[rhs[..., i, c] for c in range(k)] for i in range(n)], n, k)
+    return np.asarray(is_pd), np.moveaxis(np.array(x), (0, 1), (-2, -1))
+
+
+# ------------------------------------ public API ----------------------------------------
+
+def positive_definite(mat: np.ndarray):
+    """
+    Checks if a (batch of) symmetric matrices is positive definite
+    :param mat: matrix of shape (..., n, n)
+    :return: bool for a single matrix, otherwise bool array of the batch shape
+    """
+    mat = np.asarray(mat, dtype=float)
+    n = mat.shape[-1]
+    if n in _CLOSED_FORM:
+        return _closed_form(mat)[0]
+    if mat.ndim == 2:
+        try:
+            np.linalg.cholesky(mat)
+            return True
+        except np.linalg.LinAlgError:
+            return False
+    flat = mat.reshape((-1, n, n))
+    is_pd = np.zeros(len(flat), dtype=bool)
+    for i, m in enumerate(flat):
+        try:
+            np.linalg.cholesky(m)
+            is_pd[i] = True
+        except np.linalg.LinAlgError:
+            pass
+    return is_pd.reshape(mat.shape[:-2])
+
+
+_IDENTITIES = {}
+
+
+def _identity(n: int) -> np.ndarray:
+    if n not in _IDENTITIES:
+        _IDENTITIES[n] = np.identity(n)
+    return _IDENTITIES[n]
+
+
+def _lapack_solve(mat: np.ndarray, rhs: np.ndarray) -> np.ndarray:
+    """
+    Cholesky factorization and solve of a single matrix in one LAPACK call (about 2 us, np.linalg.solve alone
+    takes about 6 us), which also detects matrices, that are not positive definite
+    """
+    chol, x, info = dposv(mat, rhs)
+    if info != 0 or not chol[-1, -1] > 0:  # a nan anywhere ends up in the last pivot, LAPACK doesn't report it
+        raise NotPositiveDefiniteError("Matrix is not positive definite:\n" + str(mat))
+    return x
+
+
+def _batch_solve(mat: np.ndarray, rhs: np.ndarray) -> np.ndarray:
+    is_pd, x = _closed_form_solve(mat, rhs)
+    if not is_pd.all():
+        raise NotPositiveDefiniteError("Matrix is not positive definite:\n" + str(mat))
+    return x
+
+
+def _cholesky(mat: np.ndarray) -> np.ndarray:
+    try:
+        chol = np.linalg.cholesky(mat)
+    except np.linalg.LinAlgError:
+        raise NotPositiveDefiniteError("Matrix is not positive definite:\n" + str(mat))
+    if not np.all(chol[..., -1, -1] > 0):  # nan
+        raise NotPositiveDefiniteError("Matrix is not positive definite:\n" + str(mat))
+    return chol
+
+
+def inv_spd(mat: np.ndarray) -> np.ndarray:
+    """
+    Inverts a (batch of) symmetric positive definite matrices.
+    Closed form for 1 and 2 dimensions, cholesky based (see solve_spd) for larger matrices.
+    Prefer solve_spd, if the inverse is multiplied with something anyway.
+    :param mat: matrix of shape (..., n, n)
+    :return: the inverse(s)
+    :raises NotPositiveDefiniteError: if any matrix is not positive definite
+    """
+    mat = np.asarray(mat, dtype=float)
+    n = mat.shape[-1]
+    if counters.active:
+        counters.add("inversions", mat.size // (n * n))
+    if n in _CLOSED_FORM:
+        is_pd, inv = _closed_form(mat)
+        if not (is_pd if mat.ndim == 2 else is_pd.all()):
+            raise NotPositiveDefiniteError("Matrix is not positive definite:\n" + str(mat))
+        return inv
+    if mat.ndim == 2 and dposv is not None:
+        return _lapack_solve(mat, _identity(n))
+    if mat.size >= _MIN_BATCH * n * n:
+        return _batch_solve(mat, np.broadcast_to(_identity(n), mat.shape))
+    chol_inv = np.linalg.inv(_cholesky(mat))
+    return np.swapaxes(chol_inv, -1, -2) @ chol_inv
+
+
+def solve_spd(mat: np.ndarray, rhs: np.ndarray) -> np.ndarray:
+    """
+    Solves mat @ x = rhs for a (batch of) symmetric positive definite matrices without inverting them.
+    Single matrices are solved by one LAPACK call (cholesky), batches by the closed form LDL^T substitution and
+    small batches of larger matrices cholesky based by numpy.
+    :param mat: matrix of shape (..., n, n)
+    :param rhs: right hand side of shape (..., n, k) with the same batch shape
+    :return: x
+    :raises NotPositiveDefiniteError: if any matrix is not positive definite
+    """
+    mat = np.asarray(mat, dtype=float)
+    rhs = np.asarray(rhs, dtype=float)
+    n = mat.shape[-1]
+    if counters.active:
+        counters.add("solves", mat.size // (n * n))
+    if mat.ndim == 2 and dposv is not None:
+        return _lapack_solve(mat, rhs)
+    if mat.ndim > 2 and (n in _CLOSED_FORM or mat.size >= _MIN_BATCH * n * n):
+        return _batch_solve(mat, rhs)
+    chol = _cholesky(mat)
+    # numpy has no (batched) triangular solve, the general solver runs on the triangular factors
+    return np.linalg.solve(np.swapaxes(chol, -1, -2), np.linalg.solve(chol, rhs))
+
+
+def marginalize(eta: np.ndarray, lam: np.ndarray, keep: np.ndarray, rest: np.ndarray) -> Tuple[
+    np.ndarray, np.ndarray]:
+    """
+    Marginalizes a (batch of) gaussians in canonical form onto a subset of its dimensions (schur complement).
+    See https://ieeexplore.ieee.org/document/4020357
+    :param eta: information vector(s) of shape (..., n)
+    :param lam: precision matrix(es) of shape (..., n, n)
+    :param keep: indices of the dimensions to keep
+    :param rest: indices of the dimensions to marginalize out
+    :return: eta and lambda of the marginal
+    :raises NotPositiveDefiniteError: if the precision of the marginalized dimensions is not positive definite
+    """
+    if counters.active:
+        counters.add("marginalizations", eta.size // eta.shape[-1])
+    eta_a = eta[..., keep]
+    lam_aa = lam[..., keep[:, None], keep[None, :]]
+    if rest.size == 0:
+        return eta_a, lam_aa
+    lam_ab = lam[..., keep[:, None], rest[None, :]]
+    # one factorized solve of lam_bb against [lam_ba | eta_b]
+    rhs = np.concatenate([lam[..., rest[:, None], keep[None, :]], eta[..., rest, None]], axis=-1)
+    x = lam_ab @ solve_spd(lam[..., rest[:, None], rest[None, :]], rhs)
+    return eta_a - x[..., -1], lam_aa - x[..., :-1]
+
+
+def add_noise(eta: np.ndarray, lam: np.ndarray, noise: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Adds independent gaussian noise (e.g. a transition noise) to a (batch of) gaussians in canonical form:
+    lam' = lam (I + Q lam)^-1 = (Sigma + Q)^-1 and eta' = (I + lam Q)^-1 eta = lam' mu.
+    In contrast to the moment form this works for singular lam as well (e.g. an uninformative message).
+    :param eta: information vector(s) of shape (..., n)
+    :param lam: precision matrix(es) of shape (..., n, n)
+    :param noise: covariance Q of the noise of shape (n, n) or (..., n, n)
+    :return: eta and lambda with the added noise
+    """
+    if counters.active:
+        counters.add("solves", eta.size // eta.shape[-1])
+    lhs = np.identity(lam.shape[-1]) + lam @ noise
+    solution = np.linalg.solve(lhs, np.concatenate([eta[..., None], lam], axis=-1))
+    lam_noisy = solution[..., 1:]
+    return solution[..., 0], (lam_noisy + np.swapaxes(lam_noisy, -1, -2)) / 2.
@@ -0,0 +1,54 @@
+import tracemalloc
+from typing import Tuple
+import numpy as np
+
+from GBP import VariableNode, FactorNode, FactorGraph
+from ContourFitting import smoothing, smoothing_jac
+
+
+def build_chain(num_variables: int) -> FactorGraph:
+    """
+    Chain of heights with random priors, neighbours are connected by smoothing factors
+    :param num_variables: number of variable nodes
+    """
+    rng = np.random.RandomState(0)
+    variable_nodes = []
+    for i in range(num_variables):
+        node = VariableNode(1)
+        node.prior.set_values(rng.randn(1), np.array([[1.]]))
+        node.belief = node.prior.copy()
+        variable_nodes.append(node)
+    factor_nodes = [FactorNode([variable_nodes[i], variable_nodes[i + 1]], smoothing, np.array([[0.01]]),
+                               np.zeros(1), smoothing_jac, False, [], linear=True)
+                    for i in range(num_variables - 1)]
+    return FactorGraph(variable_nodes, factor_nodes)
+
+
+def measure(num_variables: int) -> Tuple[float, float]:
+    """
+    Measures the memory held by a chain after one iteration (all messages allocated)
+    :return: bytes per variable node, bytes per factor node
+    """
+    tracemalloc.start()
+    start = tracemalloc.take_snapshot()
+    variable_nodes = [VariableNode(1) for _ in range(num_variables)]
+    variables_size = sum(stat.size_diff for stat in tracemalloc.take_snapshot().compare_to(start, "filename"))
+    del variable_nodes
+
+    start = tracemalloc.take_snapshot()
+    factor_graph = build_chain(num_variables)
+    factor_graph.synchronous_iteration()
+    graph_size = sum(stat.size_diff for stat in tracemalloc.take_snapshot().compare_to(start, "filename"))
+    tracemalloc.stop()
+    factors_size = graph_size - variables_size
+    return variables_size / num_variables, factors_size / len(factor_graph.factor_nodes)
+
+
+def main(num_variables: int = 2000):
+    per_variable, per_factor = measure(num_variables)
+    print(str(int(per_variable)) + " bytes per variable node, " + str(int(per_factor))
+          + " bytes per factor node (incl. messages)")
+
+
+if __name__ == "__main__":
+    main()
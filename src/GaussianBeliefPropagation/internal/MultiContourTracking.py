@@ -0,0 +1,178 @@
+import multiprocessing as mp
+import traceback
+from typing import List, Tuple
+import numpy as np
+
+from GBP import FactorGraph
+from FramePipeline import Frame
+from SpatialIndex import NodeIndex
+from ContourTracking import generate_prior, update_factor_graph, fit_frame
+
+
+def kmeans_labels(points: np.ndarray, k: int, num_iterations: int = 10) -> np.ndarray:
+    """
+    Clusters points by k-means with a deterministic farthest point initialization
+    :return: cluster of every point
+    """
+    centers = [points[0]]
+    for _ in range(1, k):
+        distances = np.min([np.linalg.norm(points - center, axis=1) for center in centers], axis=0)
+        centers.append(points[np.argmax(distances)])
+    centers = np.array(centers)
+    labels = np.zeros(len(points), dtype=int)
+    for _ in range(num_iterations):
+        labels = np.argmin(np.linalg.norm(points[:, None] - centers, axis=2), axis=1)
+        centers = np.array([points[labels == c].mean(axis=0) if np.any(labels == c) else centers[c]
+                            for c in range(k)])
+    return labels
+
+
+def split_measurements(measurements: List[np.ndarray], num_contours: int,
+                       contour_means: List[np.ndarray] = None) -> List[List[np.ndarray]]:
+    """
+    Splits the measurements of a frame among the contours: every measurement belongs to the contour with the nearest
+    node. Without contours (first frame) the measurements are clustered by k-means.
+    :param contour_means: (n, 2) means of the nodes of every contour
+    :return: measurements of every contour
+    """
+    points = np.array(measurements)
+    if contour_means is None:
+        labels = kmeans_labels(points, num_contours)
+    else:
+        _, nearest = NodeIndex.from_points(np.concatenate(contour_means)).nearest(points)
+        contour_of_node = np.repeat(np.arange(num_contours), [len(means) for means in contour_means])
+        labels = contour_of_node[nearest]
+    return [[measurements[i] for i in np.nonzero(labels == c)[0].tolist()] for c in range(num_contours)]
+
+
+def fit_contour_frame(measurements: List[np.ndarray], factor_graph: FactorGraph,
+                      frame: int) -> Tuple[FactorGraph, Tuple[np.ndarray, np.ndarray, int]]:
+    """
+    Fits one contour of a frame like the loop in main, without visualization
+    :param factor_graph: the factor graph of the contour, None in the first frame
+    :return: the factor graph and the result: means, covariances and total iterations
+    """
+    if factor_graph is None:
+        factor_graph = generate_prior(measurements)
+    else:
+        factor_graph = update_factor_graph(measurements, factor_graph)
+    factor_graph, total_iterations = fit_frame(measurements, factor_graph, frame, verbose=False)
+    means = np.array([v.mu for v in factor_graph.variable_nodes]).reshape(-1, 2)
+    covariances = np.array([v.sigma for v in factor_graph.variable_nodes]).reshape(-1, 2, 2)
+    return factor_graph, (means, covariances, total_iterations)
+
+
+def _contour_worker(connection, contours: List[int]):
+    """
+    Worker process, which keeps the factor graphs of its contours. Receives (frame, {contour: measurements}) and sends
+    {contour: result} (see fit_contour_frame) or the tracebacks of the failed contours, stops on None. The factor graph
+    of a failed contour is dropped (it is half updated), the contour starts from a new prior in the next frame.
+    """
+    factor_graphs = {contour: None for contour in contours}
+    while True:
+        task = connection.recv()
+        if task is None:
+            break
+        frame, measurements_of = task
+        results, failures = {}, []
+        for contour, measurements in measurements_of.items():
+            try:
+                factor_graphs[contour], results[contour] = fit_contour_frame(measurements, factor_graphs[contour],
+                                                                             frame)
+            except Exception:
+                factor_graphs[contour] = None
+                failures.append("Contour " + str(contour) + ":\n" + traceback.format_exc())
+        connection.send("\n".join(failures) if failures else results)
+    connection.close()
+
+
+class MultiContourTracker:
+    __doc__ = "Tracks several independent contours. The measurements of every frame are split among the contours, " \
+              "which are fitted in parallel by worker processes. Every worker keeps the factor graphs of its " \
+              "contours, so only measurements and results are sent between the processes."
+
+    def __init__(self, num_contours: int, num_workers: int = None, min_measurements: int = 2):
+        """
+        :param num_contours: number of contours
+        :param num_workers: number of worker processes, the contours are distributed round robin. None for one per
+                            contour, 0 to fit all contours in this process.
+        :param min_measurements: contours with fewer measurements in a frame are not fitted in that frame
+        """
+        self.num_contours = num_contours
+        self.num_workers = num_contours if num_workers is None else min(num_workers, num_contours)
+        self.min_measurements = min_measurements
+        self.contour_means: List[np.ndarray] = None
+        self.results: List[Tuple[np.ndarray, np.ndarray, int]] = [(np.zeros((0, 2)), np.zeros((0, 2, 2)), 0)
+                                                                 for _ in range(num_contours)]
+        self.factor_graphs = [None] * num_contours  # only used without workers
+        self.connections = []
+        self.workers = []
+        # fork shares the configuration and the factor functions without pickling, see PartitionedGBP
+        methods = mp.get_all_start_methods()
+        context = mp.get_context("fork" if "fork" in methods else None)
+        for w in range(self.num_workers):
+            connection, worker_connection = context.Pipe()
+            worker = context.Process(target=_contour_worker, args=(worker_connection, self.worker_contours(w)),
+                                     daemon=True)
+            worker.start()
+            worker_connection.close()
+            self.connections.append(connection)
+            self.workers.append(worker)
+
+    def worker_contours(self, worker: int) -> List[int]:
+        return list(range(worker, self.num_contours, self.num_workers))
+
+    def track(self, measurements: List[np.ndarray], frame: int) -> List[Tuple[np.ndarray, np.ndarray, int]]:
+        """
+        Fits all contours to the measurements of one frame
+        :return: means, covariances and total iterations of every contour (iterations are 0, if it was not fitted)
+        :raises RuntimeError: if a contour failed, all other contours keep the state of this frame
+        """
+        measurements_of = split_measurements(measurements, self.num_contours, self.contour_means)
+        tasks = {c: m for c, m in enumerate(measurements_of) if len(m) >= self.min_measurements}
+        results = {}
+        if self.num_workers == 0:
+            failures = []
+            for contour, contour_measurements in tasks.items():
+                try:
+                    self.factor_graphs[contour], results[contour] = fit_contour_frame(
+                        contour_measurements, self.factor_graphs[contour], frame)
+                except Exception:
+                    self.factor_graphs[contour] = None  # like in the workers, see _contour_worker
+                    failures.append("Contour " + str(contour) + ":\n" + traceback.format_exc())
+            if failures:
+                raise RuntimeError("A contour failed:\n" + "\n".join(failures))
+        else:
+            for w, connection in enumerate(self.connections):  # all workers run, before any result is awaited
+                connection.send((frame, {c: tasks[c] for c in self.worker_contours(w) if c in tasks}))
+            # every reply is received before raising, otherwise it would be taken for the result of the next frame
+            replies = [connection.recv() for connection in self.connections]
+            failures = [reply for reply in replies if isinstance(reply, str)]
+            if failures:
+                raise RuntimeError("A contour worker failed:\n" + "\n".join(failures))
+            for worker_results in replies:
+                results.update(worker_results)
+        self.results = [results.get(c, (means, covariances, 0)) for c, (means, covariances, _) in
+                        enumerate(self.results)]
+        if all(len(means) > 0 for means, _, _ in self.results):
+            self.contour_means = [means for means, _, _ in self.results]
+        return self.results
+
+    def __call__(self, frame: Frame) -> List[Tuple[np.ndarray, np.ndarray, int]]:
+        """
+        Solver stage of a FramePipeline
+        """
+        return self.track(frame.measurements, frame.index)
+
+    def close(self):
+        for connection, worker in zip(self.connections, self.workers):
+            connection.send(None)
+            connection.close()
+            worker.join()
+        self.connections, self.workers = [], []
+
+    def __enter__(self) -> "MultiContourTracker":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
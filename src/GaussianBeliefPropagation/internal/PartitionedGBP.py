@@ -0,0 +1,312 @@
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from typing import List, Dict, Tuple
+import numpy as np
+
+from GBP import FactorGraph, ConvergenceReport
+
+
+# ---------------------------------- Partitioning ------------------------------------
+def partition_chain(factor_graph: FactorGraph, num_partitions: int) -> List[List[int]]:
+    """
+    Splits the factors of a chain like graph (e.g. a contour) into contiguous chunks.
+    The factors are ordered by the mean position of their adjacent variables.
+    :param factor_graph: the factor graph
+    :param num_partitions: number of chunks
+    :return: factor idxs of each partition
+    """
+    position = {v.idx: i for i, v in enumerate(factor_graph.variable_nodes)}
+    factors = sorted(factor_graph.factor_nodes,
+                     key=lambda f: np.mean([position[v_idx] for v_idx in f.adj_variable_node_idxs]))
+    chunks = np.array_split(np.arange(len(factors)), num_partitions)
+    return [[factors[i].idx for i in chunk] for chunk in chunks if len(chunk) > 0]
+
+
+def partition_edge_cut(factor_graph: FactorGraph, num_partitions: int) -> List[List[int]]:
+    """
+    Splits the factors of a general graph into connected regions of similar size by greedy region growing
+    (breadth first search over factors sharing a variable). This keeps the number of cut edges low.
+    :param factor_graph: the factor graph
+    :param num_partitions: number of regions
+    :return: factor idxs of each partition
+    """
+    target_size = int(np.ceil(len(factor_graph.factor_nodes) / num_partitions))
+    assigned = set()
+    partitions = []
+    for seed in factor_graph.factor_nodes:
+        if seed.idx in assigned:
+            continue
+        if len(partitions) == 0 or len(partitions[-1]) >= target_size:
+            partitions.append([])
+        partition = partitions[-1]
+        queue = [seed]
+        assigned.add(seed.idx)
+        while queue and len(partition) < target_size:
+            f = queue.pop(0)
+            partition.append(f.idx)
+            for v in f.adj_variable_nodes:
+                for neighbour in v.adj_factors:
+                    if neighbour.idx not in assigned:
+                        assigned.add(neighbour.idx)
+                        queue.append(neighbour)
+        for f in queue:  # region is full, the rest is free again
+            assigned.discard(f.idx)
+    return partitions
+
+
+# ---------------------------------- Shared state layout ------------------------------------
+class SharedLayout:
+    __doc__ = "Offsets of all messages and beliefs within the flat shared memory buffers."
+
+    def __init__(self, factor_graph: FactorGraph, partition_of: Dict[int, int]):
+        """
+        :param factor_graph: the factor graph
+        :param partition_of: factor idx -> partition
+        """
+        variable_nodes = factor_graph.variable_nodes
+
+        # Boundary variables are adjacent to factors of more than one partition
+        self.boundary_variables = set()
+        for v in variable_nodes:
+            if len({partition_of[f.idx] for f in v.adj_factors}) > 1:
+                self.boundary_variables.add(v.idx)
+
+        # Factor to variable messages on boundary edges (see EdgeTable), exchanged every iteration
+        self.boundary_edges: Dict[int, int] = {}
+        size = 0
+        for edge, v_idx in enumerate(factor_graph.edges.variable.tolist()):
+            if v_idx in self.boundary_variables:
+                self.boundary_edges[edge] = size
+                d = variable_nodes[v_idx].dimensions
+                size += d + d * d
+        self.boundary_size = size
+
+        # Complete state, written once at the end
+        self.variable_offsets: Dict[int, int] = {}
+        self.factor_offsets: Dict[int, int] = {}
+        size = 0
+        for v in variable_nodes:
+            self.variable_offsets[v.idx] = size
+            d = v.dimensions
+            size += 2 * (d + d * d)  # belief and moment form
+        for f in factor_graph.factor_nodes:
+            self.factor_offsets[f.idx] = size
+            dim = f.number_of_conditional_variables
+            size += dim + dim * dim
+            for v_idx in f.adj_variable_node_idxs:
+                d = variable_nodes[v_idx].dimensions
+                size += 2 * (d + d * d)  # incoming and outgoing message
+        self.state_size = size
+
+
+def _write_gaussian(buffer: np.ndarray, offset: int, eta, lam) -> int:
+    eta = np.ravel(eta)
+    lam = np.ravel(lam)
+    buffer[offset:offset + eta.size] = eta
+    buffer[offset + eta.size:offset + eta.size + lam.size] = lam
+    return offset + eta.size + lam.size
+
+
+def _read_gaussian(buffer: np.ndarray, offset: int, dim: int) -> Tuple[np.ndarray, np.ndarray, int]:
+    eta = buffer[offset:offset + dim].copy()
+    lam = buffer[offset + dim:offset + dim + dim * dim].reshape(dim, dim).copy()
+    return eta, lam, offset + dim + dim * dim
+
+
+# ---------------------------------- Worker ------------------------------------
+def _run_partition(factor_graph: FactorGraph, layout: SharedLayout, partition: int, factor_idxs: List[int],
+                   owned_variables: List[int], shm_names: Tuple[str, str, str, str], num_partitions: int,
+                   barrier, max_iterations: int, tolerance: float, variable_tolerance: float):
+    """
+    Runs synchronous iterations on the factors of one partition. Boundary messages of the other partitions
+    are read from shared memory, so every iteration is identical to a synchronous iteration of the whole graph.
+    The convergence is checked like in FactorGraph.fit, partition 0 records the history for the report.
+    """
+    shms = [shared_memory.SharedMemory(name=name) for name in shm_names]
+    try:
+        boundary = np.ndarray((layout.boundary_size,), dtype=np.float64, buffer=shms[0].buf)
+        state = np.ndarray((layout.state_size,), dtype=np.float64, buffer=shms[1].buf)
+        # per parity of the iteration: squared change and number of active variables of every partition
+        control = np.ndarray((2, 2, num_partitions), dtype=np.float64, buffer=shms[2].buf)
+        # per iteration: residual and number of active variables, then the active flag of every variable and the
+        # number of iterations
+        history = np.ndarray((2 * max_iterations + len(factor_graph.variable_nodes) + 1,), dtype=np.float64,
+                             buffer=shms[3].buf)
+        active_flags = history[2 * max_iterations:-1]
+        variable_threshold = tolerance if variable_tolerance is None else variable_tolerance
+
+        variable_nodes = factor_graph.variable_nodes
+        factor_nodes = [factor_graph.factor_nodes[idx] for idx in factor_idxs]
+        owned_variables = set(owned_variables)
+        # variables without factors are owned (and updated) by partition 0
+        local_variables = sorted({v_idx for f in factor_nodes for v_idx in f.adj_variable_node_idxs} | owned_variables)
+        own_factors = set(factor_idxs)
+        local_variable_set = set(local_variables)
+        edges = factor_graph.edges
+        own_boundary_edges, foreign_boundary_edges = [], []
+        for edge, offset in layout.boundary_edges.items():
+            f_idx, v_idx = edges.factor[edge], edges.variable[edge]
+            message = factor_graph.factor_nodes[f_idx].messages_to_adj_variables[edges.slot[edge]]
+            if f_idx in own_factors:
+                own_boundary_edges.append((message, offset))
+            elif v_idx in local_variable_set:
+                foreign_boundary_edges.append((message, offset))
+
+        # Means before the first iteration, afterwards the ones computed by the belief update are used
+        means = {}
+        for v_idx in owned_variables:
+            try:
+                means[v_idx] = variable_nodes[v_idx].belief.get_values()[0]
+            except np.linalg.LinAlgError:
+                means[v_idx] = np.zeros(variable_nodes[v_idx].dimensions)
+
+        num_iterations = 0
+        for iteration in range(max_iterations):
+            for f in factor_nodes:
+                f.relinearize()
+                f.compute_outgoing_messages()
+            for message, offset in own_boundary_edges:
+                _write_gaussian(boundary, offset, message.eta, message.lam)
+            barrier.wait()
+
+            for message, offset in foreign_boundary_edges:
+                eta, lam, _ = _read_gaussian(boundary, offset, message.eta.shape[0])
+                message.set(eta, lam)
+            squared_change = 0.
+            num_active = 0
+            for v_idx in local_variables:
+                v = variable_nodes[v_idx]
+                v.update_belief()
+                if v_idx in owned_variables:
+                    mean = v.mu
+                    variable_squared_change = np.sum(np.square(mean - means[v_idx]))
+                    squared_change += variable_squared_change
+                    is_active = np.sqrt(variable_squared_change) >= variable_threshold
+                    active_flags[v_idx] = is_active
+                    num_active += int(is_active)
+                    means[v_idx] = mean
+            # double buffered by parity, so nobody overwrites values, which are still read
+            control[iteration % 2, 0, partition] = squared_change
+            control[iteration % 2, 1, partition] = num_active
+            barrier.wait()
+            residual = np.sqrt(np.sum(control[iteration % 2, 0]))
+            total_active = int(np.sum(control[iteration % 2, 1]))
+            if partition == 0:
+                history[2 * iteration:2 * iteration + 2] = residual, total_active
+            num_iterations = iteration + 1
+            if residual < tolerance and (variable_tolerance is None or total_active == 0):
+                break
+        if partition == 0:
+            history[-1] = num_iterations
+
+        # Write back the final state of owned nodes
+        for v_idx in owned_variables:
+            v = variable_nodes[v_idx]
+            offset = _write_gaussian(state, layout.variable_offsets[v_idx], v.belief.eta, v.belief.lam)
+            _write_gaussian(state, offset, v.mu, v.sigma)
+        for f in factor_nodes:
+            offset = _write_gaussian(state, layout.factor_offsets[f.idx], f.factor_eta, f.factor_lam)
+            for to_factor, to_variable in zip(f.adj_variable_messages, f.messages_to_adj_variables):
+                offset = _write_gaussian(state, offset, to_factor.eta, to_factor.lam)
+                offset = _write_gaussian(state, offset, to_variable.eta, to_variable.lam)
+    except BaseException:
+        barrier.abort()  # don't let the other partitions wait forever
+        raise
+    finally:
+        for shm in shms:
+            shm.close()
+
+
+class PartitionedFactorGraph:
+    __doc__ = "Runs the synchronous iterations of a FactorGraph partitioned over multiple worker processes."
+
+    def __init__(self, factor_graph: FactorGraph, partitions: List[List[int]]):
+        """
+        :param factor_graph: the factor graph to run, its nodes are updated at the end of fit
+        :param partitions: factor idxs of each partition, see partition_chain and partition_edge_cut
+        """
+        self.factor_graph = factor_graph
+        self.partitions = partitions
+        partition_of = {f_idx: p for p, factor_idxs in enumerate(partitions) for f_idx in factor_idxs}
+        self.layout = SharedLayout(factor_graph, partition_of)
+
+        # Every variable is owned (written back and checked for convergence) by exactly one partition
+        self.owned_variables = [[] for _ in partitions]
+        for v in factor_graph.variable_nodes:
+            owners = [partition_of[f.idx] for f in v.adj_factors]
+            self.owned_variables[min(owners) if owners else 0].append(v.idx)
+        # fork shares the graph without pickling, fallback for platforms without fork
+        methods = mp.get_all_start_methods()
+        self.context = mp.get_context("fork" if "fork" in methods else None)
+
+    def fit(self, max_iterations: int = 500, tolerance: float = 0.001,
+            variable_tolerance: float = None) -> ConvergenceReport:
+        """
+        Calls synchronous iteration in all partitions until a convergence criteria is met, see FactorGraph.fit
+        :param max_iterations: maximal number of iterations
+        :param tolerance: converged, if the norm of the change of all means is below
+        :param variable_tolerance: additionally require that the mean of every single variable changed less
+        :return: convergence report
+        """
+        num_partitions = len(self.partitions)
+        num_variables = len(self.factor_graph.variable_nodes)
+        sizes = [max(self.layout.boundary_size, 1), max(self.layout.state_size, 1), 2 * 2 * num_partitions,
+                 2 * max_iterations + num_variables + 1]
+        shms = [shared_memory.SharedMemory(create=True, size=size * 8) for size in sizes]
+        try:
+            barrier = self.context.Barrier(num_partitions)
+            names = tuple(shm.name for shm in shms)
+            workers = [self.context.Process(target=_run_partition,
+                                            args=(self.factor_graph, self.layout, p, self.partitions[p],
+                                                  self.owned_variables[p], names, num_partitions, barrier,
+                                                  max_iterations, tolerance, variable_tolerance))
+                       for p in range(num_partitions)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            if any(worker.exitcode != 0 for worker in workers):
+                raise RuntimeError("A partition of the factor graph failed")
+
+            state = np.ndarray((self.layout.state_size,), dtype=np.float64, buffer=shms[1].buf)
+            history = np.ndarray((sizes[3],), dtype=np.float64, buffer=shms[3].buf)
+            self._read_back(state)
+            return self._report(history, max_iterations, tolerance, variable_tolerance)
+        finally:
+            for shm in shms:
+                shm.close()
+                shm.unlink()
+
+    def _report(self, history: np.ndarray, max_iterations: int, tolerance: float,
+                variable_tolerance: float) -> ConvergenceReport:
+        """
+        Creates the report of fit from the history written by partition 0
+        """
+        report = ConvergenceReport()
+        report.iterations = int(history[-1])
+        report.residuals = history[0:2 * report.iterations:2].tolist()
+        report.num_active_variables = [int(num_active) for num_active in history[1:2 * report.iterations:2]]
+        active_flags = history[2 * max_iterations:-1]
+        report.active_variables = [v.idx for v in self.factor_graph.variable_nodes if active_flags[v.idx] > 0]
+        if report.iterations > 0:
+            report.converged = report.residuals[-1] < tolerance and \
+                               (variable_tolerance is None or report.num_active_variables[-1] == 0)
+        return report
+
+    def _read_back(self, state: np.ndarray):
+        """
+        Updates the nodes of the factor graph with the final state of the workers
+        """
+        variable_nodes = self.factor_graph.variable_nodes
+        for v in variable_nodes:
+            d = v.dimensions
+            v.belief.eta, v.belief.lam, offset = _read_gaussian(state, self.layout.variable_offsets[v.idx], d)
+            v.mu, v.sigma, _ = _read_gaussian(state, offset, d)
+        for f in self.factor_graph.factor_nodes:
+            f.factor_eta, f.factor_lam, offset = _read_gaussian(state, self.layout.factor_offsets[f.idx],
+                                                                f.number_of_conditional_variables)
+            for s, v in enumerate(f.adj_variable_nodes):
+                eta, lam, offset = _read_gaussian(state, offset, v.dimensions)
+                f.receive_message_from(s, eta, lam)
+                eta, lam, offset = _read_gaussian(state, offset, v.dimensions)
+                f.messages_to_adj_variables[s].set(eta, lam)
@@ -0,0 +1,147 @@
+import os
+import threading
+from typing import Dict, Iterator, Callable, Any, List
+import numpy as np
+
+from FramePipeline import FrameQueue
+
+# A recording is a directory of chunk files, which are only ever added (a reader can stream a recording, while it is
+# written). Every chunk holds the snapshots concatenated per key: scalars as one array with one entry per snapshot,
+# arrays (e.g. one row per node) concatenated along the first axis together with "offsets_<key>" of every snapshot.
+
+CHUNK_PREFIX = "chunk_"
+OFFSETS_PREFIX = "offsets_"
+
+
+def chunk_paths(path: str) -> List[str]:
+    """
+    :return: the chunk files of a recording in the order they were written
+    """
+    if not os.path.isdir(path):
+        return []
+    names = sorted(name for name in os.listdir(path) if name.startswith(CHUNK_PREFIX) and name.endswith(".npz"))
+    return [os.path.join(path, name) for name in names]
+
+
+class ChunkedRecorder:
+    __doc__ = "Append-only recording of snapshots (dicts of arrays) into a directory of npz chunks. The snapshots " \
+              "are written by a background thread, so the caller only pays for handing them over. The memory is " \
+              "bounded by the queue and the chunk size."
+
+    def __init__(self, path: str, chunk_size: int = 64, sample_every: int = 1, queue_size: int = 256,
+                 policy: str = "block", transform: Callable[[Dict[str, Any]], Dict[str, Any]] = None):
+        """
+        :param path: directory of the recording, an existing recording is continued
+        :param chunk_size: number of snapshots per chunk file
+        :param sample_every: only every n-th snapshot is recorded
+        :param queue_size: maximum number of snapshots waiting for the writer
+        :param policy: what to do, if the writer falls behind: "block", "drop_oldest" or "drop_newest"
+        :param transform: called by the writer thread for every snapshot before it is stored, e.g. to convert
+                          states, which were handed over without copies, into the stored form
+        """
+        if policy == "merge":
+            raise ValueError("Snapshots can't be merged, use block or one of the drop policies")
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.chunk_size = chunk_size
+        self.sample_every = sample_every
+        self.transform = transform
+        self.num_offered = 0
+        self.num_chunks = len(chunk_paths(path))
+        self.queue = FrameQueue(queue_size, policy)
+        self.error = None
+        self.writer = threading.Thread(target=self._write, name="recorder", daemon=True)
+        self.writer.start()
+
+    def record(self, snapshot: Dict[str, Any]) -> bool:
+        """
+        Hands a snapshot over to the writer. The arrays must not be modified afterwards.
+        :return: whether this snapshot was enqueued, False if it was not sampled, dropped (drop_newest) or the
+                 recorder is closed. With drop_oldest it is enqueued even if an older snapshot is dropped for it.
+        """
+        self.num_offered += 1
+        if (self.num_offered - 1) % self.sample_every != 0:
+            return False
+        outcome = self.queue.put(snapshot)
+        return outcome is None or (outcome == "dropped" and self.queue.policy == "drop_oldest")
+
+    def close(self):
+        """
+        Writes the remaining snapshots and stops the writer
+        :raises: the exception of the writer, if it failed
+        """
+        self.queue.close()
+        self.writer.join()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self) -> "ChunkedRecorder":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _write(self):
+        snapshots = []
+        try:
+            while True:
+                snapshot = self.queue.get()
+                if snapshot is None:
+                    break
+                snapshots.append(snapshot if self.transform is None else self.transform(snapshot))
+                if len(snapshots) >= self.chunk_size:
+                    self._write_chunk(snapshots)
+                    snapshots = []
+            if snapshots:
+                self._write_chunk(snapshots)
+        except BaseException as error:
+            self.error = error
+            self.queue.close(discard=True)
+
+    def _write_chunk(self, snapshots: List[Dict[str, Any]]):
+        columns = {}
+        for key in snapshots[0]:
+            values = [np.asarray(snapshot[key]) for snapshot in snapshots]
+            if all(value.ndim == 0 for value in values):
+                columns[key] = np.array(values)
+            else:
+                columns[key] = np.concatenate(values)
+                columns[OFFSETS_PREFIX + key] = np.cumsum([0] + [len(value) for value in values])
+        # written under a temporary name first, so readers never see a partial chunk
+        name = os.path.join(self.path, CHUNK_PREFIX + "{:06d}".format(self.num_chunks))
+        with open(name + ".tmp", "wb") as file:
+            np.savez(file, **columns)
+        os.replace(name + ".tmp", name + ".npz")
+        self.num_chunks += 1
+
+
+def count_snapshots(path: str) -> int:
+    """
+    Number of snapshots of a recording, only reads the offsets (or scalars) of every chunk
+    """
+    count = 0
+    for chunk in chunk_paths(path):
+        with np.load(chunk) as data:
+            count += _num_snapshots(data.files, lambda key: len(data[key]))
+    return count
+
+
+def _num_snapshots(keys: List[str], length: Callable[[str], int]) -> int:
+    offsets = [key for key in keys if key.startswith(OFFSETS_PREFIX)]
+    return length(offsets[0]) - 1 if offsets else length(keys[0])
+
+
+def read_recording(path: str) -> Iterator[Dict[str, np.ndarray]]:
+    """
+    Streams the snapshots of a recording, only one chunk is loaded at a time
+    """
+    for chunk in chunk_paths(path):
+        with np.load(chunk) as data:
+            columns = {key: data[key] for key in data.files}
+        keys = [key for key in columns if not key.startswith(OFFSETS_PREFIX)]
+        for i in range(_num_snapshots(list(columns), lambda key: len(columns[key]))):
+            snapshot = {}
+            for key in keys:
+                offsets = columns.get(OFFSETS_PREFIX + key)
+                snapshot[key] = columns[key][i] if offsets is None else columns[key][offsets[i]:offsets[i + 1]]
+            yield snapshot
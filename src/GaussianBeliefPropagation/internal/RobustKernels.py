@@ -0,0 +1,134 @@
+from abc import ABC, abstractmethod
+from typing import Sequence, Tuple
+import numpy as np
+
+
+# The kernels replace the quadratic energy 0.5 * d^2 of a residual with mahalanobis distance d by a robust energy
+# rho(d). Like the original huber implementation, the noise is rescaled such that the quadratic energy of the
+# reweighted noise matches the robust energy at the current residual: 0.5 * d^2 * scale = rho(d).
+
+class RobustKernel(ABC):
+    __doc__ = "Robust energy of a residual depending on its mahalanobis distance, see the subclasses."
+    __slots__ = ("threshold",)
+
+    def __init__(self, threshold: float):
+        """
+        :param threshold: mahalanobis distance, where the energy starts to deviate from the quadratic energy
+        """
+        self.threshold = threshold
+
+    @staticmethod
+    @abstractmethod
+    def energy_of(mahalanobis: np.ndarray, threshold: np.ndarray) -> np.ndarray:
+        """
+        Robust energy, works elementwise on arrays
+        :param mahalanobis: mahalanobis distances of the residuals
+        :param threshold: thresholds of the kernels
+        """
+
+    @classmethod
+    def precision_scale_of(cls, mahalanobis: np.ndarray, threshold: np.ndarray) -> np.ndarray:
+        """
+        Factor for the precision of the measurement noise, such that the quadratic energy matches the robust energy.
+        Residuals with a distance of 0 keep the precision.
+        """
+        mahalanobis = np.asarray(mahalanobis, dtype=float)
+        squared = np.square(mahalanobis)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            scale = 2 * cls.energy_of(mahalanobis, threshold) / squared
+        return np.where(squared > 0, scale, 1.)
+
+    def energy(self, mahalanobis: float) -> float:
+        return float(self.energy_of(mahalanobis, self.threshold))
+
+    def precision_scale(self, mahalanobis: float) -> float:
+        """
+        Precision scale of a single residual, see precision_scale_of
+        """
+        if mahalanobis <= 0:
+            return 1.
+        return 2 * self.energy(mahalanobis) / (mahalanobis * mahalanobis)
+
+    def __repr__(self):
+        return type(self).__name__ + "(" + str(self.threshold) + ")"
+
+
+class HuberKernel(RobustKernel):
+    __doc__ = "Quadratic up to the threshold, linear afterwards."
+    __slots__ = ()
+
+    @staticmethod
+    def energy_of(mahalanobis: np.ndarray, threshold: np.ndarray) -> np.ndarray:
+        clipped = np.minimum(mahalanobis, threshold)
+        return clipped * (mahalanobis - 0.5 * clipped)
+
+
+class CauchyKernel(RobustKernel):
+    __doc__ = "Logarithmic energy, outliers still have a small influence."
+    __slots__ = ()
+
+    @staticmethod
+    def energy_of(mahalanobis: np.ndarray, threshold: np.ndarray) -> np.ndarray:
+        return 0.5 * np.square(threshold) * np.log1p(np.square(mahalanobis / threshold))
+
+
+class TukeyKernel(RobustKernel):
+    __doc__ = "Biweight energy, which is constant beyond the threshold, so outliers have (almost) no influence."
+    __slots__ = ()
+
+    @staticmethod
+    def energy_of(mahalanobis: np.ndarray, threshold: np.ndarray) -> np.ndarray:
+        inlier = 1. - np.square(np.minimum(mahalanobis / threshold, 1.))
+        return np.square(threshold) / 6. * (1. - inlier * inlier * inlier)
+
+
+def whiten_noise(noise: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Factorizes a (batch of) measurement noise covariances once, noise = L L^T (cholesky)
+    :param noise: covariance(s) of shape (..., m, m)
+    :return: precision(s) and whitening matrix(es) W = L^-1, so the mahalanobis distance of r is |W r|
+    """
+    noise = np.asarray(noise, dtype=float)
+    whitening = np.linalg.inv(np.linalg.cholesky(noise))
+    return np.swapaxes(whitening, -1, -2) @ whitening, whitening
+
+
+def whiten_precision(lam: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Like whiten_noise, but for a known precision (e.g. of a marginal), lam = L L^T (cholesky), without inverting it
+    :param lam: precision(s) of shape (..., m, m)
+    :return: the precision(s) and whitening matrix(es) W = L^T
+    """
+    lam = np.asarray(lam, dtype=float)
+    return lam, np.swapaxes(np.linalg.cholesky(lam), -1, -2)
+
+
+def mahalanobis(residuals: np.ndarray, whitening: np.ndarray):
+    """
+    Mahalanobis distances of a (batch of) residuals
+    :param residuals: residuals of shape (..., m)
+    :param whitening: whitening matrix(es) of shape (..., m, m), see whiten_noise
+    :return: float for a single residual, otherwise array of the batch shape
+    """
+    if residuals.ndim == 1:
+        whitened = whitening @ residuals
+        return float(np.sqrt(whitened @ whitened))
+    whitened = (whitening @ residuals[..., None])[..., 0]
+    return np.sqrt(np.einsum("...i,...i->...", whitened, whitened))
+
+
+def precision_scales(kernels: Sequence[RobustKernel], distances: np.ndarray) -> np.ndarray:
+    """
+    Precision scales of a batch of factors, one vectorized evaluation per kind of kernel
+    :param kernels: kernel of each factor, None for a quadratic energy
+    :param distances: mahalanobis distance of the residual of each factor
+    """
+    scales = np.ones(len(kernels))
+    by_type = {}
+    for row, kernel in enumerate(kernels):
+        if kernel is not None:
+            by_type.setdefault(type(kernel), []).append(row)
+    for kernel_type, rows in by_type.items():
+        thresholds = np.array([kernels[row].threshold for row in rows])
+        scales[rows] = kernel_type.precision_scale_of(distances[rows], thresholds)
+    return scales
@@ -0,0 +1,109 @@
+from typing import List, Tuple
+import numpy as np
+
+from GBP import VariableNode
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:  # scipy is optional here, the brute force search is used instead
+    cKDTree = None
+
+
+class NodeIndex:
+    __doc__ = "Nearest neighbour index over the means of variable nodes. The means move with every iteration, " \
+              "so the index is a snapshot: build it again (O(N log N)) after the graph was fitted or changed."
+
+    def __init__(self, variable_nodes: List[VariableNode], use_tree: bool = True, chunk_size: int = 256,
+                 dimensions: int = 2):
+        """
+        :param variable_nodes: nodes, the idxs returned by the queries are positions in this list, may be empty
+        :param use_tree: use a KD-tree (needs scipy), otherwise a brute force search vectorized over chunks of queries
+        :param chunk_size: number of queries per chunk of the brute force search, bounds its memory
+        :param dimensions: dimensions of the means, only used if there are no nodes
+        """
+        if len(variable_nodes) == 0:
+            points = np.zeros((0, dimensions))
+        else:
+            points = np.array([v.mu for v in variable_nodes], dtype=float).reshape(len(variable_nodes), -1)
+        self._build(points, use_tree, chunk_size)
+
+    @classmethod
+    def from_points(cls, points: np.ndarray, use_tree: bool = True, chunk_size: int = 256) -> "NodeIndex":
+        """
+        Index over arbitrary points of shape (N, dimensions), e.g. the means of several contours
+        """
+        index = cls.__new__(cls)
+        index._build(np.asarray(points, dtype=float), use_tree, chunk_size)
+        return index
+
+    def _build(self, points: np.ndarray, use_tree: bool, chunk_size: int):
+        self.points = points
+        self.tree = cKDTree(points) if use_tree and cKDTree is not None and len(points) > 0 else None
+        self.chunk_size = chunk_size
+
+    def nearest(self, queries: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        One batched nearest neighbour query for all points
+        :param queries: points of shape (M, dimensions), e.g. all measurements of a frame
+        :return: euclidean distances and positions of the nearest nodes, both of shape (M,)
+        :raises ValueError: if the index has no nodes (k_nearest returns no neighbours instead)
+        """
+        if len(self.points) == 0:
+            raise ValueError("The nearest node of an empty index is undefined")
+        queries = np.asarray(queries, dtype=float).reshape(-1, self.points.shape[1])
+        if self.tree is not None:
+            distances, idxs = self.tree.query(queries)
+            return distances, idxs.astype(np.intp)
+        distances = np.empty(len(queries))
+        idxs = np.empty(len(queries), dtype=np.intp)
+        for start in range(0, len(queries), self.chunk_size):
+            chunk = queries[start:start + self.chunk_size]
+            squared = np.einsum("mnd,mnd->mn", chunk[:, None] - self.points, chunk[:, None] - self.points)
+            nearest = np.argmin(squared, axis=1)
+            idxs[start:start + len(chunk)] = nearest
+            distances[start:start + len(chunk)] = np.sqrt(squared[np.arange(len(chunk)), nearest])
+        return distances, idxs
+
+    def k_nearest(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        One batched query of the k nearest nodes of all points
+        :param queries: points of shape (M, dimensions)
+        :param k: number of neighbours, limited to the number of nodes
+        :return: euclidean distances and positions of the nodes, both of shape (M, k) and sorted by distance
+        """
+        queries = np.asarray(queries, dtype=float).reshape(-1, self.points.shape[1])
+        k = min(k, len(self.points))
+        if self.tree is not None:
+            distances, idxs = self.tree.query(queries, k)
+            return distances.reshape(len(queries), k), idxs.reshape(len(queries), k).astype(np.intp)
+        distances = np.empty((len(queries), k))
+        idxs = np.empty((len(queries), k), dtype=np.intp)
+        for start in range(0, len(queries), self.chunk_size):
+            chunk = queries[start:start + self.chunk_size]
+            squared = np.einsum("mnd,mnd->mn", chunk[:, None] - self.points, chunk[:, None] - self.points)
+            nearest = np.argpartition(squared, k - 1, axis=1)[:, :k]
+            nearest_squared = np.take_along_axis(squared, nearest, axis=1)
+            order = np.argsort(nearest_squared, axis=1)
+            idxs[start:start + len(chunk)] = np.take_along_axis(nearest, order, axis=1)
+            distances[start:start + len(chunk)] = np.sqrt(np.take_along_axis(nearest_squared, order, axis=1))
+        return distances, idxs
+
+    def gated_k_nearest(self, queries: np.ndarray, k: int, gate: float = np.inf,
+                        covariances: np.ndarray = None) -> List[np.ndarray]:
+        """
+        The k nearest nodes of every point, which are within the gate
+        :param queries: points of shape (M, dimensions)
+        :param k: maximum number of nodes per point
+        :param gate: maximum distance of a node
+        :param covariances: covariances of the node means of shape (N, dimensions, dimensions). If given, the gate
+                            applies to the mahalanobis distance of the point to the candidates (the k euclidean nearest
+                            nodes), otherwise to the euclidean distance.
+        :return: positions of the gated nodes for every point, sorted by position (e.g. along a contour), may be empty
+        """
+        distances, idxs = self.k_nearest(queries, k)
+        if covariances is not None:
+            queries = np.asarray(queries, dtype=float).reshape(-1, self.points.shape[1])
+            residuals = queries[:, None] - self.points[idxs]
+            solved = np.linalg.solve(covariances[idxs], residuals[..., None])[..., 0]
+            distances = np.sqrt(np.einsum("mkd,mkd->mk", residuals, solved))
+        return [np.sort(row[gated]) for row, gated in zip(idxs, distances <= gate)]
@@ -0,0 +1,165 @@
+import json
+import os
+import sys
+import threading
+import time
+from typing import List, Dict, Any, Optional
+
+
+class OperationCounters:
+    __doc__ = "Counts of the expensive operations of the hot path (matrices, not calls, for batches). " \
+              "Only counted while a span of a Tracer is open. Every thread counts into its own list (the worker " \
+              "threads of FactorGraph too), the lists are summed up when a span starts or ends."
+    __slots__ = ("active", "local", "threads", "lock")
+    NAMES = ("inversions", "solves", "marginalizations", "relinearizations")
+    INDEX = {name: i for i, name in enumerate(NAMES)}
+
+    def __init__(self):
+        self.active = 0  # number of open spans (of all threads, changed under the lock), counting is enabled if > 0
+        self.local = threading.local()
+        self.threads: List[List[int]] = []  # counts of every thread, which counted something
+        self.lock = threading.Lock()
+
+    def add(self, name: str, count: int = 1):
+        """
+        Adds to the count of the calling thread, only one thread writes to it, so no lock is needed
+        :param name: one of NAMES
+        """
+        counts = getattr(self.local, "counts", None)
+        if counts is None:
+            counts = self.local.counts = [0] * len(self.NAMES)
+            with self.lock:
+                self.threads.append(counts)
+        counts[self.INDEX[name]] += count
+
+    def snapshot(self) -> List[int]:
+        """
+        :return: counts summed over all threads, exact if no other thread is counting at the moment (e.g. at the
+                 start and end of the spans around the iterations, whose worker threads have finished)
+        """
+        with self.lock:
+            threads = list(self.threads)
+        return [sum(counts[i] for counts in threads) for i in range(len(self.NAMES))]
+
+
+counters = OperationCounters()
+
+
+class Span:
+    __doc__ = "Timed section of a trace, use as context manager. Nested spans are allowed."
+    __slots__ = ("tracer", "name", "args", "start", "counts", "blocks")
+
+    def __init__(self, tracer: "Tracer", name: str, args: Dict[str, Any]):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def set(self, **args):
+        """
+        Adds arguments to the event of the span, e.g. results, which are only known at the end
+        """
+        self.args.update(args)
+
+    def __enter__(self) -> "Span":
+        with counters.lock:  # spans may be opened by several threads
+            counters.active += 1
+        self.counts = counters.snapshot()
+        self.blocks = sys.getallocatedblocks()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        end = time.perf_counter()
+        self.args["allocated_blocks"] = sys.getallocatedblocks() - self.blocks  # net change
+        for name, before, after in zip(OperationCounters.NAMES, self.counts, counters.snapshot()):
+            if after != before:
+                self.args[name] = after - before
+        with counters.lock:
+            counters.active -= 1
+        self.tracer.add_event(self.name, self.start, end - self.start, self.args)
+
+
+class NoSpan:
+    __doc__ = "Span of a disabled tracer, does nothing."
+    __slots__ = ()
+
+    def set(self, **args):
+        pass
+
+    def __enter__(self) -> "NoSpan":
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NO_SPAN = NoSpan()
+
+
+class Tracer:
+    __doc__ = "Opt-in structured trace of the iterations of factor graphs, written as JSON lines or Chrome trace. " \
+              "Every span records its wall time, the operation counts (see OperationCounters) and the net change " \
+              "of allocated memory blocks."
+
+    def __init__(self, message_residuals: bool = True):
+        """
+        :param message_residuals: record the norm of the change of the factor to variable messages per iteration
+                                  (copies the message buffers once per iteration)
+        """
+        self.message_residuals = message_residuals
+        self.events: List[Dict[str, Any]] = []
+        self.origin = time.perf_counter()
+
+    def span(self, name: str, **args) -> Span:
+        """
+        :param name: name of the section, e.g. the phase
+        :param args: additional arguments of the event, e.g. the graph size
+        """
+        return Span(self, name, args)
+
+    def add_event(self, name: str, start: float, duration: float = None, args: Dict[str, Any] = None):
+        """
+        Adds an event of the calling thread, spans add themselves on exit
+        :param name: name of the event
+        :param start: perf_counter at the start of the event
+        :param duration: duration in seconds, None for an instantaneous event
+        :param args: arguments of the event
+        """
+        event = {"name": name, "ts": 1e6 * (start - self.origin), "tid": threading.get_native_id(), "args": args or {}}
+        if duration is not None:
+            event["dur"] = 1e6 * duration
+        self.events.append(event)
+
+    def instant(self, name: str, **args):
+        self.add_event(name, time.perf_counter(), None, args)
+
+    def sorted_events(self) -> List[Dict[str, Any]]:
+        """
+        Events in the order of their start (spans are added on exit, so nested spans come first otherwise)
+        """
+        return sorted(self.events, key=lambda event: event["ts"])
+
+    def write_json_lines(self, path: str):
+        with open(path, "w") as file:
+            for event in self.sorted_events():
+                file.write(json.dumps(event) + "\n")
+
+    def write_chrome_trace(self, path: str):
+        """
+        Writes the trace in the Chrome trace event format (chrome://tracing, Perfetto)
+        """
+        pid = os.getpid()
+        trace_events = [dict(event, ph="X" if "dur" in event else "i", pid=pid)
+                        for event in self.sorted_events()]
+        with open(path, "w") as file:
+            json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, file)
+
+    def clear(self):
+        self.events = []
+
+
+def span(tracer: Optional[Tracer], name: str, **args):
+    """
+    Span of the given tracer or a span doing nothing, if tracing is disabled (tracer is None)
+    """
+    return NO_SPAN if tracer is None else tracer.span(name, **args)